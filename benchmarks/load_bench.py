@@ -0,0 +1,324 @@
+"""
+Load generator for the servers. Starts a server on loopback, in a separate
+process, with a synthetic connections file, connects N clients with M
+terminals each and drives state changes through it:
+
+    python benchmarks/load_bench.py [--server qt2|qt1|aio] [--clients N] [--terminals M]
+                                    [--fan-out F] [--changes C] [--rate R] [--output results.json]
+
+Every net has one source terminal and F sink terminals, spread over the next F
+clients, so every change crosses clients. Clients speak the SASClient2
+protocol (SASServer's inputs and outputs registration for qt1), binary if
+--protocol is 2 or more and the server agrees. Reported, as JSON:
+
+    registration_seconds   connect and register all clients, until every client has its snapshot
+    changes_per_second     source changes sent per second, until the last one has reached all sinks
+    deliveries_per_second  sink state changes received per second
+    latency_ms             percentiles of the time from a source change to a sink receiving it
+    disconnect_seconds     close half the clients, until the other half has seen their sinks reset
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sas import protocol
+
+
+def sourceName(client, net):
+    return 'C%04dS%04d' % (client, net)
+
+
+def sinkName(client, net, sink):
+    return 'C%04dS%04dL%02d' % (client, net, sink)
+
+
+def writeConnections(path, clients, nets_per_client, fan_out):
+    with open(path, 'w') as f:
+        for client in range(clients):
+            for net in range(nets_per_client):
+                f.write('%s -> %s\n' % (sourceName(client, net), ', '.join(sinkName(client, net, sink) for sink in range(fan_out))))
+
+
+def serve(server_kind, port, connections_path):
+    """
+    Runs a server until killed. This is the server process of the benchmark.
+    """
+    if server_kind == 'aio':
+        from sas.aioserver import SASAsyncServer
+        asyncio.run(SASAsyncServer(port, connections_path, host='127.0.0.1').serveForever())
+        return
+
+    from PySide2 import QtCore
+    from sas.server import SASServer, SASServer2
+
+    app = QtCore.QCoreApplication([])
+    if server_kind == 'qt1':
+        server = SASServer(port, connections_path)
+    else:
+        server = SASServer2(port, connections_path, watch_connections=False)
+    app.exec_()
+
+
+class BenchClient(object):
+
+    def __init__(self, bench, index, protocol_version):
+        self.bench = bench
+        self.index = index
+        self.name = 'bench%04d' % index
+        self.protocol_version = protocol_version
+        self.negotiated_protocol_version = protocol.text_protocol_version
+
+        # Sources of this client, and its sinks as sink -> (source client, net).
+        self.sources = [sourceName(index, net) for net in range(bench.nets_per_client)]
+        self.sinks = {}
+        for sink in range(bench.fan_out):
+            source_client = (index - sink - 1) % bench.clients
+            for net in range(bench.nets_per_client):
+                self.sinks[sinkName(source_client, net, sink)] = (source_client, net)
+
+        self.terminal_ids = {}
+        self.terminal_names = {}
+        self.states = {}
+        self.received_counts = dict.fromkeys(self.sinks, 0)
+        self.receive_buffer = bytearray()
+        self.snapshot = None
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.read_task = asyncio.ensure_future(self.readMessages())
+
+    async def register(self):
+        loop = asyncio.get_event_loop()
+        self.snapshot = loop.create_future()
+
+        messages = ['clientname:%s:%d' % (self.name, self.protocol_version)]
+        if self.bench.server_kind == 'qt1':
+            messages.append('registration:outputs:' + ':'.join(self.sources))
+            messages.append('registration:inputs:' + ':'.join(self.sinks))
+        else:
+            messages.append('registration:' + ':'.join(self.sources + list(self.sinks)))
+        messages.append('snapshot:own')
+        self.writer.write(('\n'.join(messages) + '\n').encode())
+        await self.snapshot
+
+    def sendChange(self, terminal_name, state):
+        if self.negotiated_protocol_version >= protocol.binary_protocol_version and terminal_name in self.terminal_ids:
+            self.writer.write(protocol.packStateChange(self.terminal_ids[terminal_name], protocol.state_codes[state]))
+        else:
+            self.writer.write(('statechange:%s:%s\n' % (terminal_name, state)).encode())
+
+    async def readMessages(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            now = time.perf_counter()
+            self.receive_buffer.extend(data)
+            for frame in protocol.splitFrames(self.receive_buffer):
+                if frame.__class__ is tuple:
+                    _, terminal_id, state_code = frame
+                    self.receivedState(self.terminal_names[terminal_id], protocol.state_table[state_code], now)
+                    continue
+                entries = frame.split(':')
+                if entries[0] == 'statechange':
+                    self.receivedState(entries[1], entries[2], now)
+                elif entries[0] == 'states':
+                    for terminal_name, state in protocol.unpackStates(entries[1:]):
+                        self.receivedState(terminal_name, state, now)
+                elif entries[0] == 'protocol':
+                    self.negotiated_protocol_version = int(entries[1])
+                elif entries[0] == 'terminalids':
+                    for terminal_name, terminal_id in protocol.unpackStates(entries[1:]):
+                        self.terminal_ids[terminal_name] = int(terminal_id)
+                        self.terminal_names[int(terminal_id)] = terminal_name
+                elif entries[0] == 'snapshot' and self.snapshot is not None and not self.snapshot.done():
+                    self.snapshot.set_result(None)
+
+    def receivedState(self, terminal_name, state, now):
+        self.states[terminal_name] = state
+        if terminal_name not in self.sinks:
+            return
+
+        if state == protocol.no_state:
+            self.bench.sinkReset(terminal_name)
+            return
+
+        # Every change of a net reaches every sink in order, so the n:th change received
+        # by a sink is the n:th change sent on its net.
+        source_client, net = self.sinks[terminal_name]
+        send_times = self.bench.send_times[source_client][net]
+        count = self.received_counts[terminal_name]
+        if count < len(send_times):
+            self.bench.latencies.append(now - send_times[count])
+        self.received_counts[terminal_name] = count + 1
+        self.bench.delivered += 1
+        if self.bench.delivered >= self.bench.expected_deliveries:
+            self.bench.all_delivered.set()
+
+    async def close(self):
+        self.writer.close()
+        self.read_task.cancel()
+
+
+class LoadBench(object):
+
+    def __init__(self, args):
+        self.server_kind = args.server
+        self.clients = args.clients
+        self.fan_out = min(args.fan_out, args.clients - 1) if args.clients > 1 else 0
+        self.nets_per_client = max(1, args.terminals // (self.fan_out + 1))
+        self.changes = args.changes
+        self.rate = args.rate
+        self.protocol_version = args.protocol
+
+        self.send_times = [[[] for net in range(self.nets_per_client)] for client in range(self.clients)]
+        self.latencies = []
+        self.delivered = 0
+        self.expected_deliveries = 0
+        self.all_delivered = asyncio.Event()
+
+        self.reset_sinks = set()
+        self.expected_resets = set()
+        self.all_reset = asyncio.Event()
+
+    def sinkReset(self, terminal_name):
+        if terminal_name in self.expected_resets:
+            self.reset_sinks.add(terminal_name)
+            if len(self.reset_sinks) == len(self.expected_resets):
+                self.all_reset.set()
+
+    async def driveClient(self, client):
+        """
+        Sends this client's share of the changes, toggling its sources in turn, at the
+        configured rate or as fast as the socket takes them.
+        """
+        states = (protocol.state_table[1], protocol.state_table[2])
+        burst = max(1, self.rate // 100) if self.rate else 100
+        for change in range(self.changes):
+            net = change % self.nets_per_client
+            self.send_times[client.index][net].append(time.perf_counter())
+            client.sendChange(client.sources[net], states[(change // self.nets_per_client) % 2])
+            if (change + 1) % burst == 0:
+                await client.writer.drain()
+                if self.rate:
+                    await asyncio.sleep(burst / self.rate)
+        await client.writer.drain()
+
+    async def run(self, port):
+        results = {'server': self.server_kind, 'clients': self.clients, 'terminals_per_client': self.nets_per_client * (self.fan_out + 1),
+                   'fan_out': self.fan_out, 'protocol': self.protocol_version, 'changes_per_client': self.changes, 'rate': self.rate}
+
+        clients = [BenchClient(self, index, self.protocol_version) for index in range(self.clients)]
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client.connect(port) for client in clients])
+        await asyncio.gather(*[client.register() for client in clients])
+        results['registration_seconds'] = time.perf_counter() - start
+
+        self.expected_deliveries = self.clients * self.changes * self.fan_out
+        start = time.perf_counter()
+        await asyncio.gather(*[self.driveClient(client) for client in clients])
+        sent = time.perf_counter()
+        if self.expected_deliveries:
+            await asyncio.wait_for(self.all_delivered.wait(), 60)
+        seconds = time.perf_counter() - start
+
+        results['send_seconds'] = sent - start
+        results['propagation_seconds'] = seconds
+        results['changes_per_second'] = self.clients * self.changes / seconds
+        results['deliveries_per_second'] = self.delivered / seconds
+
+        latencies = sorted(self.latencies)
+        results['latency_ms'] = {}
+        if latencies:
+            for percentile in (50, 90, 99, 99.9):
+                results['latency_ms']['p%s' % percentile] = latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))] * 1000.0
+            results['latency_ms']['max'] = latencies[-1] * 1000.0
+
+        # Closing the first half of the clients resets the sinks of their sources in the other half.
+        closing = clients[:self.clients // 2]
+        remaining = clients[self.clients // 2:]
+        closing_indices = set(client.index for client in closing)
+        self.expected_resets = set(sink for client in remaining for sink, (source_client, _) in client.sinks.items() if source_client in closing_indices)
+        start = time.perf_counter()
+        await asyncio.gather(*[client.close() for client in closing])
+        if self.expected_resets:
+            await asyncio.wait_for(self.all_reset.wait(), 60)
+        results['disconnect_seconds'] = time.perf_counter() - start
+
+        await asyncio.gather(*[client.close() for client in remaining])
+        return results
+
+
+def waitForServer(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit('The server exited with %d.' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    sys.exit('The server did not start listening on port %d.' % port)
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the SAS servers.')
+    parser.add_argument('--server', choices=('qt2', 'qt1', 'aio'), default='qt2', help='SASServer2, SASServer or SASAsyncServer')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--terminals', type=int, default=100, help='terminals per client')
+    parser.add_argument('--fan-out', type=int, default=3, help='sinks per source')
+    parser.add_argument('--changes', type=int, default=1000, help='state changes sent per client')
+    parser.add_argument('--rate', type=int, default=0, help='state changes per second per client, 0 for as fast as possible')
+    # The bench clients never resume sessions, which would keep the terminals of closed clients registered.
+    parser.add_argument('--protocol', type=int, default=protocol.batch_protocol_version, help='protocol version offered by the clients')
+    parser.add_argument('--output', help='write the results to this file instead of standard output')
+    parser.add_argument('--serve', nargs=2, metavar=('PORT', 'CONNECTIONS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.server, int(args.serve[0]), args.serve[1])
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        bench = LoadBench(args)
+        connections_path = os.path.join(directory, 'connections.txt')
+        writeConnections(connections_path, bench.clients, bench.nets_per_client, bench.fan_out)
+
+        port = freePort()
+        environment = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--server', args.server, '--serve', str(port), connections_path],
+                                   env=environment, stderr=subprocess.DEVNULL)
+        try:
+            waitForServer(port, process)
+            results = asyncio.run(bench.run(port))
+        finally:
+            process.terminate()
+            process.wait()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Compares the text protocol (version 1) with the binary state change records of
+protocol version 2: bytes on the wire per state change, and the time it takes
+to split a received buffer into state changes.
+
+    python benchmarks/protocol_bench.py [--changes N] [--repeat R]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sas import protocol
+
+
+def buildChanges(count):
+    terminal_names = ['CAB%02d-X%02d-%02d' % (i // 400, (i // 20) % 20, i % 20) for i in range(count)]
+    states = protocol.state_table
+    return [(terminal_name, i, states[i % len(states)]) for i, terminal_name in enumerate(terminal_names)]
+
+
+def encodeText(changes):
+    return b''.join(('statechange:' + terminal_name + ':' + state + '\n').encode() for terminal_name, _, state in changes)
+
+
+def encodeBinary(changes):
+    return b''.join(protocol.packStateChange(terminal_id, protocol.state_codes[state]) for _, terminal_id, state in changes)
+
+
+def parseUnbuffered(data):
+    # The parsing done by the servers before receive buffering was added.
+    changes = []
+    for line in data.decode().split('\n'):
+        entries = line.split(':')
+        if len(entries) > 1 and entries[0] == 'statechange':
+            changes.append((entries[1], entries[2]))
+    return changes
+
+
+def parseText(data):
+    changes = []
+    for frame in protocol.splitFrames(bytearray(data)):
+        command, _, arguments = frame.partition(':')
+        if command == 'statechange':
+            changes.append(arguments.split(':'))
+    return changes
+
+
+def parseBinary(data, terminal_names):
+    state_table = protocol.state_table
+    return [(terminal_names[terminal_id], state_table[state_code]) for _, terminal_id, state_code in protocol.splitFrames(bytearray(data))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Text versus binary state change benchmark.')
+    parser.add_argument('--changes', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    changes = buildChanges(args.changes)
+    terminal_names = [terminal_name for terminal_name, _, _ in changes]
+
+    text_data = encodeText(changes)
+    binary_data = encodeBinary(changes)
+
+    assert len(parseText(text_data)) == len(parseBinary(binary_data, terminal_names)) == args.changes
+
+    results = [('text, unbuffered', text_data, lambda: parseUnbuffered(text_data)),
+               ('text, framed', text_data, lambda: parseText(text_data)),
+               ('binary, framed', binary_data, lambda: parseBinary(binary_data, terminal_names))]
+
+    print('%-18s %14s %18s' % ('protocol', 'bytes/change', 'parse us/change'))
+    for name, data, parse in results:
+        seconds = min(timeit.repeat(parse, number=1, repeat=args.repeat))
+        print('%-18s %14.1f %18.3f' % (name, len(data) / args.changes, seconds / args.changes * 1e6))
+
+
+if __name__ == '__main__':
+    main()
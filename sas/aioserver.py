@@ -0,0 +1,102 @@
+"""
+A headless SAS server on asyncio streams, for routing boxes and containers
+without Qt. It speaks the same protocol as SASServer2, with the same
+registration, statechange and disconnect semantics:
+
+    python -m sas.aioserver connections.txt --port 23456
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+from .core import RoutingCore
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class SASAsyncServer(RoutingCore):
+    """
+    An asyncio adapter over RoutingCore, which does all the routing.
+    """
+
+    def __init__(self, server_port, connections_path, host='0.0.0.0', journal_path=None):
+        RoutingCore.__init__(self, connections_path, journal_path)
+
+        self.host = host
+        self.server_port = server_port
+        self.server = None
+
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handleConnection, self.host, self.server_port)
+        logger.info('Server now listening on port %d' % self.server_port)
+
+    async def serveForever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def quit(self):
+        if self.server is not None:
+            self.server.close()
+
+
+    def onSessionDetached(self, session_token, expiry_time):
+        asyncio.get_running_loop().call_later(self.session_grace_period, self.expireSession, session_token, expiry_time)
+
+
+    async def handleConnection(self, reader, writer):
+        socket_id = self.addSocket(writer.write)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.receiveData(socket_id, data)
+        except ConnectionError:
+            pass
+        finally:
+            self.removeSocket(socket_id)
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless SAS server.')
+    parser.add_argument('connections_path', help='the connections file')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=23456)
+    parser.add_argument('--journal', help='journal net states to this file, and restore them on start')
+    parser.add_argument('--sync-interval', type=float, default=1.0, help='seconds between journal syncs, 0 syncs every write')
+    parser.add_argument('--capture', help='capture all received traffic to this file, for sas.replay')
+    parser.add_argument('--session-grace', type=float, default=RoutingCore.session_grace_period, help='seconds a lost client can resume its session, 0 to unregister it at once')
+    parser.add_argument('--trace', type=int, metavar='EVENTS', help='keep the last EVENTS routing events in memory, logged on SIGUSR1')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    server = SASAsyncServer(args.port, args.connections_path, host=args.host, journal_path=args.journal)
+    server.session_grace_period = args.session_grace
+    if server.journal is not None:
+        server.journal.sync_interval = args.sync_interval
+    if args.capture:
+        server.startCapture(args.capture)
+    if args.trace:
+        tracer.enable(args.trace)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signal_number, frame: tracer.dump())
+    try:
+        asyncio.run(server.serveForever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopCapture()
+        server.closeJournal()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Capture of the traffic a server receives, for replaying it later with sas.replay.
+
+A capture file starts with a magic string and holds one record per event, in
+the order the server saw them: a client connecting, data received from it, and
+the client disconnecting. Every record holds the time since the capture
+started, the kind of event and the session, a number given to each client
+connection in the order they connected. Data records are followed by the bytes
+exactly as they were received, so replaying them reproduces partial frames too.
+
+Binary state records (protocol version 2) sent by clients hold the terminal IDs
+of the capturing server, which another server may assign differently. So the
+capture also holds a terminal record for every terminal the server has a handle
+for, giving its name as data, with the terminal ID in place of the session.
+"""
+
+import struct
+import time
+
+capture_magic = b'SASCAP02'
+
+# Seconds since the start of the capture, event, session, length of the data that follows.
+capture_record = struct.Struct('<dBII')
+
+open_event = 0
+data_event = 1
+close_event = 2
+terminal_event = 3
+
+
+class TrafficCapture(object):
+
+    def __init__(self, capture_path):
+        self.capture_path = capture_path
+        self.file = open(capture_path, 'wb')
+        self.file.write(capture_magic)
+
+        self.start_time = time.monotonic()
+        self.sessions = {}
+        self.session_count = 0
+        self.statistics = {'records': 0, 'bytes': 0}
+
+    def session(self, socket_id):
+        # Sockets connected before the capture started are given a session when first seen.
+        session = self.sessions.get(socket_id)
+        if session is None:
+            session = self.sessions[socket_id] = self.session_count
+            self.session_count += 1
+        return session
+
+    def writeRecord(self, event, session, data=b''):
+        self.file.write(capture_record.pack(time.monotonic() - self.start_time, event, session, len(data)))
+        if data:
+            self.file.write(data)
+        self.statistics['records'] += 1
+        self.statistics['bytes'] += len(data)
+
+    def recordOpen(self, socket_id):
+        self.writeRecord(open_event, self.session(socket_id))
+
+    def recordData(self, socket_id, data):
+        self.writeRecord(data_event, self.session(socket_id), data)
+
+    def recordClose(self, socket_id):
+        self.writeRecord(close_event, self.session(socket_id))
+        del self.sessions[socket_id]
+
+    def recordTerminal(self, terminal_name, terminal_id):
+        self.writeRecord(terminal_event, terminal_id, terminal_name.encode())
+
+    def close(self):
+        self.file.close()
+
+
+def readCapture(capture_path):
+    """
+    Yields the records of a capture file as (time, event, session, data) tuples. A record
+    cut short by the capturing server stopping ends the capture.
+    """
+    with open(capture_path, 'rb') as f:
+        if f.read(len(capture_magic)) != capture_magic:
+            raise ValueError('%s is not a capture file.' % capture_path)
+
+        while True:
+            header = f.read(capture_record.size)
+            if len(header) < capture_record.size:
+                return
+            timestamp, event, session, length = capture_record.unpack(header)
+            data = f.read(length) if length else b''
+            if len(data) < length:
+                return
+            yield timestamp, event, session, data
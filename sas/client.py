@@ -1,210 +1,218 @@
 
 import logging
-
-from functools import partial
+import random
+import time
 
 from PySide2 import QtCore, QtNetwork
 
+from . import protocol
+from . import tracing
+from .core import ClientCore
+from .tracing import tracer
+
 logger = logging.getLogger(__name__)
 
+# The states of a client's connection, as emitted by connection_state_changed.
+disconnected_state = 'disconnected'
+connecting_state = 'connecting'
+connected_state = 'connected'
+waiting_state = 'waiting'
+
+
+class SASConnector(QtCore.QObject):
+    """
+    Connects a client socket to the server without blocking, and connects it again whenever
+    connecting fails or the connection is lost, until disconnectFromServer is called. Attempts
+    are spaced by an exponentially growing delay with random jitter, so clients started together,
+    or cut off by the same server restart, do not all come back at once.
+    """
+
+    state_changed = QtCore.Signal(str)
+
+    def __init__(self, socket, parent=None, initial_delay=0.1, maximum_delay=30.0, connect_timeout=10.0, stable_time=10.0):
+        super(SASConnector, self).__init__(parent)
+        self.socket = socket
+        self.initial_delay = initial_delay
+        self.maximum_delay = maximum_delay
+
+        # The delay only starts over once a connection has lasted stable_time seconds, so a server
+        # which accepts connections and drops them at once is not hammered either.
+        self.stable_time = stable_time
+        self.connected_time = None
+
+        self.server_address = None
+        self.server_port = None
+        self.state = disconnected_state
+        self.reconnecting = False
+        self.attempts = 0
+
+        self.reconnect_timer = QtCore.QTimer(self)
+        self.reconnect_timer.setSingleShot(True)
+        self.reconnect_timer.timeout.connect(self.onReconnectTimeout)
+
+        # Connecting to an unreachable host only fails after the operating system's timeout, which can be minutes.
+        self.connect_timer = QtCore.QTimer(self)
+        self.connect_timer.setSingleShot(True)
+        self.connect_timer.setInterval(int(connect_timeout * 1000))
+        self.connect_timer.timeout.connect(self.onConnectTimeout)
 
-class SASClient2(QtCore.QObject):
+        self.socket.connected.connect(self.onConnected)
+        self.socket.disconnected.connect(self.onDisconnected)
+        self.socket.error.connect(self.onError)
 
-    ac_230_on_state = '230VAC'
-    ac_230_off_state = '0VAC'
-    dc_48_on_state = '48VDC'
-    dc_48_off_state = '0VDC'
-    dc_12_on_state = '12VDC'
-    dc_12_off_state = '0VDC'
-    dc_5_on_state = '5VDC'
-    dc_5_off_state = '0VDC'
+    def setState(self, state):
+        if state != self.state:
+            self.state = state
+            self.state_changed.emit(state)
+
+    def connectToServer(self, server_address, server_port):
+        self.server_address = server_address
+        self.server_port = server_port
+        self.reconnecting = True
+        self.attempts = 0
+        self.reconnect_timer.stop()
+        if self.socket.state() == QtNetwork.QAbstractSocket.UnconnectedState:
+            self.attemptConnection()
+
+    def disconnectFromServer(self):
+        self.reconnecting = False
+        self.reconnect_timer.stop()
+        self.connect_timer.stop()
+        self.socket.abort()
+        self.setState(disconnected_state)
+
+    def attemptConnection(self):
+        logger.debug('Connecting to host at %s, port %d' % (self.server_address, self.server_port))
+        self.setState(connecting_state)
+        self.connect_timer.start()
+        self.socket.connectToHost(self.server_address, self.server_port)
 
-    # signal_on_state = '12VDC'
-    # signal_off_state = '0VDC'
-    
-    no_state = 'None'
+    def nextDelay(self):
+        """
+        Returns the seconds to wait before the next attempt: the initial delay doubled for every failed
+        attempt, up to the maximum, of which a random half to all is used.
+        """
+        delay = self.initial_delay * 2 ** self.attempts
+        if delay < self.maximum_delay:
+            self.attempts += 1
+        else:
+            delay = self.maximum_delay
+        return delay * random.uniform(0.5, 1.0)
+
+    def scheduleReconnect(self):
+        self.connect_timer.stop()
+        if not self.reconnecting:
+            self.setState(disconnected_state)
+            return
+        if not self.reconnect_timer.isActive():
+            delay = self.nextDelay()
+            logger.debug('Connecting again to host at %s, port %d in %.2f s' % (self.server_address, self.server_port, delay))
+            self.setState(waiting_state)
+            self.reconnect_timer.start(int(delay * 1000))
+
+    def onReconnectTimeout(self):
+        if self.socket.state() == QtNetwork.QAbstractSocket.UnconnectedState:
+            self.attemptConnection()
+
+    def onConnectTimeout(self):
+        logger.debug('Connecting to host at %s, port %d timed out' % (self.server_address, self.server_port))
+        self.socket.abort()
+        self.scheduleReconnect()
 
-    def __init__(self):
-        super(SASClient2, self).__init__()
+    def onConnected(self):
+        self.connect_timer.stop()
+        self.connected_time = time.monotonic()
+        self.setState(connected_state)
+
+    def onDisconnected(self):
+        if self.connected_time is not None and time.monotonic() - self.connected_time >= self.stable_time:
+            self.attempts = 0
+        self.connected_time = None
+        self.scheduleReconnect()
+
+    def onError(self, error):
+        # A lost connection is also reported by disconnected, failed connection attempts only here.
+        if self.socket.state() == QtNetwork.QAbstractSocket.UnconnectedState:
+            self.scheduleReconnect()
 
-        self.client_name = 'default'
 
-        # self.input_terminals = {}
-        # self.output_terminals = {}
+class SASClient2(QtCore.QObject, ClientCore):
+    """
+    A Qt adapter over ClientCore, which holds the terminals and speaks the protocol.
+    This class only owns the socket.
+    """
 
-        self.terminals = {}
-        self.sources = []
+    monitored_terminal_changed_state = QtCore.Signal(str, str, str)
+    snapshot_received = QtCore.Signal(dict)
+    statistics_received = QtCore.Signal(dict)
+    connection_state_changed = QtCore.Signal(str)
+
+    def __init__(self):
+        super(SASClient2, self).__init__()
+        self.socket = QtNetwork.QTcpSocket()
+        ClientCore.__init__(self, self.socket.write)
 
         self.server_address = '127.0.0.1'
         self.server_port = 23456
 
-        self.socket = QtNetwork.QTcpSocket()
         self.socket.connected.connect(self.onConnected)
         self.socket.disconnected.connect(self.onDisconnected)
         self.socket.error.connect(self.onError)
         self.socket.stateChanged.connect(self.onStateChanged)
         self.socket.readyRead.connect(self.onReadyRead)
 
-    def setClientName(self, name):
-        self.client_name = name
+        self.connector = SASConnector(self.socket, parent=self)
+        self.connector.state_changed.connect(self.connection_state_changed)
 
     def onReadyRead(self):
-        received_message = self.socket.readAll().data().decode()
-        
-        # logger.debug('Received message from connection %s: "%s"' % (socket_id, received_message.rstrip()))
-        
-        lines = received_message.split('\n')
-
-        for line in lines:
-            entries = line.split(':')
-            if len(entries) > 1:
-                if entries[0] == 'statechange':
-                    terminal_name = entries[1]
-                    new_state = entries[2]
-
-                    self.receivedTerminalState(terminal_name, new_state)
-                    
-                else:
-                    raise Exception
+        self.receiveData(self.socket.readAll().data())
 
 
     def startClient(self):
+        """
+        Starts connecting to server_address and server_port, and returns at once. The client
+        keeps connecting again whenever the connection fails or is lost, until stopClient.
+        """
+        self.connector.connectToServer(self.server_address, self.server_port)
 
-        # Hmmmm.... Do the connecting in a thread instead...... 
 
-        logger.debug('Connecting to host at %s, port %d' % (self.server_address, self.server_port))
-        self.socket.connectToHost('127.0.0.1', 23456)
-        self.socket.waitForConnected()
+    def stopClient(self):
+        # The connection is aborted, so the end of the session is written out first.
+        self.endSession()
+        self.socket.flush()
+        self.connector.disconnectFromServer()
 
 
     def onConnected(self):
         logger.debug('Connected to host at %s, port %d' % (self.server_address, self.server_port))
 
-        self.pushClientName()
-        self.pushTerminals()
-        self.initializeSources()
-
-        # self.remoteRegisterInputTerminals()
-        # self.remoteRegisterOutputTerminals()
-
-        # self.propagateSources()
-
-    def initializeSources(self):
-        for source in self.sources:
-            source.initializeSource()
-
+        self.connectedToServer()
 
        
     def onDisconnected(self):
         logger.debug('Disconnected from host at %s, port %d' % (self.server_address, self.server_port))
-        # self.startClient()
+        self.disconnectedFromServer()
 
         # self.deRegisterOutputTerminals()
         # self.deRegisterInputTerminals()
 
 
-    def onError(self, error):
-        logger.debug('Socket error occured: %s' % error)
-        if error == QtNetwork.QAbstractSocket.ConnectionRefusedError:
-            self.startClient()
-
-
-    def onStateChanged(self, state):
-        logger.debug('Socket state changed to %s' % state)
-
-    def defaultTerminalAction(self, terminal_name, new_state):
-        """
-            Just push the new state of terminal to the server.
-        """
-        self.pushTerminalState(terminal_name, new_state)
-
-
-    def registerTerminal(self, terminal_name, state=no_state):
-        self.terminals[terminal_name] = {'name': terminal_name, 'state': state, 'action': partial(self.defaultTerminalAction, terminal_name)}
-
-    def getTerminalState(self, terminal_name):
-        return self.terminals[terminal_name]['state']
-
-    def receivedTerminalState(self, terminal_name, new_state):
-        """
-            Acts on a new state change reveived from the server side.
-        """
-        logger.debug('Received statechange on %s (new state: %s) from server' % (terminal_name, new_state))
-        
-        self.terminals[terminal_name]['action'](new_state)
-
-        # # Register the new state locally, but only if it differs from the old state.
-        # if self.getTerminalState(terminal_name) != new_state:# or self.getTerminalState(terminal_name) == self.no_state:
-        #     #self.terminals[terminal_name]['state'] = new_state
-        
-        #     # Perform action due to new state.
-        #     logger.debug('Registered statechange on %s (new state: %s)' % (terminal_name, new_state))
-        #     self.terminals[terminal_name]['action'](new_state)
-            
-
-
-    def pushTerminalState(self, terminal_name, state):
-        """
-            Stores the state locally at the client side, and sends the new state to the server.
-        """
-        self.terminals[terminal_name]['state'] = state
-        message = 'statechange:' + ':'.join((terminal_name, state)) + '\n'
-        self.socket.write(message.encode())
-        logger.debug('Pushed statechange on %s (new state: %s) to server' % (terminal_name, state))
-
-    # def registerInputTerminal(self, name, action=None):
-    #     self.input_terminals[name] = {'name': name, 'state': self.no_state, 'action': action}
-
-
-    # def registerOutputTerminal(self, name, state=no_state):
-    #     self.output_terminals[name] = {'name': name, 'state': state}
-
-
-    # def getOutputTerminalState(self, name):
-    #     return self.output_terminals[name]['state']
-
-
-    # def setOutputTerminalState(self, name, new_state):
-    #     if self.getOutputTerminalState(name) != new_state:
-    #         self.output_terminals[name]['state'] = new_state
-    #         self.remoteSendOutputTerminalState(name, new_state)
-
-
-    # def getInputTerminalState(self, name):
-    #     return self.input_terminals[name]['state']
-
-
-    # def setInputTerminalState(self, name, new_state):
-    #     if self.getInputTerminalState(name) != new_state:
-    #         self.input_terminals[name]['state'] = new_state
-    #         if self.input_terminals[name]['action']:
-    #             self.input_terminals[name]['action'](new_state)
-
-
-    def pushClientName(self):
-        message = 'clientname:' + self.client_name + '\n'
-        self.socket.write(message.encode())
-        logger.debug('Sent client name registration to server (%s).' % (self.client_name, ))
+    def receivedMonitorState(self, client_name, terminal_name, new_state):
+        self.monitored_terminal_changed_state.emit(client_name, terminal_name, new_state)
 
+    def receivedSnapshot(self, states):
+        self.snapshot_received.emit(states)
 
-    def pushTerminals(self):
-        if len(self.terminals) > 0:
-            message = 'registration:' + ':'.join(self.terminals) + '\n'
-            self.socket.write(message.encode())
-            logger.debug('Registered terminals on server (%s).' % (', '.join(self.terminals)))
+    def receivedStatistics(self, statistics):
+        self.statistics_received.emit(statistics)
 
 
-    # def remoteRegisterOutputTerminals(self):
-    #     if len(self.output_terminals) > 0:
-    #         message = 'registration:' + 'outputs:' + ':'.join(self.output_terminals) + '\n'
-    #         self.socket.write(message.encode())
-    #         logger.debug('Registered output terminals on server (%s).' % (', '.join(self.output_terminals)))
+    def onError(self, error):
+        logger.debug('Socket error occured: %s' % error)
 
 
-    # def pushTerminalState(self, terminal_name, new_state):
-    #     message = 'statechange:' + ':'.join((terminal_name, new_state)) + '\n'
-    #     self.socket.write(message.encode())
-    #     logger.debug('Sent statechange on %s (new state: %s) to server' % (terminal_name, new_state))
+    def onStateChanged(self, state):
+        logger.debug('Socket state changed to %s' % state)
 
 
     def deRegisterOutputTerminals(self):
@@ -228,6 +236,9 @@ class SASClient(QtCore.QObject):
     signal_off_state = '0VDC'
     no_state = 'None'
 
+    snapshot_received = QtCore.Signal(dict)
+    connection_state_changed = QtCore.Signal(str)
+
     def __init__(self):
         super(SASClient, self).__init__()
 
@@ -236,6 +247,12 @@ class SASClient(QtCore.QObject):
         self.input_terminals = {}
         self.output_terminals = {}
 
+        # Output terminals set while not connected, sent once connected.
+        self.unsent_output_terminals = {}
+
+        # Data received up to the end of the last complete line, the rest stays here until it arrives.
+        self.receive_buffer = bytearray()
+
         self.server_address = '127.0.0.1'
         self.server_port = 23456
 
@@ -246,17 +263,21 @@ class SASClient(QtCore.QObject):
         self.socket.stateChanged.connect(self.onStateChanged)
         self.socket.readyRead.connect(self.onReadyRead)
 
+        self.connector = SASConnector(self.socket, parent=self)
+        self.connector.state_changed.connect(self.connection_state_changed)
+
     def setClientName(self, name):
         self.client_name = name
 
     def onReadyRead(self):
-        received_message = self.socket.readAll().data().decode()
-        
-        # logger.debug('Received message from connection %s: "%s"' % (socket_id, received_message.rstrip()))
-        
-        lines = received_message.split('\n')
-
-        for line in lines:
+        self.receive_buffer.extend(self.socket.readAll().data())
+
+        # A 'states:' or 'snapshot:' line can be split over any number of reads, so only
+        # complete lines are handled.
+        for line in protocol.splitFrames(self.receive_buffer):
+            if line.__class__ is not str:
+                logger.warning('Unexpected binary state record from server: %s' % (line, ))
+                continue
             entries = line.split(':')
             if len(entries) > 1:
                 if entries[0] == 'statechange':
@@ -264,31 +285,46 @@ class SASClient(QtCore.QObject):
                     new_state = entries[2]
 
                     self.setInputTerminalState(input_terminal, new_state)
-                    
+
+                elif entries[0] == 'states':
+                    for input_terminal, new_state in protocol.unpackStates(entries[1:]):
+                        self.setInputTerminalState(input_terminal, new_state)
+
+                elif entries[0] == 'snapshot':
+                    self.snapshot_received.emit(dict(protocol.unpackStates(entries[1:])))
+
                 else:
-                    raise Exception
+                    logger.warning('Unknown message from server: %s' % (line, ))
 
 
     def startClient(self):
+        """
+        Starts connecting to server_address and server_port, and returns at once. The client
+        keeps connecting again whenever the connection fails or is lost, until stopClient.
+        """
+        self.connector.connectToServer(self.server_address, self.server_port)
 
-        # Hmmmm.... Do the connecting in a thread instead...... 
 
-        logger.debug('Connecting to host at %s, port %d' % (self.server_address, self.server_port))
-        self.socket.connectToHost('127.0.0.1', 23456)
-        self.socket.waitForConnected()
+    def stopClient(self):
+        self.connector.disconnectFromServer()
 
 
     def onConnected(self):
         logger.debug('Connected to host at %s, port %d' % (self.server_address, self.server_port))
 
+        self.receive_buffer = bytearray()
         self.remoteRegisterClientName()
         self.remoteRegisterInputTerminals()
         self.remoteRegisterOutputTerminals()
 
+        unsent_output_terminals = self.unsent_output_terminals
+        self.unsent_output_terminals = {}
+        for terminal_name in unsent_output_terminals:
+            self.remoteSendOutputTerminalState(terminal_name, self.getOutputTerminalState(terminal_name))
+
        
     def onDisconnected(self):
         logger.debug('Disconnected from host at %s, port %d' % (self.server_address, self.server_port))
-        # self.startClient()
 
         self.deRegisterOutputTerminals()
         self.deRegisterInputTerminals()
@@ -296,8 +332,6 @@ class SASClient(QtCore.QObject):
 
     def onError(self, error):
         logger.debug('Socket error occured: %s' % error)
-        if error == QtNetwork.QAbstractSocket.ConnectionRefusedError:
-            self.startClient()
 
 
     def onStateChanged(self, state):
@@ -327,6 +361,8 @@ class SASClient(QtCore.QObject):
 
 
     def setInputTerminalState(self, name, new_state):
+        if tracer.enabled:
+            tracer.record(tracing.received_state, name, new_state, self.client_name)
         if self.getInputTerminalState(name) != new_state:
             self.input_terminals[name]['state'] = new_state
             if self.input_terminals[name]['action']:
@@ -334,7 +370,8 @@ class SASClient(QtCore.QObject):
 
 
     def remoteRegisterClientName(self):
-        message = 'clientname:' + self.client_name + '\n'
+        # Offers the bulk initial states of protocol version 3, the only part of it SASServer speaks.
+        message = 'clientname:' + self.client_name + ':%d' % protocol.bulk_protocol_version + '\n'
         self.socket.write(message.encode())
         logger.debug('Sent client name registration to server (%s).' % (self.client_name, ))
 
@@ -353,10 +390,22 @@ class SASClient(QtCore.QObject):
             logger.debug('Registered output terminals on server (%s).' % (', '.join(self.output_terminals)))
 
 
+    def requestSnapshot(self, all_terminals=False):
+        """
+            Asks the server for the states of this client's terminals, or of all terminals.
+            The answer is emitted with snapshot_received.
+        """
+        self.socket.write(('snapshot:' + ('all' if all_terminals else 'own') + '\n').encode())
+
+
     def remoteSendOutputTerminalState(self, terminal_name, new_state):
+        if self.socket.state() != QtNetwork.QAbstractSocket.ConnectedState:
+            self.unsent_output_terminals[terminal_name] = None
+            return
         message = 'statechange:' + ':'.join((terminal_name, new_state)) + '\n'
         self.socket.write(message.encode())
-        logger.debug('Sent statechange on %s (new state: %s) to server' % (terminal_name, new_state))
+        if tracer.enabled:
+            tracer.record(tracing.pushed_state, terminal_name, new_state, self.client_name)
 
 
     def deRegisterOutputTerminals(self):
@@ -0,0 +1,1302 @@
+"""
+The routing and client logic of the SAS protocol, free of Qt.
+
+RoutingCore holds everything SASServer2 does with connections, registrations
+and state changes, and ClientCore everything SASClient2 does with terminals.
+Neither knows about sockets or event loops: data received is handed to them,
+and they hand data to send back to a write callable the adapter provides. The Qt
+classes in sas.server and sas.client, and the asyncio server in sas.aioserver,
+are thin adapters over them. Unit tests, load generators and offline tools can
+import this module without Qt.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import secrets
+import time
+
+from array import array
+from functools import partial
+
+from . import protocol
+from . import tracing
+from .capture import TrafficCapture
+from .journal import StateJournal
+from .metrics import ServerMetrics
+from .subscriptions import SubscriptionIndex
+from .tracing import tracer
+from .wiring import loadConnections
+
+logger = logging.getLogger(__name__)
+
+
+class ClientSocket(object):
+    """
+    A client connection of RoutingCore. Slotted, since a server holds thousands of them.
+    """
+
+    __slots__ = ('write', 'name', 'terminals', 'protocol', 'receive_buffer', 'outbox', 'session', 'sent_count', 'received_count')
+
+    def __init__(self, write):
+        # None while the socket is closed and its session waits to be resumed.
+        self.write = write
+        self.name = ''
+        # Handles of the terminals the socket owns, so they can be unregistered without scanning all terminals.
+        self.terminals = set()
+        self.protocol = protocol.text_protocol_version
+        self.receive_buffer = bytearray()
+        self.outbox = []
+        # The session token, and the state changes sent and received in the session (protocol version 5).
+        self.session = None
+        self.sent_count = 0
+        self.received_count = 0
+
+
+class HandleAllocator(object):
+    """
+    Hands out small integer handles. Released handles are reused, the longest released first,
+    so the handles stay dense however many connections come and go.
+    """
+
+    def __init__(self):
+        self.free_handles = collections.deque()
+        self.next_handle = 0
+
+    def allocate(self):
+        if self.free_handles:
+            return self.free_handles.popleft()
+        handle = self.next_handle
+        self.next_handle += 1
+        return handle
+
+    def release(self, handle):
+        self.free_handles.append(handle)
+
+
+class RoutingCore(object):
+
+    no_state = 'None'
+
+    # Seconds the terminals of a lost session stay registered, waiting for the client to resume it.
+    session_grace_period = 10.0
+
+    def __init__(self, connections_path=None, journal_path=None):
+        self.connections_path = connections_path
+        self.connections = {}
+
+        # The connections grouped into electrical nets. Every terminal in a net shares
+        # the net's state, so a change is pushed to all members in one pass.
+        self.terminal_nets = {}
+        self.net_members = {}
+        self.net_states = {}
+
+        # Terminals are interned to integer handles, which are also the IDs of protocol version 2. A handle
+        # is never reused for another name, so a reconnecting client gets the same IDs back. Everything the
+        # hot path needs about a terminal is in columns indexed by its handle.
+        self.terminal_ids = {}
+        self.terminal_names = []
+        self.terminal_states = []
+        # The socket handle of the client which registered the terminal, -1 while it is not registered.
+        self.terminal_sockets = array('i')
+        # The handles of all terminals in the terminal's net, None when it is not connected to anything.
+        self.terminal_net_members = []
+        # The sent_count of the owning session when the terminal's state was last sent to it.
+        self.terminal_sequences = array('Q')
+        self.registered_terminal_count = 0
+
+        # Everything received is written to a capture file while capturing, see startCapture.
+        self.capture = None
+
+        if connections_path is not None:
+            self.buildTerminalConnections(connections_path)
+
+        # Socket handle -> ClientSocket.
+        self.client_sockets = {}
+        self.socket_handles = HandleAllocator()
+
+        # Session token -> socket handle, and the tokens of the sessions waiting to be resumed -> the
+        # monotonic time they expire.
+        self.sessions = {}
+        self.detached_sessions = {}
+
+        # Sockets of remote monitors, by the terminal name patterns they subscribed to.
+        self.subscriptions = SubscriptionIndex()
+
+        self.message_handlers = {'clientname': self.handleClientName,
+                                 'registration': self.handleRegistration,
+                                 'statechange': self.handleStateChange,
+                                 'statechanges': self.handleStateChanges,
+                                 'snapshot': self.handleSnapshot,
+                                 'stats': self.handleStats,
+                                 'subscribe': self.handleSubscribe,
+                                 'unsubscribe': self.handleUnsubscribe,
+                                 'resume': self.handleResume,
+                                 'endsession': self.handleEndSession}
+
+        # Outgoing messages are queued per socket and written once the current batch of incoming messages is handled.
+        self.pending_socket_ids = set()
+        self.flush_statistics = {'flushes': 0, 'messages': 0, 'max_merged': 0}
+
+        # Latency histograms and counters, see sas.metrics.
+        self.metrics = ServerMetrics()
+
+        # Net states are journaled to journal_path, if given, and the last known ones are restored
+        # from it here, so terminals registering after a crash get them at once.
+        self.journal = None
+        if journal_path is not None:
+            self.journal = StateJournal(journal_path)
+            self.recoverJournal()
+
+
+    # Hooks for the adapters. They are called like the corresponding signals of SASServer2.
+
+    def onClientNameRegistered(self, client_name):
+        pass
+
+    def onClientNameUnregistered(self, client_name):
+        pass
+
+    def onTerminalRegistered(self, client_name, terminal_name, state, connected_terminal_names):
+        pass
+
+    def onTerminalChangedState(self, client_name, terminal_name, new_state):
+        pass
+
+    def onConnectionsReloaded(self, added_connections, removed_connections):
+        pass
+
+    def onFlushRequested(self):
+        """
+        Called when a message is queued and no flush is pending. Adapters which can queue messages
+        outside of receiveData and removeSocket schedule a flushSockets from here.
+        """
+        pass
+
+    def onSessionDetached(self, session_token, expiry_time):
+        """
+        Called when the connection of a session is lost. Adapters call expireSession(session_token,
+        expiry_time) once time.monotonic() reaches expiry_time, or the session is never ended.
+        """
+        pass
+
+
+    def buildConnectionMap(self, compiled_connections):
+        """
+        Returns the bidirectional adjacency of the compiled connections, terminal -> connected terminals.
+        """
+        connections = {}
+
+        for input_terminal, output_terminals in compiled_connections.entries():
+            if input_terminal in connections:
+                connections[input_terminal].extend(output_terminals)
+            else:
+                connections[input_terminal] = list(output_terminals)
+
+            for output_terminal in output_terminals:
+                if output_terminal in connections:
+                    connections[output_terminal].append(input_terminal)
+                else:
+                    connections[output_terminal] = [input_terminal]
+
+        return connections
+
+    def buildTerminalConnections(self, connections_path):
+        # Parsed and validated entries, from the compiled file next to connections_path when it is up to date.
+        timings = {}
+        compiled_connections = loadConnections(connections_path, timings=timings)
+        if compiled_connections is None:
+            logger.critical('%s does not exist. No connections registered.' % connections_path)
+            return
+
+        self.connections = self.buildConnectionMap(compiled_connections)
+
+        # The nets are precomputed by the compilation.
+        self.terminal_nets = compiled_connections.terminalNets()
+        self.net_members = compiled_connections.netMembers()
+        self.net_states = {net: self.no_state for net in self.net_members}
+        self.buildNetHandles()
+
+        logger.info('Successfully registered %d connections from %d entries, in %d nets (%s).' % (compiled_connections.connectionCount(), compiled_connections.entryCount(), len(self.net_members),
+                                                                                               ', '.join('%s %.1f ms' % (step, seconds * 1000.0) for step, seconds in timings.items())))
+
+    def internTerminal(self, terminal_name):
+        """
+        Returns the handle of terminal_name, adding a row for it if it has none.
+        """
+        terminal_id = self.terminal_ids.get(terminal_name)
+        if terminal_id is None:
+            terminal_id = self.terminal_ids[terminal_name] = len(self.terminal_names)
+            self.terminal_names.append(terminal_name)
+            self.terminal_states.append(self.no_state)
+            self.terminal_sockets.append(-1)
+            self.terminal_net_members.append(None)
+            self.terminal_sequences.append(0)
+            if self.capture is not None:
+                self.capture.recordTerminal(terminal_name, terminal_id)
+        return terminal_id
+
+    def buildNetHandles(self):
+        # The members of every net as handles, shared by all of them.
+        self.terminal_net_members = [None] * len(self.terminal_names)
+        for member_terminals in self.net_members.values():
+            member_ids = tuple(self.internTerminal(terminal_name) for terminal_name in member_terminals)
+            for terminal_id in member_ids:
+                self.terminal_net_members[terminal_id] = member_ids
+
+    def reloadTerminalConnections(self):
+        """
+        Applies the current connections file to the running server. Only terminals in nets that
+        gained or lost connections are sent new states, so the network traffic of an edit scales
+        with the size of the edit rather than with the plant.
+        """
+        # The file may be gone for a moment while an editor saves it, the next change is picked up again.
+        compiled_connections = loadConnections(self.connections_path) if self.connections_path is not None else None
+        if compiled_connections is None:
+            logger.warning('%s does not exist. Keeping the current connections.' % self.connections_path)
+            return
+
+        new_connections = self.buildConnectionMap(compiled_connections)
+
+        old_edges = set((terminal_name, connected_terminal_name) for terminal_name, connected_terminal_names in self.connections.items() for connected_terminal_name in connected_terminal_names)
+        new_edges = set((terminal_name, connected_terminal_name) for terminal_name, connected_terminal_names in new_connections.items() for connected_terminal_name in connected_terminal_names)
+        added_edges = new_edges - old_edges
+        removed_edges = old_edges - new_edges
+
+        if not added_edges and not removed_edges:
+            logger.info('Reloaded %s, no connections changed.' % self.connections_path)
+            return
+
+        # Both directions of every connection are in the edge sets.
+        added_terminals = set(terminal_name for edge in added_edges for terminal_name in edge)
+        removed_terminals = set(terminal_name for edge in removed_edges for terminal_name in edge)
+
+        old_terminal_nets = self.terminal_nets
+        old_net_states = self.net_states
+
+        self.connections = new_connections
+        self.terminal_nets = compiled_connections.terminalNets()
+        self.net_members = compiled_connections.netMembers()
+        self.buildNetHandles()
+
+        for socket_id in self.client_sockets:
+            self.pushLocalNets(socket_id)
+
+        changed_nets = set(self.terminal_nets[terminal_name] for terminal_name in added_terminals | removed_terminals if terminal_name in self.terminal_nets)
+        split_nets = set(self.terminal_nets[terminal_name] for terminal_name in removed_terminals if terminal_name in self.terminal_nets)
+
+        # Nets which did not change keep their state, whatever their new name.
+        self.net_states = {}
+        for net, member_terminals in self.net_members.items():
+            if net not in changed_nets:
+                self.net_states[net] = old_net_states[old_terminal_nets[member_terminals[0]]]
+
+        for net in changed_nets:
+            member_terminals = self.net_members[net]
+            old_states = set(old_net_states[old_terminal_nets[terminal_name]] for terminal_name in member_terminals if terminal_name in old_terminal_nets)
+            old_states.discard(self.no_state)
+
+            # Nets which only merged keep the state of the merged nets, if they agree. A net which lost a
+            # connection may have lost its source, so it is reset and the sources left in it push their states again.
+            if net not in split_nets and len(old_states) == 1:
+                new_state = old_states.pop()
+            else:
+                new_state = self.no_state
+
+            self.net_states[net] = new_state
+            if self.journal is not None:
+                self.journal.record(net, new_state)
+            for terminal_name in member_terminals:
+                self.remoteSendTerminalState(terminal_name, new_state)
+
+        # Terminals which are no longer connected to anything.
+        for terminal_name in removed_terminals:
+            if terminal_name not in self.terminal_nets:
+                self.remoteSendTerminalState(terminal_name, self.no_state)
+
+        self.flushSockets()
+
+        logger.info('Reloaded %s: %d connections added, %d removed, %d nets changed.' % (self.connections_path, len(added_edges) // 2, len(removed_edges) // 2, len(changed_nets)))
+        self.onConnectionsReloaded(len(added_edges) // 2, len(removed_edges) // 2)
+
+
+    def recoverJournal(self):
+        recovered_nets = set()
+        for terminal_name, state in self.journal.recover():
+            net = self.terminal_nets.get(terminal_name)
+            if net is not None:
+                self.net_states[net] = state
+                recovered_nets.add(net)
+
+        logger.info('Recovered the states of %d nets from %s.' % (sum(1 for net in recovered_nets if self.net_states[net] != self.no_state), self.journal.journal_path))
+        self.journal.open(self.journalStates)
+
+    def journalStates(self):
+        """
+        Returns the states of all nets which have one, as records for a journal snapshot.
+        """
+        return [(net, state) for net, state in self.net_states.items() if state != self.no_state]
+
+    def closeJournal(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+    def startCapture(self, capture_path):
+        """
+        Starts capturing all data received, with timestamps and sessions, for sas.replay.
+        """
+        self.stopCapture()
+        self.capture = TrafficCapture(capture_path)
+        for terminal_id, terminal_name in enumerate(self.terminal_names):
+            self.capture.recordTerminal(terminal_name, terminal_id)
+        logger.info('Capturing traffic to %s.' % capture_path)
+
+    def stopCapture(self):
+        if self.capture is not None:
+            self.capture.close()
+            logger.info('Captured %d records, %d bytes to %s.' % (self.capture.statistics['records'], self.capture.statistics['bytes'], self.capture.capture_path))
+            self.capture = None
+
+
+    def addSocket(self, write):
+        """
+        Adds a client connection, and returns its socket id, a handle reused once the socket is removed.
+        write is called with the bytes to send to the client.
+        """
+        socket_id = self.socket_handles.allocate()
+        self.client_sockets[socket_id] = ClientSocket(write)
+
+        if self.capture is not None:
+            self.capture.recordOpen(socket_id)
+
+        logger.debug('New incoming connention: %s' % socket_id)
+        return socket_id
+
+    def removeSocket(self, socket_id):
+        if self.capture is not None:
+            self.capture.recordClose(socket_id)
+        self.subscriptions.removeSubscriber(socket_id)
+
+        client_socket = self.client_sockets[socket_id]
+        if client_socket.session is not None and self.session_grace_period > 0:
+            # The terminals stay registered, and keep following their nets, until the session is
+            # resumed or expires. Messages to it are dropped, see handleResume.
+            client_socket.write = None
+            client_socket.outbox = []
+            expiry_time = time.monotonic() + self.session_grace_period
+            self.detached_sessions[client_socket.session] = expiry_time
+            self.onSessionDetached(client_socket.session, expiry_time)
+            logger.debug('Connection %s closed, keeping its session for %.1f s' % (socket_id, self.session_grace_period))
+        else:
+            self.releaseSocket(socket_id)
+            logger.debug('Connection %s closed' % socket_id)
+
+        self.flushSockets()
+
+    def releaseSocket(self, socket_id):
+        self.unRegisterTerminals(socket_id)
+        session_token = self.client_sockets.pop(socket_id).session
+        if session_token is not None:
+            del self.sessions[session_token]
+        self.socket_handles.release(socket_id)
+
+    def expireSession(self, session_token, expiry_time):
+        """
+        Ends a session waiting to be resumed, unless it was resumed since it was detached at expiry_time.
+        """
+        if self.detached_sessions.get(session_token) != expiry_time:
+            return
+        del self.detached_sessions[session_token]
+        self.releaseSocket(self.sessions[session_token])
+        self.flushSockets()
+        logger.info('Session %s expired.' % session_token)
+
+    def receiveData(self, socket_id, data):
+        receive_time = time.perf_counter()
+
+        if self.capture is not None:
+            self.capture.recordData(socket_id, data)
+
+        receive_buffer = self.client_sockets[socket_id].receive_buffer
+        receive_buffer.extend(data)
+
+        # Only complete frames are handed out, so a message split over several
+        # TCP segments is dispatched once the rest of it has arrived.
+        message_counts = {}
+        for frame in protocol.splitFrames(receive_buffer):
+            if frame.__class__ is tuple:
+                self.handleStateRecord(frame, socket_id)
+                message_counts['staterecord'] = message_counts.get('staterecord', 0) + 1
+                continue
+            command, separator, arguments = frame.partition(':')
+            if separator:
+                handler = self.message_handlers.get(command)
+                if handler is not None:
+                    handler(arguments.split(':'), socket_id)
+                    message_counts[command] = message_counts.get(command, 0) + 1
+                else:
+                    logger.warning('Unknown message from %s: %s' % (socket_id, frame))
+
+        self.flushSockets()
+
+        # Timed once per batch, from the data arriving to everything it caused being written.
+        if socket_id in self.client_sockets:
+            self.metrics.recordBatch(self.client_sockets[socket_id].name, message_counts, len(data), time.perf_counter() - receive_time)
+
+    def handleClientName(self, entries, socket_id):
+        client_name = entries[0]
+        self.registerClientName(client_name, socket_id)
+
+        # A client speaking a newer protocol appends its version. Old clients are never answered,
+        # since they do not understand the reply.
+        if len(entries) > 1 and entries[1].isdigit():
+            protocol_version = protocol.negotiateProtocolVersion(int(entries[1]))
+            if protocol_version > protocol.text_protocol_version:
+                self.client_sockets[socket_id].protocol = protocol_version
+                self.queueSocketMessage(socket_id, ('protocol:%d\n' % protocol_version).encode())
+                logger.info('Client with id %s speaks protocol version %d.' % (socket_id, protocol_version))
+
+                if protocol_version >= protocol.session_protocol_version:
+                    self.startSession(socket_id)
+
+    def handleRegistration(self, entries, socket_id):
+        terminals = entries
+        self.registerTerminals(terminals, socket_id)
+
+    def handleStateChange(self, entries, socket_id):
+        self.client_sockets[socket_id].received_count += 1
+        if len(entries) < 2:
+            logger.warning('Malformed statechange from %s: %s' % (socket_id, ':'.join(entries)))
+            return
+        terminal_name = entries[0]
+        new_state = entries[1]
+        self.registerTerminalStateChange(terminal_name, new_state, socket_id)
+
+    def handleStateChanges(self, entries, socket_id):
+        pairs = protocol.unpackStates(entries)
+        self.client_sockets[socket_id].received_count += len(pairs)
+
+        changes = []
+        for terminal_name, new_state in pairs:
+            terminal_id = self.terminal_ids.get(terminal_name)
+            if terminal_id is None or self.terminal_sockets[terminal_id] < 0:
+                logger.warning('Tried to register a statechange on %s, but this terminal is not registered at the server.' % terminal_name)
+                continue
+            changes.append((terminal_id, new_state))
+        self.changeTerminalStates(changes, socket_id)
+
+    def handleSnapshot(self, entries, socket_id):
+        # 'snapshot:all' for every registered terminal, anything else for the requester's own.
+        if entries[0] == 'all':
+            states = list(self.registeredTerminalStates().items())
+        else:
+            states = [(self.terminal_names[terminal_id], self.terminal_states[terminal_id]) for terminal_id in self.client_sockets[socket_id].terminals]
+        self.queueSocketMessage(socket_id, protocol.packStates('snapshot', states))
+        logger.debug('Sent a snapshot of %d terminals to %s' % (len(states), socket_id))
+
+    def handleStats(self, entries, socket_id):
+        # JSON holds colons, so clients take everything after the first one as the summary.
+        self.queueSocketMessage(socket_id, ('stats:' + json.dumps(self.statisticsSummary(), separators=(',', ':')) + '\n').encode())
+
+    def handleSubscribe(self, entries, socket_id):
+        for pattern in entries:
+            if self.subscriptions.isValidPattern(pattern):
+                self.subscriptions.subscribe(socket_id, pattern)
+                logger.debug('Client with id %s subscribed to %s' % (socket_id, pattern))
+            else:
+                logger.warning('Malformed subscription pattern from %s: %s' % (socket_id, pattern))
+
+    def handleUnsubscribe(self, entries, socket_id):
+        for pattern in entries:
+            self.subscriptions.unsubscribe(socket_id, pattern)
+            logger.debug('Client with id %s unsubscribed from %s' % (socket_id, pattern))
+
+    def handleResume(self, entries, socket_id):
+        session_token = entries[0]
+        if session_token not in self.detached_sessions:
+            self.queueSocketMessage(socket_id, ('expired:' + session_token + '\n').encode())
+            logger.info('Client with id %s tried to resume session %s, which expired.' % (socket_id, session_token))
+            return
+        del self.detached_sessions[session_token]
+        received_count = int(entries[1]) if len(entries) > 1 and entries[1].isdigit() else 0
+
+        # The new socket takes over the session, and the terminals of the old one.
+        detached_socket_id = self.sessions[session_token]
+        detached_socket = self.client_sockets.pop(detached_socket_id)
+        self.socket_handles.release(detached_socket_id)
+
+        client_socket = self.client_sockets[socket_id]
+        client_socket.name = detached_socket.name
+        client_socket.protocol = detached_socket.protocol
+        client_socket.terminals = detached_socket.terminals
+        client_socket.session = session_token
+        client_socket.received_count = detached_socket.received_count
+        self.sessions[session_token] = socket_id
+        for terminal_id in client_socket.terminals:
+            self.terminal_sockets[terminal_id] = socket_id
+
+        self.queueSocketMessage(socket_id, ('resumed:%d\n' % client_socket.received_count).encode())
+
+        # Only the terminals whose last state was sent after what the client received are sent
+        # again, counting on from what it received.
+        terminal_sequences = self.terminal_sequences
+        missed_terminal_ids = [terminal_id for terminal_id in client_socket.terminals if terminal_sequences[terminal_id] > received_count]
+        client_socket.sent_count = received_count
+        if missed_terminal_ids:
+            for terminal_id in missed_terminal_ids:
+                client_socket.sent_count += 1
+                terminal_sequences[terminal_id] = client_socket.sent_count
+            self.queueSocketMessage(socket_id, protocol.packStates('states', [(self.terminal_names[terminal_id], self.terminal_states[terminal_id]) for terminal_id in missed_terminal_ids]))
+
+        # The nets may have changed while the session was detached.
+        self.pushLocalNets(socket_id)
+
+        logger.info('Client with id %s resumed the session of %s, %d of %d terminal states were missed.' % (socket_id, client_socket.name, len(missed_terminal_ids), len(client_socket.terminals)))
+
+    def handleEndSession(self, entries, socket_id):
+        # The client is closing for good, so nothing waits for it to resume once its connection is closed.
+        client_socket = self.client_sockets[socket_id]
+        if client_socket.session is not None:
+            del self.sessions[client_socket.session]
+            client_socket.session = None
+            logger.debug('Client with id %s ended its session.' % socket_id)
+
+    def handleStateRecord(self, record, socket_id):
+        self.client_sockets[socket_id].received_count += 1
+        _, terminal_id, state_code = record
+        if terminal_id >= len(self.terminal_names) or state_code >= len(protocol.state_table):
+            logger.warning('Malformed state record from %s: %s' % (socket_id, record))
+            return
+        if self.terminal_sockets[terminal_id] < 0:
+            logger.warning('Tried to register a statechange on %s, but this terminal is not registered at the server.' % self.terminal_names[terminal_id])
+            return
+        self.changeTerminalState(terminal_id, protocol.state_table[state_code], socket_id)
+
+
+    def startSession(self, socket_id):
+        client_socket = self.client_sockets[socket_id]
+        if client_socket.session is not None:
+            del self.sessions[client_socket.session]
+        client_socket.session = secrets.token_hex(8)
+        self.sessions[client_socket.session] = socket_id
+        self.queueSocketMessage(socket_id, ('session:' + client_socket.session + '\n').encode())
+
+    def registerClientName(self, client_name, socket_id):
+        self.client_sockets[socket_id].name = client_name
+        self.onClientNameRegistered(client_name)
+        logger.info('Client with id %s registered as %s.' % (socket_id, client_name))
+
+    def registerTerminals(self, terminals, socket_id):
+        client_socket = self.client_sockets[socket_id]
+        terminal_ids = [self.internTerminal(terminal_name) for terminal_name in terminals]
+        previous_socket_ids = set()
+
+        for terminal_name, terminal_id in zip(terminals, terminal_ids):
+            previous_socket_id = self.terminal_sockets[terminal_id]
+            if previous_socket_id >= 0:
+                self.client_sockets[previous_socket_id].terminals.discard(terminal_id)
+                previous_socket_ids.add(previous_socket_id)
+            else:
+                self.registered_terminal_count += 1
+
+            self.terminal_sockets[terminal_id] = socket_id
+            self.terminal_states[terminal_id] = self.no_state
+            self.terminal_sequences[terminal_id] = 0
+            client_socket.terminals.add(terminal_id)
+
+            # Get all connected terminals here, and add them as a tuple to the hook below!
+            if terminal_name in self.connections:
+                connected_terminal_names = tuple(self.connections[terminal_name])
+            else:
+                connected_terminal_names = ()
+
+            self.onTerminalRegistered(client_socket.name, terminal_name, self.no_state, connected_terminal_names)
+            if tracer.enabled:
+                tracer.record(tracing.registered, terminal_name, self.no_state, client_socket.name)
+
+        # The IDs must reach the client before any binary state change using them.
+        if client_socket.protocol >= protocol.binary_protocol_version:
+            terminal_id_pairs = ['%s:%d' % (terminal_name, terminal_id) for terminal_name, terminal_id in zip(terminals, terminal_ids)]
+            self.queueSocketMessage(socket_id, ('terminalids:' + ':'.join(terminal_id_pairs) + '\n').encode())
+
+        # Clients which lost terminals to this one route fewer nets themselves.
+        for local_socket_id in previous_socket_ids | {socket_id}:
+            self.pushLocalNets(local_socket_id)
+
+        # A terminal joining a net which already has a state is told about it, in a single
+        # message for all terminals of the registration if the client understands it.
+        bulk_states = client_socket.protocol >= protocol.bulk_protocol_version
+        initial_states = []
+        for terminal_name, terminal_id in zip(terminals, terminal_ids):
+            net = self.terminal_nets.get(terminal_name)
+            if net is not None and self.net_states[net] != self.no_state:
+                if bulk_states:
+                    self.terminal_states[terminal_id] = self.net_states[net]
+                    client_socket.sent_count += 1
+                    self.terminal_sequences[terminal_id] = client_socket.sent_count
+                    initial_states.append((terminal_name, self.net_states[net]))
+                else:
+                    self.sendTerminalState(terminal_id, self.net_states[net])
+
+        if initial_states:
+            self.queueSocketMessage(socket_id, protocol.packStates('states', initial_states))
+            logger.debug('Sent initial states of %d terminals to %s' % (len(initial_states), socket_id))
+
+    def registerTerminalStateChange(self, terminal_name, new_state, socket_id):
+        terminal_id = self.terminal_ids.get(terminal_name)
+        if terminal_id is None or self.terminal_sockets[terminal_id] < 0:
+            logger.warning('Tried to register a statechange on %s, but this terminal is not registered at the server.' % terminal_name)
+            return
+        self.changeTerminalState(terminal_id, new_state, socket_id)
+
+    def changeTerminalState(self, terminal_id, new_state, socket_id):
+        """
+        Sets the state of a registered terminal, by handle, and pushes it to the rest of its net.
+        """
+        self.terminal_states[terminal_id] = new_state
+
+        terminal_name = self.terminal_names[terminal_id]
+        client_name = self.client_sockets[socket_id].name
+
+        self.onTerminalChangedState(client_name, terminal_name, new_state)
+
+        if self.subscriptions:
+            self.notifySubscribers(client_name, terminal_name, new_state)
+
+        if tracer.enabled:
+            tracer.record(tracing.changed_state, terminal_name, new_state, client_name)
+
+        # The new state is the state of the whole net, so send it to every other terminal in the net
+        # at once, instead of one hop at a time with the clients echoing it to the next hop. Terminals
+        # already in the new state are skipped by sendTerminalState.
+        fan_out = 0
+        member_ids = self.terminal_net_members[terminal_id]
+        if member_ids is not None:
+            self.net_states[self.terminal_nets[terminal_name]] = new_state
+            if self.journal is not None:
+                self.journal.record(terminal_name, new_state)
+            fan_out = self.pushNetState(member_ids, terminal_id, new_state, socket_id)
+
+        self.metrics.recordFanOut(fan_out)
+
+    def changeTerminalStates(self, changes, socket_id):
+        """
+        Applies (terminal handle, new state) changes of registered terminals as a whole. All terminals
+        take their new states before any net is pushed, and every net is pushed once, with the last
+        state given for it, so the states in between are never routed.
+        """
+        client_name = self.client_sockets[socket_id].name
+
+        net_changes = {}
+        for terminal_id, new_state in changes:
+            self.terminal_states[terminal_id] = new_state
+
+            terminal_name = self.terminal_names[terminal_id]
+            self.onTerminalChangedState(client_name, terminal_name, new_state)
+
+            if self.subscriptions:
+                self.notifySubscribers(client_name, terminal_name, new_state)
+
+            if tracer.enabled:
+                tracer.record(tracing.changed_state, terminal_name, new_state, client_name)
+
+            # The members tuple is shared by the whole net, so its identity tells nets apart.
+            member_ids = self.terminal_net_members[terminal_id]
+            if member_ids is not None:
+                net_changes[id(member_ids)] = (member_ids, terminal_id, new_state)
+            else:
+                self.metrics.recordFanOut(0)
+
+        for member_ids, terminal_id, new_state in net_changes.values():
+            terminal_name = self.terminal_names[terminal_id]
+            self.net_states[self.terminal_nets[terminal_name]] = new_state
+            if self.journal is not None:
+                self.journal.record(terminal_name, new_state)
+
+            self.metrics.recordFanOut(self.pushNetState(member_ids, terminal_id, new_state, socket_id))
+
+    def pushNetState(self, member_ids, terminal_id, new_state, socket_id):
+        """
+        Sends the new state of terminal_id, changed by socket_id, to the other members of its net, and
+        returns how many it was sent to. A client routing its own nets (protocol version 6) has given
+        the state to its terminals in the net already, so their states are only recorded.
+        """
+        fan_out = 0
+        if self.client_sockets[socket_id].protocol >= protocol.local_protocol_version:
+            terminal_sockets = self.terminal_sockets
+            for member_id in member_ids:
+                if member_id != terminal_id:
+                    if terminal_sockets[member_id] == socket_id:
+                        self.terminal_states[member_id] = new_state
+                    elif self.sendTerminalState(member_id, new_state):
+                        fan_out += 1
+        else:
+            for member_id in member_ids:
+                if member_id != terminal_id and self.sendTerminalState(member_id, new_state):
+                    fan_out += 1
+        return fan_out
+
+    def pushLocalNets(self, socket_id):
+        """
+        Sends a client of protocol version 6 or newer the groups of its terminals sharing a net.
+        """
+        client_socket = self.client_sockets[socket_id]
+        if client_socket.protocol < protocol.local_protocol_version:
+            return
+        local_nets = {}
+        for terminal_id in client_socket.terminals:
+            member_ids = self.terminal_net_members[terminal_id]
+            if member_ids is not None:
+                local_nets.setdefault(id(member_ids), []).append(self.terminal_names[terminal_id])
+        groups = [','.join(terminal_names) for terminal_names in local_nets.values() if len(terminal_names) > 1]
+        self.queueSocketMessage(socket_id, ('localnets:' + ':'.join(groups) + '\n').encode())
+
+    def unRegisterTerminals(self, socket_id):
+        client_socket = self.client_sockets[socket_id]
+
+        for terminal_id in client_socket.terminals:
+            self.changeTerminalState(terminal_id, self.no_state, socket_id)
+
+        for terminal_id in client_socket.terminals:
+            self.terminal_sockets[terminal_id] = -1
+            self.terminal_states[terminal_id] = self.no_state
+            if tracer.enabled:
+                tracer.record(tracing.unregistered, self.terminal_names[terminal_id], self.no_state, socket_id)
+
+        self.registered_terminal_count -= len(client_socket.terminals)
+        client_socket.terminals.clear()
+
+        self.onClientNameUnregistered(client_socket.name)
+
+    def remoteSendTerminalState(self, terminal_name, new_state):
+        """
+        Sends new_state to the client of terminal_name, unless it is unregistered or already in
+        that state. Returns whether anything was sent.
+        """
+        terminal_id = self.terminal_ids.get(terminal_name)
+        return terminal_id is not None and self.sendTerminalState(terminal_id, new_state)
+
+    def sendTerminalState(self, terminal_id, new_state):
+        socket_id = self.terminal_sockets[terminal_id]
+        if socket_id < 0 or self.terminal_states[terminal_id] == new_state:
+            return False
+
+        client_socket = self.client_sockets[socket_id]
+        if client_socket.protocol >= protocol.binary_protocol_version and new_state in protocol.state_codes:
+            message = protocol.packStateChange(terminal_id, protocol.state_codes[new_state])
+        else:
+            message = ('statechange:' + self.terminal_names[terminal_id] + ':' + new_state + '\n').encode()
+        self.queueSocketMessage(socket_id, message)
+        client_socket.sent_count += 1
+        self.terminal_sequences[terminal_id] = client_socket.sent_count
+
+        # Record the state sent, so the client echoing it back does not propagate it again.
+        self.terminal_states[terminal_id] = new_state
+        if tracer.enabled:
+            tracer.record(tracing.sent_state, self.terminal_names[terminal_id], new_state, client_socket.name)
+        return True
+
+    def getTerminalState(self, terminal_name):
+        return self.terminal_states[self.terminal_ids[terminal_name]]
+
+    def registeredTerminalStates(self):
+        """
+        Returns the states of all registered terminals, by name.
+        """
+        terminal_names = self.terminal_names
+        terminal_states = self.terminal_states
+        return {terminal_names[terminal_id]: terminal_states[terminal_id] for terminal_id, socket_id in enumerate(self.terminal_sockets) if socket_id >= 0}
+
+    def notifySubscribers(self, client_name, terminal_name, new_state):
+        subscriber_socket_ids = self.subscriptions.match(terminal_name)
+        if subscriber_socket_ids:
+            message = ('monitor:' + client_name + ':' + terminal_name + ':' + new_state + '\n').encode()
+            for socket_id in subscriber_socket_ids:
+                self.queueSocketMessage(socket_id, message)
+
+
+    def statisticsSummary(self):
+        summary = self.metrics.summary()
+        summary['flushes'] = dict(self.flush_statistics)
+        summary['sockets'] = len(self.client_sockets) - len(self.detached_sessions)
+        summary['detached_sessions'] = len(self.detached_sessions)
+        summary['registered_terminals'] = self.registered_terminal_count
+        summary['queued_messages'] = sum(len(self.client_sockets[socket_id].outbox) for socket_id in self.pending_socket_ids if socket_id in self.client_sockets)
+        return summary
+
+
+    def queueSocketMessage(self, socket_id, message):
+        if not self.pending_socket_ids:
+            self.onFlushRequested()
+        self.client_sockets[socket_id].outbox.append(message)
+        self.pending_socket_ids.add(socket_id)
+
+    def flushSockets(self):
+        """
+        Writes the queued messages of every socket that has any, one write per socket.
+        """
+        for socket_id in self.pending_socket_ids:
+            if socket_id in self.client_sockets:
+                client_socket = self.client_sockets[socket_id]
+                merged_messages = len(client_socket.outbox)
+                if client_socket.write is None:
+                    client_socket.outbox = []
+                elif merged_messages:
+                    data = b''.join(client_socket.outbox)
+                    client_socket.write(data)
+                    client_socket.outbox = []
+                    self.metrics.recordWrite(merged_messages, len(data))
+                    self.flush_statistics['flushes'] += 1
+                    self.flush_statistics['messages'] += merged_messages
+                    self.flush_statistics['max_merged'] = max(self.flush_statistics['max_merged'], merged_messages)
+        self.pending_socket_ids.clear()
+
+        # The journal is written after the messages are sent, so it never delays them.
+        if self.journal is not None:
+            self.journal.flush()
+
+
+class ClientCore(object):
+
+    ac_230_on_state = '230VAC'
+    ac_230_off_state = '0VAC'
+    dc_48_on_state = '48VDC'
+    dc_48_off_state = '0VDC'
+    dc_12_on_state = '12VDC'
+    dc_12_off_state = '0VDC'
+    dc_5_on_state = '5VDC'
+    dc_5_off_state = '0VDC'
+
+    # signal_on_state = '12VDC'
+    # signal_off_state = '0VDC'
+
+    no_state = 'None'
+
+    def __init__(self, write=None):
+        # Called with the bytes to send to the server, by the adapter owning the connection. Without
+        # one, data sent is dropped.
+        self.write = write
+        self.client_name = 'default'
+
+        self.terminals = {}
+        self.sources = []
+
+        # The highest protocol version offered to the server, and the version it agreed to.
+        self.protocol_version = protocol.highest_protocol_version
+        self.negotiated_protocol_version = protocol.text_protocol_version
+
+        # Terminal IDs assigned by the server (protocol version 2).
+        self.terminal_ids = {}
+        self.terminal_names = {}
+
+        # Terminal name -> the terminals of this client in its net, one tuple shared by the net, routed
+        # here (protocol version 6).
+        self.local_nets = {}
+        # id of a local net -> the state its terminals are being given.
+        self.delivering_nets = {}
+
+        self.receive_buffer = bytearray()
+        self.connected = False
+
+        # Terminal name patterns to monitor, see sas.subscriptions.
+        self.subscriptions = []
+
+        # Terminal name -> state before the first change of the open batch, see batch.
+        self.batch_depth = 0
+        self.batch_start_states = {}
+
+        # Terminals pushed while not connected, which are sent once connected.
+        self.unsent_terminals = {}
+
+        # The session given by the server (protocol version 5), and the state changes sent and received
+        # in it. Every terminal holds the sent_count of the last state sent for it, see handleResumed.
+        self.session_token = None
+        self.sent_count = 0
+        self.received_count = 0
+
+        self.message_handlers = {'statechange': self.handleStateChange,
+                                 'protocol': self.handleProtocol,
+                                 'terminalids': self.handleTerminalIds,
+                                 'states': self.handleStates,
+                                 'snapshot': self.handleSnapshot,
+                                 'stats': self.handleStats,
+                                 'monitor': self.handleMonitor,
+                                 'session': self.handleSession,
+                                 'localnets': self.handleLocalNets,
+                                 'resumed': self.handleResumed,
+                                 'expired': self.handleExpired}
+
+    def sendData(self, data):
+        if self.write is not None:
+            self.write(data)
+
+    def setClientName(self, name):
+        self.client_name = name
+
+    def receiveData(self, data):
+        self.receive_buffer.extend(data)
+
+        for frame in protocol.splitFrames(self.receive_buffer):
+            if frame.__class__ is tuple:
+                _, terminal_id, state_code = frame
+                self.received_count += 1
+                if terminal_id in self.terminal_names and state_code < len(protocol.state_table):
+                    self.receivedTerminalState(self.terminal_names[terminal_id], protocol.state_table[state_code])
+                else:
+                    logger.warning('Malformed state record from server: %s' % (frame, ))
+                continue
+            command, separator, arguments = frame.partition(':')
+            if separator:
+                handler = self.message_handlers.get(command)
+                if handler is not None:
+                    handler(arguments.split(':'))
+                else:
+                    logger.warning('Unknown message from server: %s' % (frame, ))
+
+    def handleStateChange(self, entries):
+        terminal_name = entries[0]
+        new_state = entries[1]
+
+        self.received_count += 1
+        self.receivedTerminalState(terminal_name, new_state)
+
+    def handleStates(self, entries):
+        states = protocol.unpackStates(entries)
+        self.received_count += len(states)
+        for terminal_name, new_state in states:
+            self.receivedTerminalState(terminal_name, new_state)
+
+    def handleSnapshot(self, entries):
+        self.receivedSnapshot(dict(protocol.unpackStates(entries)))
+
+    def handleStats(self, entries):
+        self.receivedStatistics(json.loads(':'.join(entries)))
+
+    def handleMonitor(self, entries):
+        client_name, terminal_name, new_state = entries[:3]
+        self.receivedMonitorState(client_name, terminal_name, new_state)
+
+    def handleProtocol(self, entries):
+        self.negotiated_protocol_version = int(entries[0])
+        logger.debug('Server agreed to protocol version %d' % (self.negotiated_protocol_version, ))
+
+    def handleTerminalIds(self, entries):
+        for terminal_name, terminal_id in zip(entries[0::2], entries[1::2]):
+            self.terminal_ids[terminal_name] = int(terminal_id)
+            self.terminal_names[int(terminal_id)] = terminal_name
+
+    def handleLocalNets(self, entries):
+        self.local_nets = {}
+        groups = []
+        for group in entries:
+            terminal_names = tuple(terminal_name for terminal_name in group.split(',') if terminal_name in self.terminals)
+            if len(terminal_names) < 2:
+                continue
+            groups.append(terminal_names)
+            for terminal_name in terminal_names:
+                self.local_nets[terminal_name] = terminal_names
+
+        # States pushed before the groups were known, like those of the sources when connecting, were
+        # recorded by the server for the other terminals of the group without being sent here.
+        with self.batch():
+            for terminal_names in groups:
+                state = next((self.terminals[terminal_name]['state'] for terminal_name in terminal_names if self.terminals[terminal_name]['state'] != self.no_state), None)
+                if state is None:
+                    continue
+                for terminal_name in terminal_names:
+                    if self.terminals[terminal_name]['state'] == self.no_state:
+                        self.receivedTerminalState(terminal_name, state)
+
+    def handleSession(self, entries):
+        self.session_token = entries[0]
+
+    def handleResumed(self, entries):
+        # The server has everything up to the first state sent after what it received. Those are
+        # sent again, with whatever was pushed while not connected, counting on from there.
+        received_count = int(entries[0])
+        missed_terminals = dict.fromkeys(terminal_name for terminal_name, terminal in self.terminals.items() if terminal['sequence'] > received_count)
+        missed_terminals.update(self.unsent_terminals)
+        self.unsent_terminals = {}
+        self.sent_count = received_count
+        self.connected = True
+
+        if missed_terminals:
+            self.sendTerminalStates([(terminal_name, self.terminals[terminal_name]['state']) for terminal_name in missed_terminals])
+        self.pushSubscriptions(self.subscriptions)
+        logger.debug('Resumed session %s, sent %d missed states.' % (self.session_token, len(missed_terminals)))
+
+    def handleExpired(self, entries):
+        logger.debug('Session %s expired, registering again.' % (self.session_token, ))
+        self.startSession()
+
+    def connectedToServer(self):
+        self.receive_buffer = bytearray()
+
+        # A lost session is resumed rather than started over, and the client counts as connected
+        # once the server has answered, see handleResumed and handleExpired.
+        if self.session_token is not None:
+            self.sendData(('resume:%s:%d\n' % (self.session_token, self.received_count)).encode())
+            return
+
+        self.startSession()
+
+    def startSession(self):
+        # Whatever was agreed with a previous server does not hold for this connection.
+        self.negotiated_protocol_version = protocol.text_protocol_version
+        self.terminal_ids = {}
+        self.terminal_names = {}
+        self.local_nets = {}
+        self.session_token = None
+        self.sent_count = 0
+        self.received_count = 0
+        for terminal in self.terminals.values():
+            terminal['sequence'] = 0
+        self.connected = True
+
+        self.pushClientName()
+        self.pushTerminals()
+        self.pushUnsentStates()
+        self.pushSubscriptions(self.subscriptions)
+        self.initializeSources()
+
+    def endSession(self):
+        """
+            Tells the server the client is closing its connection for good, so its terminals are
+            unregistered at once instead of waiting to be resumed. The next connection starts over.
+        """
+        if self.connected and self.session_token is not None:
+            self.sendData(b'endsession:\n')
+        self.session_token = None
+
+    def disconnectedFromServer(self):
+        self.connected = False
+
+    def initializeSources(self):
+        for source in self.sources:
+            source.initializeSource()
+
+    def defaultTerminalAction(self, terminal_name, new_state):
+        """
+            Just push the new state of terminal to the server.
+        """
+        self.pushTerminalState(terminal_name, new_state)
+
+    def registerTerminal(self, terminal_name, state=no_state):
+        self.terminals[terminal_name] = {'name': terminal_name, 'state': state, 'sequence': 0, 'action': partial(self.defaultTerminalAction, terminal_name)}
+
+    def getTerminalState(self, terminal_name):
+        return self.terminals[terminal_name]['state']
+
+    def receivedTerminalState(self, terminal_name, new_state):
+        """
+            Acts on a new state change reveived from the server side.
+        """
+        if tracer.enabled:
+            tracer.record(tracing.received_state, terminal_name, new_state, self.client_name)
+
+        local_terminal_names = self.local_nets.get(terminal_name)
+        if local_terminal_names is None:
+            self.terminals[terminal_name]['action'](new_state)
+        elif id(local_terminal_names) in self.delivering_nets:
+            # Given by another terminal of this client in the net. The server records the state for this
+            # terminal too, so it is stored before the action runs, and an echo of it is not sent.
+            self.terminals[terminal_name]['state'] = new_state
+            self.terminals[terminal_name]['action'](new_state)
+        else:
+            self.receivedNetState(local_terminal_names, new_state)
+
+    def receivedNetState(self, terminal_names, new_state):
+        """
+            Gives a state received from the server to all terminals of a local net at once.
+        """
+        # The server sends a new net state to each terminal of this client in the net, and records it
+        # for all of them, so they all take it before any action runs. A source putting its state back
+        # from its action then pushes a change, which is given to the rest of the net, and the messages
+        # for the other terminals find it delivered already.
+        changed_terminal_names = [terminal_name for terminal_name in terminal_names if self.terminals[terminal_name]['state'] != new_state]
+        for terminal_name in changed_terminal_names:
+            if terminal_name in self.batch_start_states:
+                self.batch_start_states[terminal_name] = new_state
+            self.terminals[terminal_name]['state'] = new_state
+
+        with self.batch():
+            for terminal_name in changed_terminal_names:
+                # Unless an action gave the net another state meanwhile.
+                if self.terminals[terminal_name]['state'] == new_state:
+                    self.terminals[terminal_name]['action'](new_state)
+
+    def receivedMonitorState(self, client_name, terminal_name, new_state):
+        """
+            Acts on a state change of a subscribed terminal, owned by any client.
+        """
+        if tracer.enabled:
+            tracer.record(tracing.monitored_state, terminal_name, new_state, client_name)
+
+    def receivedSnapshot(self, states):
+        """
+            Acts on the answer to requestSnapshot, a dict of terminal name -> state.
+        """
+        logger.debug('Received a snapshot of %d terminals from server' % (len(states), ))
+
+    def requestSnapshot(self, all_terminals=False):
+        """
+            Asks the server for the states of this client's terminals, or of all terminals.
+        """
+        self.sendData(('snapshot:' + ('all' if all_terminals else 'own') + '\n').encode())
+
+    def receivedStatistics(self, statistics):
+        """
+            Acts on the answer to requestStatistics, the server's metrics as a dict.
+        """
+        logger.debug('Received statistics from server')
+
+    def requestStatistics(self):
+        self.sendData(b'stats:all\n')
+
+    def subscribe(self, patterns):
+        """
+            Subscribes to the state changes of all terminals matching the patterns, a
+            terminal name or a prefix followed by '*'. Sent again on every reconnect.
+        """
+        self.subscriptions.extend(patterns)
+        if self.connected:
+            self.pushSubscriptions(patterns)
+
+    def unsubscribe(self, patterns):
+        for pattern in patterns:
+            if pattern in self.subscriptions:
+                self.subscriptions.remove(pattern)
+        if self.connected:
+            self.sendData(('unsubscribe:' + ':'.join(patterns) + '\n').encode())
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+            Collects the states pushed inside the with block, and sends them as one message
+            when the outermost block ends. Terminals which end up in the state they had
+            before the batch are not sent at all.
+
+                with client.batch():
+                    client.pushTerminalState('K1-13', '0VDC')
+                    client.pushTerminalState('K1-14', '48VDC')
+        """
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.pushBatchedStates()
+
+    def pushTerminalState(self, terminal_name, state):
+        """
+            Stores the state locally at the client side, and sends the new state to the server.
+        """
+        local_terminal_names = self.local_nets.get(terminal_name)
+        if local_terminal_names is not None:
+            if self.terminals[terminal_name]['state'] == state:
+                # The net agrees on its state, and the server has it, so a terminal pushing the state
+                # it has, like an action echoing what it was given, has nothing to pass on.
+                return
+            net_id = id(local_terminal_names)
+            if self.delivering_nets.get(net_id) == state:
+                # Echoed while the net is being given the state: the loop below gives it to the rest,
+                # rather than recursing through every terminal of the net.
+                self.storeTerminalState(terminal_name, state)
+                return
+            # The other terminals of this client in the net get the state here rather than from the
+            # server, and whatever their actions push is sent in one batch with the change.
+            with self.batch():
+                self.storeTerminalState(terminal_name, state)
+                delivering_state = self.delivering_nets.get(net_id)
+                self.delivering_nets[net_id] = state
+                try:
+                    for local_terminal_name in local_terminal_names:
+                        if self.terminals[local_terminal_name]['state'] != state:
+                            self.receivedTerminalState(local_terminal_name, state)
+                finally:
+                    if delivering_state is None:
+                        del self.delivering_nets[net_id]
+                    else:
+                        self.delivering_nets[net_id] = delivering_state
+        else:
+            self.storeTerminalState(terminal_name, state)
+
+    def storeTerminalState(self, terminal_name, state):
+        if self.batch_depth:
+            if terminal_name not in self.batch_start_states:
+                self.batch_start_states[terminal_name] = self.terminals[terminal_name]['state']
+            self.terminals[terminal_name]['state'] = state
+            return
+
+        terminal = self.terminals[terminal_name]
+        terminal['state'] = state
+        if not self.connected:
+            self.unsent_terminals[terminal_name] = None
+            return
+        self.sent_count += 1
+        terminal['sequence'] = self.sent_count
+        self.sendData(self.encodeTerminalState(terminal_name, state))
+        if tracer.enabled:
+            tracer.record(tracing.pushed_state, terminal_name, state, self.client_name)
+
+    def pushBatchedStates(self):
+        changes = [(terminal_name, self.terminals[terminal_name]['state']) for terminal_name, start_state in self.batch_start_states.items()
+                   if self.terminals[terminal_name]['state'] != start_state]
+        self.batch_start_states = {}
+        if not changes:
+            return
+        if not self.connected:
+            self.unsent_terminals.update((terminal_name, None) for terminal_name, _ in changes)
+            return
+        self.sendTerminalStates(changes)
+
+    def pushUnsentStates(self):
+        # The states pushed while not connected, as they are now.
+        if self.unsent_terminals:
+            changes = [(terminal_name, self.terminals[terminal_name]['state']) for terminal_name in self.unsent_terminals]
+            self.unsent_terminals = {}
+            self.sendTerminalStates(changes)
+
+    def sendTerminalStates(self, changes):
+        for terminal_name, _ in changes:
+            self.sent_count += 1
+            self.terminals[terminal_name]['sequence'] = self.sent_count
+
+        # A single change is sent as usual, which is a binary record for most states. Servers which
+        # do not apply batches get the changes one by one, in a single write.
+        if len(changes) > 1 and self.negotiated_protocol_version >= protocol.batch_protocol_version:
+            self.sendData(protocol.packStates('statechanges', changes))
+        else:
+            self.sendData(b''.join([self.encodeTerminalState(terminal_name, state) for terminal_name, state in changes]))
+
+        if tracer.enabled:
+            for terminal_name, state in changes:
+                tracer.record(tracing.pushed_state, terminal_name, state, self.client_name)
+
+    def encodeTerminalState(self, terminal_name, state):
+        if self.negotiated_protocol_version >= protocol.binary_protocol_version and terminal_name in self.terminal_ids and state in protocol.state_codes:
+            return protocol.packStateChange(self.terminal_ids[terminal_name], protocol.state_codes[state])
+        return ('statechange:' + terminal_name + ':' + state + '\n').encode()
+
+    def pushClientName(self):
+        # Servers that only speak the text protocol ignore the appended version.
+        if self.protocol_version > protocol.text_protocol_version:
+            message = 'clientname:' + self.client_name + ':%d' % self.protocol_version + '\n'
+        else:
+            message = 'clientname:' + self.client_name + '\n'
+        self.sendData(message.encode())
+        logger.debug('Sent client name registration to server (%s).' % (self.client_name, ))
+
+    def pushTerminals(self):
+        if len(self.terminals) > 0:
+            message = 'registration:' + ':'.join(self.terminals) + '\n'
+            self.sendData(message.encode())
+            logger.debug('Registered terminals on server (%s).' % (', '.join(self.terminals)))
+
+    def pushSubscriptions(self, patterns):
+        if len(patterns) > 0:
+            self.sendData(('subscribe:' + ':'.join(patterns) + '\n').encode())
+            logger.debug('Subscribed to terminals on server (%s).' % (', '.join(patterns)))
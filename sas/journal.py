@@ -0,0 +1,207 @@
+"""
+A write-ahead journal of net states, so a restarted server knows the last
+state of the plant before any client has reconnected.
+
+State changes are appended to the journal as 'terminal:state' lines. The
+servers hand records to the journal while routing, and write them with a
+single write after the messages of a batch are sent, so the journal never
+delays a state change on the wire. Syncing to disk is batched: a background
+thread calls fsync at most every sync_interval seconds, trading the last
+moment of history in a power loss for latency. A sync_interval of 0 syncs on
+every write, and None leaves it to the operating system.
+
+Every snapshot_interval records the journal is compacted: it is moved aside,
+a fresh one is started, and the background thread writes a snapshot of all
+net states and removes the old journal. Recovery reads the snapshot and then
+both journals, oldest first. Replaying a record the snapshot already holds
+does not change anything, so a crash at any point of a compaction recovers
+the same states.
+"""
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+snapshot_suffix = '.snapshot'
+rotated_suffix = '.old'
+
+
+def readRecords(path):
+    """
+    Returns the (terminal_name, state) records of a journal or snapshot file, oldest
+    first. A partial last line, left by a crash in the middle of a write, is skipped.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+
+    end = data.rfind(b'\n')
+    records = []
+    for line in data[:end + 1].decode(errors='replace').splitlines():
+        terminal_name, separator, state = line.partition(':')
+        if separator:
+            records.append((terminal_name, state))
+    return records
+
+
+def writeRecords(path, records):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(''.join(['%s:%s\n' % record for record in records]).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+class StateJournal(object):
+
+    def __init__(self, journal_path, sync_interval=1.0, snapshot_interval=100000):
+        self.journal_path = journal_path
+        self.snapshot_path = journal_path + snapshot_suffix
+        self.rotated_path = journal_path + rotated_suffix
+
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+
+        # Encoded records waiting for the next flush, and the number of records in the current journal.
+        self.pending = []
+        self.record_count = 0
+        self.statistics = {'records': 0, 'writes': 0, 'syncs': 0, 'snapshots': 0}
+
+        self.file = None
+        self.states = None
+
+        # Shared with the background thread: whether the file has unsynced writes, and a
+        # compaction waiting to be finished, (rotated file, net states).
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.snapshot_job = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+    def recover(self):
+        """
+        Returns all (terminal_name, state) records, oldest first. Applying them in order
+        gives the last known states.
+        """
+        records = []
+        for path in (self.snapshot_path, self.rotated_path, self.journal_path):
+            records.extend(readRecords(path))
+        return records
+
+    def open(self, states):
+        """
+        Starts journaling. states is called for the (terminal_name, state) records of a
+        snapshot, and should return them for the current states. The recovered history is
+        compacted into a snapshot first.
+        """
+        self.states = states
+
+        writeRecords(self.snapshot_path, states())
+        for path in (self.rotated_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.file = open(self.journal_path, 'ab', buffering=0)
+        self.record_count = 0
+
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='StateJournal', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+
+        if self.sync_interval is not None:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+    def record(self, terminal_name, state):
+        self.pending.append('%s:%s\n' % (terminal_name, state))
+
+    def flush(self):
+        """
+        Writes the pending records with a single write. Called after the messages they
+        caused have been sent.
+        """
+        if not self.pending or self.file is None:
+            return
+
+        self.file.write(''.join(self.pending).encode())
+        self.record_count += len(self.pending)
+        self.statistics['records'] += len(self.pending)
+        self.statistics['writes'] += 1
+        self.pending = []
+
+        if self.sync_interval == 0:
+            os.fsync(self.file.fileno())
+            self.statistics['syncs'] += 1
+        else:
+            with self.lock:
+                self.dirty = True
+
+        if self.record_count >= self.snapshot_interval:
+            self.rotate()
+
+    def rotate(self):
+        with self.lock:
+            # The previous compaction has not finished yet, the journal just grows a while longer.
+            if self.snapshot_job is not None:
+                return
+
+            rotated_file = self.file
+            os.replace(self.journal_path, self.rotated_path)
+            self.file = open(self.journal_path, 'ab', buffering=0)
+            self.record_count = 0
+            self.snapshot_job = (rotated_file, self.states())
+
+        self.wakeup.set()
+
+    def run(self):
+        """
+        The background thread: syncs the journal and finishes compactions.
+        """
+        while not self.stopping:
+            self.wakeup.wait(self.sync_interval or None)
+            self.wakeup.clear()
+
+            with self.lock:
+                journal_file = self.file
+                dirty = self.dirty and bool(self.sync_interval)
+                self.dirty = False
+                snapshot_job = self.snapshot_job
+
+            # Only this thread closes journal files, so the file stays open while it is synced.
+            if dirty:
+                os.fsync(journal_file.fileno())
+                self.statistics['syncs'] += 1
+
+            if snapshot_job is not None:
+                rotated_file, states = snapshot_job
+                try:
+                    if rotated_file is not None:
+                        os.fsync(rotated_file.fileno())
+                        rotated_file.close()
+                    writeRecords(self.snapshot_path, states)
+                    os.remove(self.rotated_path)
+                except OSError as error:
+                    # The rotated journal is kept, and no other rotation happens until it is retried.
+                    logger.error('Could not write journal snapshot %s: %s' % (self.snapshot_path, error))
+                    with self.lock:
+                        self.snapshot_job = (None, states)
+                else:
+                    self.statistics['snapshots'] += 1
+                    with self.lock:
+                        self.snapshot_job = None
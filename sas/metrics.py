@@ -0,0 +1,121 @@
+"""
+Cheap, always-on server metrics: counters and fixed-bucket histograms.
+
+A histogram has one bucket per power of two of the recorded value in its unit
+(microseconds for latencies), so recording a value is a multiplication, a
+bit_length and an increment, and the memory used never grows. Percentiles are
+reported as the upper bound of the bucket they fall in, so they are accurate
+to within a factor of two, which is plenty to see where time goes.
+"""
+
+
+class Histogram(object):
+
+    def __init__(self, scale=1.0, bucket_count=24):
+        # Values are multiplied by scale, so that bucket 0 holds values up to 1 unit, and bucket i
+        # values above 2 ** (i - 1) up to 2 ** i units.
+        self.scale = scale
+        self.counts = [0] * bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, value, count=1):
+        units = int(value * self.scale)
+        bucket = (units - 1).bit_length() if units > 0 else 0
+        if bucket >= len(self.counts):
+            bucket = len(self.counts) - 1
+        self.counts[bucket] += count
+        self.count += count
+        self.total += value * count
+        if value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, percentile):
+        threshold = self.count * percentile / 100.0
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= threshold:
+                return (1 << bucket) / self.scale
+        return 0.0
+
+    def summary(self):
+        # The buckets are reported up to the last one in use, as counts per upper bound.
+        last_bucket = max([bucket for bucket, count in enumerate(self.counts) if count] or [0])
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.maximum,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': self.counts[:last_bucket + 1]}
+
+
+class ServerMetrics(object):
+    """
+    The metrics RoutingCore records while routing. Latencies are recorded in seconds,
+    and kept in microsecond buckets.
+
+    Data received from a socket is handled as a batch, and timed once: from its arrival
+    to all messages it caused having been written. That time is recorded for every
+    message in the batch, so recording costs the same for one message as for a thousand.
+    """
+
+    def __init__(self):
+        # Message type -> count, and the batch latency of the messages.
+        self.message_counts = {}
+        self.message_latency = {}
+
+        # Client name -> the batch latency of the state changes sent by the client.
+        self.client_latency = {}
+
+        # The number of terminals a state change was sent to, and the number of messages
+        # merged into each socket write, which is the depth of the socket's queue.
+        self.fan_out = Histogram()
+        self.queue_depth = Histogram()
+
+        self.counters = {'bytes_received': 0, 'bytes_sent': 0, 'state_changes': 0, 'sends': 0}
+
+    def recordBatch(self, client_name, message_counts, byte_count, latency):
+        for message_type, count in message_counts.items():
+            histogram = self.message_latency.get(message_type)
+            if histogram is None:
+                histogram = self.message_latency[message_type] = Histogram(1e6)
+                self.message_counts[message_type] = 0
+            histogram.record(latency, count)
+            self.message_counts[message_type] += count
+
+        state_changes = message_counts.get('statechange', 0) + message_counts.get('staterecord', 0) + message_counts.get('statechanges', 0)
+        if state_changes:
+            histogram = self.client_latency.get(client_name)
+            if histogram is None:
+                histogram = self.client_latency[client_name] = Histogram(1e6)
+            histogram.record(latency, state_changes)
+
+        self.counters['bytes_received'] += byte_count
+
+    def recordFanOut(self, fan_out):
+        # Also called for changes made by the server itself, like unregistering a disconnected client.
+        self.fan_out.record(fan_out)
+        self.counters['state_changes'] += 1
+        self.counters['sends'] += fan_out
+
+    def recordWrite(self, message_count, byte_count):
+        self.queue_depth.record(message_count)
+        self.counters['bytes_sent'] += byte_count
+
+    def summary(self):
+        return {'counters': dict(self.counters),
+                'messages': dict(self.message_counts),
+                'message_latency_us': {message_type: self.scaled(histogram) for message_type, histogram in self.message_latency.items()},
+                'client_latency_us': {client_name: self.scaled(histogram) for client_name, histogram in self.client_latency.items()},
+                'fan_out': self.fan_out.summary(),
+                'queue_depth': self.queue_depth.summary()}
+
+    def scaled(self, histogram):
+        # Latency summaries in microseconds rather than seconds.
+        summary = histogram.summary()
+        for key in ('mean', 'max', 'p50', 'p90', 'p99'):
+            summary[key] *= 1e6
+        return summary
@@ -1,20 +1,136 @@
 
 import logging
+from functools import partial
 
 from PySide2 import QtCore, QtNetwork
 
+try:
+    import numpy
+except ImportError:
+    # Only the component banks need it.
+    numpy = None
+
 from .client import SASClient
 
 logger = logging.getLogger(__name__)
 
 
-class SingleLoad(QtCore.QObject):
+class DeltaScheduler(QtCore.QObject):
+    """
+    Settles the components of a client in delta cycles, as an HDL simulator does.
+
+    Components post the states they drive as events instead of pushing them, and the
+    states received for their terminals are posted too. Each cycle applies the events
+    posted in the previous one, the last per terminal, and then runs the actions of the
+    terminals that changed, once each, with the state the terminal has at the end of
+    the applying. What the actions post makes up the next cycle, until nothing changes.
+    The whole run is one batch of the client, so only the settled states are sent.
+    """
+
+    def __init__(self, client, max_cycles=100000):
+        super(DeltaScheduler, self).__init__()
+        self.client = client
+        # A chain of components takes a cycle or two per component to settle, a run which takes
+        # this many is taken to be a circuit that oscillates, and is given up.
+        self.max_cycles = max_cycles
+
+        # Terminal name -> the actions of the components watching it.
+        self.terminal_actions = {}
+        # Terminal name -> (state, received) of the events for the next cycle.
+        self.pending = {}
+        self.running = False
+
+        self.statistics = {'runs': 0, 'cycles': 0, 'events': 0, 'evaluations': 0}
+
+    def watch(self, terminal_name, action):
+        """
+        Calls action(new_state) in the cycle after the terminal changed. The states the
+        client receives for the terminal are posted as events from now on.
+        """
+        self.terminal_actions.setdefault(terminal_name, []).append(action)
+        self.client.terminals[terminal_name]['action'] = partial(self.receivedEvent, terminal_name)
+
+    def receivedEvent(self, terminal_name, new_state):
+        # A state the terminal already has on the server side: stored, but not sent back.
+        self.postEvent(terminal_name, new_state, received=True)
+
+    def postEvent(self, terminal_name, new_state, received=False):
+        """
+        Sets the terminal to new_state in the next cycle, and settles the components
+        unless they are being settled already.
+        """
+        self.pending[terminal_name] = (new_state, received)
+        self.statistics['events'] += 1
+        if not self.running:
+            self.run()
+
+    def run(self):
+        self.running = True
+        self.statistics['runs'] += 1
+        terminals = self.client.terminals
+        try:
+            with self.client.batch():
+                cycle_count = 0
+                while self.pending:
+                    if cycle_count == self.max_cycles:
+                        logger.warning('Components did not settle in %d delta cycles, dropped the events for %s.' % (cycle_count, ', '.join(self.pending)))
+                        break
+                    cycle_count += 1
+
+                    events = self.pending
+                    self.pending = {}
+                    changed_terminal_names = []
+                    for terminal_name, (new_state, received) in events.items():
+                        if received:
+                            # The client may have stored a state given to a terminal of a local net already.
+                            terminals[terminal_name]['state'] = new_state
+                        elif terminals[terminal_name]['state'] == new_state:
+                            continue
+                        else:
+                            self.client.pushTerminalState(terminal_name, new_state)
+                        changed_terminal_names.append(terminal_name)
+
+                    for terminal_name in changed_terminal_names:
+                        new_state = terminals[terminal_name]['state']
+                        for action in self.terminal_actions.get(terminal_name, ()):
+                            action(new_state)
+                            self.statistics['evaluations'] += 1
+                self.statistics['cycles'] += cycle_count
+        finally:
+            self.pending = {}
+            self.running = False
+
+
+class Component(QtCore.QObject):
+    """
+    Base of the components below. Without a scheduler a component pushes its states to the
+    client from its terminal actions, with one they are posted to the scheduler.
+    """
+
+    def __init__(self, parent, scheduler=None):
+        super(Component, self).__init__()
+        self.parent_ = parent
+        self.scheduler = scheduler
+
+    def setTerminalAction(self, terminal_name, action):
+        if self.scheduler is None:
+            self.parent_.terminals[terminal_name]['action'] = action
+        else:
+            self.scheduler.watch(terminal_name, action)
+
+    def pushTerminalState(self, terminal_name, state):
+        if self.scheduler is None:
+            self.parent_.pushTerminalState(terminal_name, state)
+        else:
+            self.scheduler.postEvent(terminal_name, state)
+
 
-    def __init__(self, on_state, off_state, parent):
-        super(SingleLoad, self).__init__()
+class SingleLoad(Component):
+
+    def __init__(self, on_state, off_state, parent, scheduler=None):
+        super(SingleLoad, self).__init__(parent, scheduler)
         self.on_state = on_state
         self.off_state = off_state
-        self.parent_ = parent
 
     """
     Input is the positive side. It can be connected to a source, or a circuit breaker.
@@ -40,55 +156,54 @@ class SingleLoad(QtCore.QObject):
             print('LOAD is OFF')
             self.parent_.terminals[self.power_terminal_name]['state'] = self.parent_.no_state
             #self.parent_.pushTerminalState(self.power_terminal_name, new_state)
-            self.parent_.pushTerminalState(self.zero_terminal_name, self.parent_.no_state)
+            self.pushTerminalState(self.zero_terminal_name, self.parent_.no_state)
         
         elif new_state == self.on_state:
-            self.parent_.pushTerminalState(self.power_terminal_name, self.on_state)
-            if self.parent_.terminals[self.zero_terminal_name]['state'] == self.off_state:
-                print('LOAD is ON')
-            else:
-                self.parent_.pushTerminalState(self.zero_terminal_name, self.parent_.no_state)
+            with self.parent_.batch():
+                self.pushTerminalState(self.power_terminal_name, self.on_state)
+                if self.parent_.terminals[self.zero_terminal_name]['state'] == self.off_state:
+                    print('LOAD is ON')
+                else:
+                    self.pushTerminalState(self.zero_terminal_name, self.parent_.no_state)
 
 
     def addTerminalPair(self, power_terminal_name, zero_terminal_name):
         self.power_terminal_name = power_terminal_name
         self.zero_terminal_name = zero_terminal_name
         
-        self.parent_.terminals[power_terminal_name]['action'] = self.powerTerminalAction
-        self.parent_.terminals[zero_terminal_name]['action'] = self.zeroTerminalAction
+        self.setTerminalAction(power_terminal_name, self.powerTerminalAction)
+        self.setTerminalAction(zero_terminal_name, self.outputAction)
 
 
-class SingleSource(QtCore.QObject):
+class SingleSource(Component):
 
-    def __init__(self, fixed_state, inverted_state, parent):
-        super(SingleSource, self).__init__()
+    def __init__(self, fixed_state, inverted_state, parent, scheduler=None):
+        super(SingleSource, self).__init__(parent, scheduler)
         self.fixed_state = fixed_state
         self.inverted_state = inverted_state
-        self.parent_ = parent
 
     def addTerminal(self, terminal_name):
         self.terminal_name = terminal_name
-        self.parent_.terminals[terminal_name]['action'] = self.terminalAction
+        self.setTerminalAction(terminal_name, self.terminalAction)
     
         self.parent_.sources.append(self)
 
     def terminalAction(self, new_state):
         if new_state == self.parent_.no_state:
             # Reflect fixed_state
-            self.parent_.pushTerminalState(self.terminal_name, self.fixed_state)
+            self.pushTerminalState(self.terminal_name, self.fixed_state)
 
         elif new_state == self.inverted_state:
             # This is a short and should not be possible
             assert new_state != self.inverted_state, 'Short circuit.'
         
     def initializeSource(self):
-        self.parent_.pushTerminalState(self.terminal_name, self.fixed_state)
+        self.pushTerminalState(self.terminal_name, self.fixed_state)
 
-class SinglePhaseCircuitBreaker(QtCore.QObject):
+class SinglePhaseCircuitBreaker(Component):
 
-    def __init__(self, parent, initially_closed=False):
-        super(SinglePhaseCircuitBreaker, self).__init__()
-        self.parent_ = parent
+    def __init__(self, parent, initially_closed=False, scheduler=None):
+        super(SinglePhaseCircuitBreaker, self).__init__(parent, scheduler)
         self.closed = initially_closed
 
         self.terminal_name_pairs = {}
@@ -97,17 +212,20 @@ class SinglePhaseCircuitBreaker(QtCore.QObject):
         return self.closed
 
     def inputAction(self, new_state):
-        self.parent_.defaultTerminalAction(self.input_terminal_name, new_state)
-        if self.isClosed():    
-            self.parent_.defaultTerminalAction(self.output_terminal_name, new_state)
-        else:
-            self.parent_.defaultTerminalAction(self.output_terminal_name, self.parent_.no_state)
+        # Both sides of the breaker are sent to the server as one change.
+        with self.parent_.batch():
+            self.pushTerminalState(self.input_terminal_name, new_state)
+            if self.isClosed():    
+                self.pushTerminalState(self.output_terminal_name, new_state)
+            else:
+                self.pushTerminalState(self.output_terminal_name, self.parent_.no_state)
 
 
     def outputAction(self, new_state):
-        self.parent_.defaultTerminalAction(self.output_terminal_name, new_state)
-        if self.isClosed() and self.parent_.getTerminalState(self.input_terminal_name) == self.parent.no_state:    
-            self.parent_.defaultTerminalAction(self.input_terminal_name, new_state)
+        with self.parent_.batch():
+            self.pushTerminalState(self.output_terminal_name, new_state)
+            if self.isClosed() and self.parent_.getTerminalState(self.input_terminal_name) == self.parent_.no_state:    
+                self.pushTerminalState(self.input_terminal_name, new_state)
         # else:
         #     self.parent.defaultTerminalAction(self.input_terminal_name, self.parent.no_state)
 
@@ -116,8 +234,8 @@ class SinglePhaseCircuitBreaker(QtCore.QObject):
     def addTerminalPair(self, input_terminal_name, output_terminal_name):
         self.input_terminal_name = input_terminal_name
         self.output_terminal_name = output_terminal_name
-        self.parent_.terminals[input_terminal_name]['action'] = self.inputAction
-        self.parent_.terminals[output_terminal_name]['action'] = self.outputAction
+        self.setTerminalAction(input_terminal_name, self.inputAction)
+        self.setTerminalAction(output_terminal_name, self.outputAction)
 
 
     # Hmmmm.... Same ugly solution as for the Relay?
@@ -219,3 +337,179 @@ class Relay(QtCore.QObject):
 
             pass
 
+
+class ComponentBank(QtCore.QObject):
+    """
+    Base of the banks below, which model many devices of a kind with their states in
+    NumPy arrays rather than one object per device.
+
+    States are kept as small integer codes, indexes into state_names, so a whole bank is
+    evaluated with a few array operations. States received for the inputs of a bank are
+    stored, and the bank is evaluated once control is back in the event loop, so everything
+    received in one read of the socket is evaluated together. Only the outputs which changed
+    are pushed, in one batch. Power flows from the inputs to the outputs, which the bank drives.
+    """
+
+    def __init__(self, parent, output_terminal_names):
+        if numpy is None:
+            raise ImportError('Component banks need NumPy.')
+        super(ComponentBank, self).__init__()
+        self.parent_ = parent
+
+        self.state_names = [parent.no_state]
+        self.state_codes = {parent.no_state: 0}
+
+        # Terminal name -> (action, [(codes, index), ...]) for every terminal the bank watches.
+        self.watched_terminals = {}
+
+        self.output_terminal_names = list(output_terminal_names)
+        if len(set(self.output_terminal_names)) != len(self.output_terminal_names):
+            raise ValueError('%s drives a terminal from more than one output, connect the outputs to one net instead.' % self.__class__.__name__)
+        self.output_codes = self.watchTerminals(self.output_terminal_names, self.receivedOutputState)
+        self.evaluation_pending = False
+        self.evaluating = False
+
+    def stateCode(self, state):
+        code = self.state_codes.get(state)
+        if code is None:
+            code = self.state_codes[state] = len(self.state_names)
+            self.state_names.append(state)
+        return code
+
+    def watchTerminals(self, terminal_names, action):
+        """
+        Returns an array with the codes of the current states of the terminals, and has
+        action(indexes, terminal_name, new_state) called for the states received, indexes
+        being the (codes, index) of every place the terminal is used in the bank. A terminal
+        can be used any number of times, as the input of several contacts or breakers, but
+        not as both an input and an output.
+        """
+        codes = numpy.array([self.stateCode(self.parent_.terminals[terminal_name]['state']) for terminal_name in terminal_names], dtype=numpy.int16)
+        for index, terminal_name in enumerate(terminal_names):
+            watched = self.watched_terminals.get(terminal_name)
+            if watched is None:
+                watched = self.watched_terminals[terminal_name] = (action, [])
+                self.parent_.terminals[terminal_name]['action'] = partial(action, watched[1], terminal_name)
+            elif watched[0] != action:
+                raise ValueError('Terminal %s is both an input and an output of %s.' % (terminal_name, self.__class__.__name__))
+            watched[1].append((codes, index))
+        return codes
+
+    def receivedInputState(self, indexes, terminal_name, new_state):
+        self.parent_.terminals[terminal_name]['state'] = new_state
+        code = self.stateCode(new_state)
+        for codes, index in indexes:
+            codes[index] = code
+        if not self.evaluation_pending:
+            self.evaluation_pending = True
+            if not self.evaluating:
+                QtCore.QTimer.singleShot(0, self.evaluate)
+
+    def receivedOutputState(self, indexes, terminal_name, new_state):
+        # Whatever else drives the net, the state is not sent back.
+        self.parent_.terminals[terminal_name]['state'] = new_state
+        code = self.stateCode(new_state)
+        for codes, index in indexes:
+            codes[index] = code
+
+    def evaluate(self):
+        """
+        Pushes the outputs of the bank which changed. Outputs sharing a net of the client with
+        inputs of the bank change those inputs right away, and the bank is evaluated again
+        until it settles.
+        """
+        self.evaluating = True
+        try:
+            with self.parent_.batch():
+                self.evaluation_pending = True
+                pass_count = 0
+                while self.evaluation_pending:
+                    # Each pass settles at least one more output, unless the bank oscillates.
+                    if pass_count > len(self.output_codes):
+                        logger.warning('%s did not settle in %d passes.' % (self.__class__.__name__, pass_count))
+                        self.evaluation_pending = False
+                        break
+                    pass_count += 1
+                    self.evaluation_pending = False
+                    output_codes = self.evaluateOutputs()
+                    changed_indexes = numpy.flatnonzero(output_codes != self.output_codes)
+                    self.output_codes[changed_indexes] = output_codes[changed_indexes]
+                    for index in changed_indexes.tolist():
+                        self.parent_.pushTerminalState(self.output_terminal_names[index], self.state_names[output_codes[index]])
+        finally:
+            self.evaluating = False
+
+    def evaluateOutputs(self):
+        """
+        Returns the codes of the states of all outputs, as the inputs are now. Overridden by
+        the banks below, a bank without logic keeps its outputs as they are.
+        """
+        return self.output_codes.copy()
+
+
+class CircuitBreakerBank(ComponentBank):
+    """
+    Single phase circuit breakers, breaker i connecting input_terminal_names[i] to
+    output_terminal_names[i] while closed.
+    """
+
+    def __init__(self, parent, input_terminal_names, output_terminal_names, initially_closed=False):
+        super(CircuitBreakerBank, self).__init__(parent, output_terminal_names)
+        self.input_terminal_names = list(input_terminal_names)
+        self.input_codes = self.watchTerminals(self.input_terminal_names, self.receivedInputState)
+
+        # initially_closed is one position for all breakers, or one per breaker.
+        self.closed = numpy.zeros(len(self.input_terminal_names), dtype=bool)
+        self.closed[:] = initially_closed
+        self.evaluate()
+
+    def isClosed(self, index):
+        return bool(self.closed[index])
+
+    def setClosed(self, indexes, closed=True):
+        """
+        Closes, or opens, the breakers at indexes, an index, a sequence of them or a mask.
+        """
+        self.closed[indexes] = closed
+        self.evaluate()
+
+    def evaluateOutputs(self):
+        return numpy.where(self.closed, self.input_codes, 0)
+
+
+class RelayBank(ComponentBank):
+    """
+    Relays energized by the on state of their coil terminals, each with any number of
+    normally open or normally closed contacts.
+
+    contacts is a sequence of (relay index, input terminal name, output terminal name,
+    normally closed), the relay index being that of its coil in coil_terminal_names.
+    """
+
+    def __init__(self, parent, coil_terminal_names, contacts, zero_state=SASClient.ac_power_off_state):
+        contact_relays, input_terminal_names, output_terminal_names, normally_closed = zip(*contacts) if contacts else ((), (), (), ())
+        super(RelayBank, self).__init__(parent, output_terminal_names)
+
+        self.off_state = zero_state
+        if zero_state == SASClient.ac_power_off_state:
+            self.on_state = SASClient.ac_power_on_state
+        elif zero_state == SASClient.dc_power_off_state:
+            self.on_state = SASClient.dc_power_on_state
+        self.on_code = self.stateCode(self.on_state)
+
+        self.coil_terminal_names = list(coil_terminal_names)
+        self.coil_codes = self.watchTerminals(self.coil_terminal_names, self.receivedInputState)
+
+        self.input_terminal_names = list(input_terminal_names)
+        self.input_codes = self.watchTerminals(self.input_terminal_names, self.receivedInputState)
+        self.contact_relays = numpy.array(contact_relays, dtype=numpy.intp)
+        self.normally_closed = numpy.array(normally_closed, dtype=bool)
+        self.evaluate()
+
+    def isEnergized(self, index):
+        return bool(self.coil_codes[index] == self.on_code)
+
+    def evaluateOutputs(self):
+        # A contact conducts when its relay is energized, or when it is not for a normally closed one.
+        conducting = (self.coil_codes == self.on_code)[self.contact_relays] != self.normally_closed
+        return numpy.where(conducting, self.input_codes, 0)
@@ -0,0 +1,141 @@
+"""
+Framing of the SAS wire protocol.
+
+Protocol version 1 is plain text: colon separated, newline terminated lines.
+
+Protocol version 2 is negotiated by a client appending the highest version it
+speaks to its 'clientname:' message. A server that agrees answers with
+'protocol:2', and answers every 'registration:' with 'terminalids:' pairs of
+terminal name and integer ID. From then on state changes may be sent in both
+directions as fixed size binary records holding the terminal ID and a one byte
+state code. Everything else, and any state missing from the state table, is
+still sent as text lines.
+
+Protocol version 3 adds bulk state messages. A server answers a registration
+with a single 'states:' line of terminal name and state pairs, holding the
+initial states of all registered terminals which have one, instead of one
+state change per terminal. Version 3 servers also answer 'snapshot:own' and
+'snapshot:all' from any client with a 'snapshot:' line of pairs, holding the
+states of the requester's terminals or of all registered terminals.
+
+Protocol version 4 adds batched state changes. A client may send several state
+changes as one 'statechanges:' line of terminal name and state pairs, which the
+server applies as a whole: all terminals take their new states before any of
+them is pushed to its net, so no client sees the states in between.
+
+Protocol version 5 adds resumable sessions. The server answers the 'clientname:'
+message with 'session:TOKEN'. Both sides count the state changes they send and
+receive in the session, every pair of a bulk message counting as one. A client
+whose connection was lost sends 'resume:TOKEN:RECEIVED' on its new connection
+instead of registering again, RECEIVED being the number of state changes it has
+received. Within the server's grace period the terminals of the session are
+still registered, and the server answers 'resumed:RECEIVED', the number of state
+changes it has received, followed by a 'states:' line of the terminals whose
+last state the client missed. The client then sends the states the server
+missed. After the grace period the server answers 'expired:TOKEN', and the
+client registers as a new client. A client closing its connection for good
+sends 'endsession:' first, so the server unregisters its terminals as soon as
+the connection is closed instead of keeping them for the grace period.
+
+Protocol version 6 moves the routing within a client to the client. After every
+registration, connections reload and resumed session, the server sends a
+'localnets:' line with a comma separated group of terminal names for every net
+holding more than one terminal of the client. The client gives a state it
+pushes to the other terminals of the group itself, and the server, told about
+the change, only records their new states instead of sending them back.
+
+Any client may send 'subscribe:' and 'unsubscribe:' with terminal name patterns
+(see sas.subscriptions). The server then sends it a text line
+'monitor:client:terminal:state' for every state change of a matching terminal.
+
+'stats:all' is answered with 'stats:' followed by the server's metrics as JSON
+(see sas.metrics), which is the only message whose arguments may hold colons.
+"""
+
+import struct
+
+text_protocol_version = 1
+binary_protocol_version = 2
+bulk_protocol_version = 3
+batch_protocol_version = 4
+session_protocol_version = 5
+local_protocol_version = 6
+highest_protocol_version = local_protocol_version
+
+no_state = 'None'
+
+# One byte state codes. The table mirrors the state constants of SASClient2,
+# with no_state first. Codes are positional, so only ever append to it.
+state_table = (no_state, '230VAC', '0VAC', '48VDC', '0VDC', '12VDC', '5VDC')
+state_codes = {state: code for code, state in enumerate(state_table)}
+
+# A binary state change record: marker, terminal ID, state code. The marker byte
+# never occurs in UTF-8 encoded text, so records and text lines can be mixed on
+# the same stream.
+record_marker = 0xFF
+record_marker_byte = bytes((record_marker, ))
+record_struct = struct.Struct('>BIB')
+record_size = record_struct.size
+
+
+def negotiateProtocolVersion(offered_version):
+    return max(text_protocol_version, min(offered_version, highest_protocol_version))
+
+
+def packStateChange(terminal_id, state_code):
+    return record_struct.pack(record_marker, terminal_id, state_code)
+
+
+def packStates(command, states):
+    """
+    Returns a bulk message of (terminal_name, state) pairs, 'command:name:state:name:state...'.
+    """
+    return (command + ':' + ':'.join([terminal_name + ':' + state for terminal_name, state in states]) + '\n').encode()
+
+
+def unpackStates(entries):
+    """
+    Returns the (terminal_name, state) pairs of the split arguments of a bulk message.
+    """
+    return list(zip(entries[0::2], entries[1::2]))
+
+
+def splitFrames(buffer):
+    """
+    Removes all complete frames from the start of buffer (a bytearray) and
+    returns them in order. Text lines are returned as str, and binary records as
+    (record_marker, terminal_id, state_code) tuples. An incomplete trailing
+    frame is left in the buffer until the rest of it arrives.
+    """
+    frames = []
+    position = 0
+    length = len(buffer)
+
+    while position < length:
+        if buffer[position] == record_marker:
+            # Unpack the whole run of consecutive complete records at once. The
+            # run ends at the first record slot that does not start with a marker.
+            limit = position + (length - position) // record_size * record_size
+            markers = buffer[position:limit:record_size]
+            run_length = len(markers) - len(markers.lstrip(record_marker_byte))
+            if run_length == 0:
+                break
+            run_end = position + run_length * record_size
+            frames.extend(record_struct.iter_unpack(buffer[position:run_end]))
+            position = run_end
+        else:
+            marker = buffer.find(record_marker_byte, position)
+            if marker < 0:
+                # Text up to the end of the buffer, keep the partial last line.
+                end = buffer.rfind(b'\n', position)
+                if end >= 0:
+                    frames.extend(buffer[position:end].decode().split('\n'))
+                    position = end + 1
+                break
+            else:
+                # Text lines are always complete when followed by a record.
+                frames.extend(buffer[position:marker].rstrip(b'\n').decode().split('\n'))
+                position = marker
+
+    del buffer[:position]
+    return frames
@@ -0,0 +1,233 @@
+"""
+Replays a capture file (see sas.capture) against a fresh server, opening one
+client connection per captured session and sending the captured data on it at
+the recorded times, or as fast as possible:
+
+    python -m sas.replay capture.sascap connections.txt [--speed 10 | --fast]
+
+Without --port a server is started in this process, the asyncio one. With
+--port the capture is replayed against a server already running there, for
+example another version of SASServer2 started on the same connections file.
+
+When the capture is replayed, the terminal states of the server are compared
+with the states the capture leads to, computed by feeding it to a RoutingCore
+directly, and the throughput is reported.
+
+Binary state records hold the terminal IDs of the capturing server, which the
+replaying server assigns in the order it sees registrations and connections
+reloads, so they are sent as text state changes of the terminal they stood for
+instead. Everything else is sent as captured.
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+from . import protocol
+from .aioserver import SASAsyncServer
+from .capture import readCapture, data_event, close_event, terminal_event
+from .core import RoutingCore
+
+logger = logging.getLogger(__name__)
+
+
+class RecordTranslator(object):
+    """
+    Rewrites the binary state records in the data of captured sessions as text state
+    changes, using the terminal records of the capture to name the IDs they hold.
+    """
+
+    def __init__(self):
+        self.terminal_names = {}
+        # Session -> the start of a record cut off at the end of its last data.
+        self.partial_records = {}
+
+    def addTerminal(self, terminal_id, data):
+        self.terminal_names[terminal_id] = data.decode()
+
+    def translate(self, session, data):
+        data = self.partial_records.pop(session, b'') + data
+        # The record marker never occurs in UTF-8 text, so only records need to be found.
+        if protocol.record_marker_byte not in data:
+            return data
+
+        translated = bytearray()
+        position = 0
+        while True:
+            marker = data.find(protocol.record_marker_byte, position)
+            if marker < 0:
+                translated += data[position:]
+                break
+            translated += data[position:marker]
+            if len(data) - marker < protocol.record_size:
+                self.partial_records[session] = data[marker:]
+                break
+            _, terminal_id, state_code = protocol.record_struct.unpack_from(data, marker)
+            position = marker + protocol.record_size
+            if terminal_id in self.terminal_names and state_code < len(protocol.state_table):
+                translated += ('statechange:%s:%s\n' % (self.terminal_names[terminal_id], protocol.state_table[state_code])).encode()
+            else:
+                logger.warning('State record of session %d for unknown terminal %d.' % (session, terminal_id))
+                translated += data[marker:position]
+        return bytes(translated)
+
+
+def expectedStates(capture_path, connections_path):
+    """
+    Returns the terminal states at the end of the capture, by routing it without any sockets.
+    """
+    core = RoutingCore(connections_path)
+    # Replayed clients never resume their sessions, so they end with their connections.
+    core.session_grace_period = 0
+    translator = RecordTranslator()
+    socket_ids = {}
+    for _, event, session, data in readCapture(capture_path):
+        if event == terminal_event:
+            translator.addTerminal(session, data)
+            continue
+        if session not in socket_ids:
+            socket_ids[session] = core.addSocket(lambda data: None)
+        if event == data_event:
+            core.receiveData(socket_ids[session], translator.translate(session, data))
+        elif event == close_event:
+            core.removeSocket(socket_ids.pop(session))
+    return core.registeredTerminalStates()
+
+
+class ReplaySession(object):
+    """
+    A client connection of the replay. Everything the server sends is read and dropped,
+    except the answer to a snapshot request.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.receive_buffer = bytearray()
+        self.snapshots = asyncio.Queue()
+        self.read_task = asyncio.ensure_future(self.readMessages())
+
+    async def readMessages(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.receive_buffer.extend(data)
+            for frame in protocol.splitFrames(self.receive_buffer):
+                if frame.__class__ is str and frame.startswith('snapshot:'):
+                    self.snapshots.put_nowait(dict(protocol.unpackStates(frame.split(':')[1:])))
+
+    async def snapshot(self, all_terminals=False):
+        self.writer.write(('snapshot:' + ('all' if all_terminals else 'own') + '\n').encode())
+        return await self.snapshots.get()
+
+    async def close(self):
+        self.writer.close()
+        self.read_task.cancel()
+
+
+async def replay(capture_path, host, port, speed=1.0):
+    """
+    Replays the capture, speed times as fast as recorded or as fast as possible if speed
+    is None. Returns the terminal states of the server at the end, and replay statistics.
+    """
+    sessions = {}
+    statistics = {'sessions': 0, 'records': 0, 'bytes': 0}
+    translator = RecordTranslator()
+
+    start_time = time.monotonic()
+    for timestamp, event, session, data in readCapture(capture_path):
+        if event == terminal_event:
+            translator.addTerminal(session, data)
+            continue
+
+        if speed is not None:
+            delay = timestamp / speed - (time.monotonic() - start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if session not in sessions:
+            reader, writer = await asyncio.open_connection(host, port)
+            sessions[session] = ReplaySession(reader, writer)
+            statistics['sessions'] += 1
+
+        if event == data_event:
+            data = translator.translate(session, data)
+            sessions[session].writer.write(data)
+            await sessions[session].writer.drain()
+            statistics['bytes'] += len(data)
+        elif event == close_event:
+            await sessions.pop(session).close()
+        statistics['records'] += 1
+
+    # A snapshot is answered after everything sent before it on the same connection is
+    # handled, so asking every open session for one waits until the server is done.
+    for replay_session in sessions.values():
+        await replay_session.snapshot()
+    statistics['seconds'] = time.monotonic() - start_time
+
+    reader, writer = await asyncio.open_connection(host, port)
+    monitor = ReplaySession(reader, writer)
+    states = await monitor.snapshot(all_terminals=True)
+    await monitor.close()
+
+    for replay_session in sessions.values():
+        await replay_session.close()
+
+    return states, statistics
+
+
+async def replayLocally(capture_path, connections_path, speed):
+    server = SASAsyncServer(0, connections_path, host='127.0.0.1')
+    server.session_grace_period = 0
+    await server.start()
+    port = server.server.sockets[0].getsockname()[1]
+    try:
+        result = await replay(capture_path, '127.0.0.1', port, speed)
+
+        # Let the server see the sessions close before the event loop goes away.
+        for _ in range(100):
+            if not server.client_sockets:
+                break
+            await asyncio.sleep(0.01)
+        return result
+    finally:
+        server.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a traffic capture against a fresh server.')
+    parser.add_argument('capture_path')
+    parser.add_argument('connections_path', help='the connections file of the captured server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='replay against a server running on this port instead of starting one')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay this many times as fast as recorded')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    speed = None if args.fast else args.speed
+    if args.port is None:
+        states, statistics = asyncio.run(replayLocally(args.capture_path, args.connections_path, speed))
+    else:
+        states, statistics = asyncio.run(replay(args.capture_path, args.host, args.port, speed))
+
+    print('%d sessions, %d records, %d bytes in %.3f s (%.0f records/s, %.2f MB/s)' % (statistics['sessions'], statistics['records'], statistics['bytes'], statistics['seconds'],
+                                                                                     statistics['records'] / statistics['seconds'], statistics['bytes'] / statistics['seconds'] / 1e6))
+
+    expected = expectedStates(args.capture_path, args.connections_path)
+    mismatches = sorted(terminal_name for terminal_name in set(expected) | set(states) if expected.get(terminal_name) != states.get(terminal_name))
+    if mismatches:
+        for terminal_name in mismatches[:20]:
+            print('%s: expected %s, got %s' % (terminal_name, expected.get(terminal_name), states.get(terminal_name)))
+        sys.exit('%d of %d terminal states differ from the capture.' % (len(mismatches), len(expected)))
+
+    print('All %d terminal states match the capture.' % len(expected))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
 
-import random
-import string
+import os
 import logging
+from functools import partial
 
 from PySide2 import QtCore, QtNetwork
 
+from . import protocol
+from . import tracing
+from .core import HandleAllocator, RoutingCore
+from .tracing import tracer
+from .wiring import loadConnections
+
 logger = logging.getLogger(__name__)
 
 # logger.info('%s' % str)   
@@ -15,8 +21,8 @@ logger = logging.getLogger(__name__)
 
 class SASClientSocket(QtNetwork.QTcpSocket):
 
-    readyReadId = QtCore.Signal((str,))
-    disconnectedId = QtCore.Signal((str,))
+    readyReadId = QtCore.Signal((int,))
+    disconnectedId = QtCore.Signal((int,))
 
     def __init__(self, id, parent):
         super(SASClientSocket, self).__init__(parent)
@@ -25,6 +31,14 @@ class SASClientSocket(QtNetwork.QTcpSocket):
         whenever is emitted.
         """
         self.id = id
+
+        # Bytes received but not yet terminated by a newline.
+        self.receive_buffer = bytearray()
+
+        # Encoded messages waiting to be written by the next flush.
+        self.outbox = []
+        self.flush_count = 0
+        self.flushed_message_count = 0
         
         self.readyRead.connect(self.onReadyRead)
         self.disconnected.connect(self.onDisconnected)
@@ -43,6 +57,84 @@ class SASClientSocket(QtNetwork.QTcpSocket):
         """
         self.disconnectedId.emit(self.id)
 
+    def readLines(self):
+        """
+        Reads everything available on the socket and returns the complete
+        lines received so far. A trailing partial line is kept in the
+        receive buffer until the rest of it arrives.
+        """
+        self.receive_buffer.extend(self.readAll().data())
+
+        end = self.receive_buffer.rfind(b'\n')
+        if end < 0:
+            return []
+
+        complete_lines = self.receive_buffer[:end].decode()
+        del self.receive_buffer[:end + 1]
+
+        return complete_lines.split('\n')
+
+    def queueMessage(self, message):
+        """
+        Queues an encoded message. Nothing is written until flushMessages is called.
+        """
+        self.outbox.append(message)
+
+    def flushMessages(self):
+        """
+        Writes all queued messages with a single write, and returns the number of
+        messages that were merged into it.
+        """
+        merged_messages = len(self.outbox)
+        if merged_messages:
+            self.write(b''.join(self.outbox))
+            self.outbox = []
+            self.flush_count += 1
+            self.flushed_message_count += merged_messages
+        return merged_messages
+
+
+class SASMonitorBatcher(QtCore.QObject):
+    """
+    Collects terminal state changes for monitors and emits them as one list at
+    most once per interval (in milliseconds). Only the latest state of each
+    terminal is kept, older changes of a terminal still waiting are merged away.
+    """
+
+    changes_ready = QtCore.Signal(list)
+
+    def __init__(self, interval=100, parent=None):
+        super(SASMonitorBatcher, self).__init__(parent)
+
+        # terminal_name -> (client_name, terminal_name, new_state), in order of first change.
+        self.pending = {}
+        self.statistics = {'changes': 0, 'merged': 0, 'batches': 0}
+
+        self.emit_timer = QtCore.QTimer(self)
+        self.emit_timer.setSingleShot(True)
+        self.emit_timer.setInterval(interval)
+        self.emit_timer.timeout.connect(self.emitPending)
+
+    def setInterval(self, interval):
+        self.emit_timer.setInterval(interval)
+
+    def addChange(self, client_name, terminal_name, new_state):
+        self.statistics['changes'] += 1
+        if terminal_name in self.pending:
+            self.statistics['merged'] += 1
+        self.pending[terminal_name] = (client_name, terminal_name, new_state)
+
+        if not self.emit_timer.isActive():
+            self.emit_timer.start()
+
+    def emitPending(self):
+        self.emit_timer.stop()
+        if self.pending:
+            changes = list(self.pending.values())
+            self.pending = {}
+            self.statistics['batches'] += 1
+            self.changes_ready.emit(changes)
+
 
 class SASServer(QtNetwork.QTcpServer):
 
@@ -54,20 +146,41 @@ class SASServer(QtNetwork.QTcpServer):
     output_terminal_registered = QtCore.Signal(str, str, str, tuple)
     input_terminal_changed_state = QtCore.Signal(str, str, str)
     output_terminal_changed_state = QtCore.Signal(str, str, str)
+    # Batched (client_name, terminal_name, new_state) changes, see enableMonitorBatching.
+    terminals_changed_state = QtCore.Signal(list)
 
-    def __init__(self, server_port, connections_path, parent=None):
+    def __init__(self, server_port, connections_path, parent=None, max_write_latency=10):
         super(SASServer, self).__init__(parent)
 
         self.connections = {}
+        # Reverse index of self.connections: input terminal -> the output terminal driving it.
+        self.input_drivers = {}
 
         self.buildTerminalConnections(connections_path)
 
         self.server_port = server_port
 
         self.client_sockets = {}
+        self.socket_handles = HandleAllocator()
         self.registered_input_terminal_states = {}
         self.registered_output_terminal_states = {}
 
+        self.message_handlers = {'clientname': self.handleClientName,
+                                 'registration': self.handleRegistration,
+                                 'statechange': self.handleStateChange,
+                                 'snapshot': self.handleSnapshot}
+
+        # Outgoing messages are queued per socket and written once the current batch of incoming
+        # messages is handled, or at the latest max_write_latency milliseconds after being queued.
+        self.pending_socket_ids = set()
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(max_write_latency)
+        self.flush_timer.timeout.connect(self.flushSockets)
+        self.flush_statistics = {'flushes': 0, 'messages': 0, 'max_merged': 0}
+
+        self.monitor_batcher = None
+
         # Starts listening on selected port.
         started = self.listen(address = QtNetwork.QHostAddress.Any, port = self.server_port)
 
@@ -78,38 +191,49 @@ class SASServer(QtNetwork.QTcpServer):
 
 
     def buildTerminalConnections(self, connections_path):
-        try:
-            f = open(connections_path, 'r')
-        except FileNotFoundError:
+        # Parsed and validated entries, from the compiled file next to connections_path when it is up to date.
+        timings = {}
+        compiled_connections = loadConnections(connections_path, timings=timings)
+        if compiled_connections is None:
             logger.critical('%s does not exist. No connections registered.' % connections_path)
             return
 
-        entries = f.readlines()
-
         counter = 0
 
-        for entry in entries:
-            if entry.strip() and not entry.lstrip()[0] == '#':
+        for output_terminal, input_terminals in compiled_connections.entries():
+            self.connections[output_terminal] = input_terminals
+            counter += 1
 
-                if len(entry.split('->')) != 2:
-                    logger.warning('Malformed line in %s:\nLine: %s')
-                else:
-                    # No error check is done here!!!!!!!!
-                    s1, s2 = entry.split('->')
-                    
-                    output_terminal = s1.strip()
-                    
-                    input_terminals = []
-                    s2s = s2.split(',')
-                    for each in s2s:
-                        input_terminals.append(each.strip())
-
-                    self.connections[output_terminal] = tuple(input_terminals)
-
-                    counter += 1
+        self.buildInputDrivers()
         
-        logger.info('Successfully registered %d connections.' % counter)
+        logger.info('Successfully registered %d connections (%s).' % (counter, ', '.join('%s %.1f ms' % (step, seconds * 1000.0) for step, seconds in timings.items())))
+
+    def buildInputDrivers(self):
+        """
+        Indexes which output terminal drives each input terminal, so that the initial
+        state of a registering input terminal is found without scanning all outputs.
+        Whether a driver is currently registered is looked up in
+        registered_output_terminal_states, so the index stays valid as outputs come and go.
+        """
+        self.input_drivers = {}
+        for output_terminal, input_terminals in self.connections.items():
+            for input_terminal in input_terminals:
+                # This situation is quite allright if certain criterias is fulfilled, but for now we call this an abnormality and stops.
+                assert self.input_drivers.get(input_terminal, output_terminal) == output_terminal, 'Multiple output terminals (%s, %s) connected to the same input terminal %s.' % (self.input_drivers[input_terminal], output_terminal, input_terminal)
+                self.input_drivers[input_terminal] = output_terminal
+
 
+    def enableMonitorBatching(self, interval=100):
+        """
+        Starts emitting terminals_changed_state with the latest state of every input and
+        output terminal that changed, at most once per interval milliseconds.
+        """
+        if self.monitor_batcher is None:
+            self.monitor_batcher = SASMonitorBatcher(interval, self)
+            self.monitor_batcher.changes_ready.connect(self.terminals_changed_state)
+        else:
+            self.monitor_batcher.setInterval(interval)
+        return self.monitor_batcher
 
     def quit(self):
         pass
@@ -121,51 +245,82 @@ class SASServer(QtNetwork.QTcpServer):
             return ()
 
     def incomingConnection(self, socketDescriptor):
-        # Generates a random string in order to tell sockets apart, and make sure it's unique.
-        rand_id = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(3))
-        while rand_id in self.client_sockets.keys():
-            rand_id = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(3))
+        # Sockets are told apart by integer handles, reused once a socket is closed.
+        socket_id = self.socket_handles.allocate()
 
-        new_socket = SASClientSocket(rand_id, parent=self)
+        new_socket = SASClientSocket(socket_id, parent=self)
         new_socket.setSocketDescriptor(socketDescriptor)
         new_socket.readyReadId.connect(self.readSocket)
         new_socket.disconnectedId.connect(self.closeSocket)
 
-        self.client_sockets[rand_id] = {'socket': new_socket}
+        # The terminal sets index which terminals each socket owns, so they can be unregistered without scanning all terminals.
+        self.client_sockets[socket_id] = {'socket': new_socket, 'input_terminals': set(), 'output_terminals': set(), 'bulk_states': False}
 
-        logger.debug('New incoming connention: %s' % rand_id)
+        logger.debug('New incoming connention: %s' % socket_id)
 
 
     def readSocket(self, socket_id):
         ready_socket = self.client_sockets[socket_id]['socket']
-        
-        received_message = ready_socket.readAll().data().decode()
-        
-        lines = received_message.split('\n')
-
-        for line in lines:
-            entries = line.split(':')
-            if len(entries) > 1:
-                if entries[0] == 'clientname':
-                    client_name = entries[1]
-                    self.registerClientName(client_name, socket_id)
-
-                elif entries[0] == 'registration':
-                    terminal_type = entries[1]
-                    if terminal_type == 'inputs':
-                        input_terminals = entries[2:]
-                        self.registerInputTerminals(input_terminals, socket_id)
-                    elif terminal_type == 'outputs':
-                        output_terminals = entries[2:]
-                        self.registerOutputTerminals(output_terminals, socket_id)
-
-                elif entries[0] == 'statechange':
-                    terminal_name = entries[1]
-                    new_state = entries[2]
-                    self.registerOutputTerminalStateChange(terminal_name, new_state)
 
+        # Only complete lines are handed out, so a message split over several
+        # TCP segments is dispatched once the rest of it has arrived.
+        for line in ready_socket.readLines():
+            command, separator, arguments = line.partition(':')
+            if separator:
+                handler = self.message_handlers.get(command)
+                if handler is not None:
+                    handler(arguments.split(':'), socket_id)
                 else:
-                    raise Exception
+                    logger.warning('Unknown message from %s: %s' % (socket_id, line))
+
+        self.flushSockets()
+
+    def handleClientName(self, entries, socket_id):
+        client_name = entries[0]
+        self.registerClientName(client_name, socket_id)
+
+        # This server only speaks text, but sends the initial states of a registration in a single
+        # 'states:' message to clients offering protocol version 3 or newer. Nothing is answered.
+        if len(entries) > 1 and entries[1].isdigit():
+            self.client_sockets[socket_id]['bulk_states'] = int(entries[1]) >= protocol.bulk_protocol_version
+
+    def handleRegistration(self, entries, socket_id):
+        terminal_type = entries[0]
+        if terminal_type == 'inputs':
+            input_terminals = entries[1:]
+            self.registerInputTerminals(input_terminals, socket_id)
+        elif terminal_type == 'outputs':
+            output_terminals = entries[1:]
+            self.registerOutputTerminals(output_terminals, socket_id)
+
+    def handleStateChange(self, entries, socket_id):
+        if len(entries) < 2:
+            logger.warning('Malformed statechange from %s: %s' % (socket_id, ':'.join(entries)))
+            return
+        terminal_name = entries[0]
+        new_state = entries[1]
+        self.registerOutputTerminalStateChange(terminal_name, new_state)
+
+    def handleSnapshot(self, entries, socket_id):
+        # 'snapshot:all' for every registered terminal, anything else for the requester's own.
+        if entries[0] == 'all':
+            input_terminals = self.registered_input_terminal_states
+            output_terminals = self.registered_output_terminal_states
+        else:
+            input_terminals = self.client_sockets[socket_id]['input_terminals']
+            output_terminals = self.client_sockets[socket_id]['output_terminals']
+
+        # Input terminal states are not tracked here, they are the states of their drivers.
+        states = [(terminal_name, self.registered_output_terminal_states[terminal_name]['state']) for terminal_name in output_terminals]
+        for input_terminal_name in input_terminals:
+            output_terminal_name = self.input_drivers.get(input_terminal_name)
+            if output_terminal_name in self.registered_output_terminal_states:
+                states.append((input_terminal_name, self.registered_output_terminal_states[output_terminal_name]['state']))
+            else:
+                states.append((input_terminal_name, self.no_state))
+
+        self.queueSocketMessage(socket_id, protocol.packStates('snapshot', states))
+        logger.debug('Sent a snapshot of %d terminals to %s' % (len(states), socket_id))
 
 
     def registerClientName(self, name, socket_id):
@@ -174,64 +329,87 @@ class SASServer(QtNetwork.QTcpServer):
         logger.info('Client %s registered as %s.' % (socket_id, name))
     
     def registerInputTerminals(self, input_terminals, socket_id):
+        initial_states = []
         for input_terminal_name in input_terminals:
+            if input_terminal_name in self.registered_input_terminal_states:
+                previous_socket_id = self.registered_input_terminal_states[input_terminal_name]['socket_id']
+                self.client_sockets[previous_socket_id]['input_terminals'].discard(input_terminal_name)
+
             self.registered_input_terminal_states[input_terminal_name] = {'state': self.no_state, 'socket_id': socket_id}
+            self.client_sockets[socket_id]['input_terminals'].add(input_terminal_name)
             client_name = self.client_sockets[socket_id]['group']
             self.input_terminal_registered.emit(client_name, input_terminal_name, self.registered_input_terminal_states[input_terminal_name]['state'])
-            logger.debug('Client %s registered an input terminal: %s)' % (socket_id, input_terminal_name))
+            if tracer.enabled:
+                tracer.record(tracing.registered, input_terminal_name, self.no_state, client_name)
 
-            # Find all registered output terminals which are connected to terminal_name (should normally be only one), and get the 
-            # initial state from there!
-            connected_output_terminal_names = [output_terminal_name for output_terminal_name in self.registered_output_terminal_states if input_terminal_name in self.getOutputConnections(output_terminal_name)]
-            assert len(connected_output_terminal_names) <= 1, 'Multiple output terminals connected to the same input terminal.'
-            # This situation is quite allright if certain criterias is fulfilled, but for now we call this an abnormality and stops.
+            # Find the output terminal which drives input_terminal_name (there is at most one, this is checked
+            # when the connections are built), and get the initial state from there if it is registered!
+            connected_output_terminal_name = self.input_drivers.get(input_terminal_name)
 
             # Now we send distribute the initial state back to the client.
-            if len(connected_output_terminal_names) > 0:
-                connected_output_terminal_name = connected_output_terminal_names[0]
+            if connected_output_terminal_name in self.registered_output_terminal_states:
                 initial_state = self.registered_output_terminal_states[connected_output_terminal_name]['state']
-                self.remoteSendInputTerminalState(input_terminal_name, initial_state)
+                if self.client_sockets[socket_id]['bulk_states']:
+                    initial_states.append((input_terminal_name, initial_state))
+                    self.emitInputTerminalChangedState(input_terminal_name, initial_state)
+                else:
+                    self.remoteSendInputTerminalState(input_terminal_name, initial_state)
+
+        if initial_states:
+            self.queueSocketMessage(socket_id, protocol.packStates('states', initial_states))
+            logger.debug('Sent initial states of %d input terminals to %s' % (len(initial_states), socket_id))
 
     def registerOutputTerminals(self, output_terminals, socket_id):
         for terminal_name in output_terminals:
+            if terminal_name in self.registered_output_terminal_states:
+                previous_socket_id = self.registered_output_terminal_states[terminal_name]['socket_id']
+                self.client_sockets[previous_socket_id]['output_terminals'].discard(terminal_name)
+
             self.registered_output_terminal_states[terminal_name] = {'state': self.no_state, 'socket_id': socket_id}
+            self.client_sockets[socket_id]['output_terminals'].add(terminal_name)
             
             client_name = self.client_sockets[socket_id]['group']
             self.output_terminal_registered.emit(client_name, terminal_name, self.registered_output_terminal_states[terminal_name]['state'], self.getOutputConnections(terminal_name))
             
-            logger.debug('Client %s registered an output terminal: %s)' % (socket_id, terminal_name))
+            if tracer.enabled:
+                tracer.record(tracing.registered, terminal_name, self.no_state, client_name)
 
 
     def registerOutputTerminalStateChange(self, terminal_name, new_state):
-        old_state = self.registered_output_terminal_states[terminal_name]['state']
-
-        
         self.registered_output_terminal_states[terminal_name]['state'] = new_state
         
         socket_id = self.registered_output_terminal_states[terminal_name]['socket_id']
         client_name = self.client_sockets[socket_id]['group']
         self.output_terminal_changed_state.emit(client_name, terminal_name, new_state)
+        if self.monitor_batcher is not None:
+            self.monitor_batcher.addChange(client_name, terminal_name, new_state)
 
-        logger.debug('%s changed state from %s to %s' % (terminal_name, old_state, new_state))
+        if tracer.enabled:
+            tracer.record(tracing.changed_state, terminal_name, new_state, client_name)
 
         if terminal_name in self.connections:
             for affected_input_terminal in self.connections[terminal_name]:
                 self.remoteSendInputTerminalState(affected_input_terminal, new_state)
 
     def unRegisterTerminals(self, socket_id):
-        socket_id_registered_out_terminals = [out_terminal for out_terminal in self.registered_output_terminal_states if self.registered_output_terminal_states[out_terminal]['socket_id'] == socket_id]
-        socket_id_registered_in_terminals = [in_terminal for in_terminal in self.registered_input_terminal_states if self.registered_input_terminal_states[in_terminal]['socket_id'] == socket_id]
+        socket_id_registered_out_terminals = self.client_sockets[socket_id]['output_terminals']
+        socket_id_registered_in_terminals = self.client_sockets[socket_id]['input_terminals']
 
         for input_terminal in socket_id_registered_in_terminals:
             del self.registered_input_terminal_states[input_terminal]
-            logger.debug('Deregistered input terminal %s' % (input_terminal, ))
+            if tracer.enabled:
+                tracer.record(tracing.unregistered, input_terminal, self.no_state, socket_id)
 
         for output_terminal in socket_id_registered_out_terminals:
             self.registerOutputTerminalStateChange(output_terminal, self.no_state)
 
         for output_terminal in socket_id_registered_out_terminals:
             del self.registered_output_terminal_states[output_terminal]
-            logger.debug('Deregistered input terminal %s' % (output_terminal, ))
+            if tracer.enabled:
+                tracer.record(tracing.unregistered, output_terminal, self.no_state, socket_id)
+
+        socket_id_registered_in_terminals.clear()
+        socket_id_registered_out_terminals.clear()
 
         client_name = self.client_sockets[socket_id]['group']
         self.client_name_unregistered.emit(client_name)
@@ -242,14 +420,19 @@ class SASServer(QtNetwork.QTcpServer):
     def remoteSendInputTerminalState(self, input_terminal_name, new_state):
         if input_terminal_name in self.registered_input_terminal_states:
             socket_id = self.registered_input_terminal_states[input_terminal_name]['socket_id']
-            client_socket = self.client_sockets[socket_id]['socket']
             message = 'statechange:' + input_terminal_name + ':' + new_state + '\n'
-            client_socket.write(message.encode())
-            logger.debug('Sent statechange on %s (new state: %s) to %s' % (input_terminal_name, new_state, socket_id))
+            self.queueSocketMessage(socket_id, message.encode())
+            if tracer.enabled:
+                tracer.record(tracing.sent_state, input_terminal_name, new_state, socket_id)
 
-            socket_id = self.registered_input_terminal_states[input_terminal_name]['socket_id']
-            client_name = self.client_sockets[socket_id]['group']
-            self.input_terminal_changed_state.emit(client_name, input_terminal_name, new_state)
+            self.emitInputTerminalChangedState(input_terminal_name, new_state)
+
+    def emitInputTerminalChangedState(self, input_terminal_name, new_state):
+        socket_id = self.registered_input_terminal_states[input_terminal_name]['socket_id']
+        client_name = self.client_sockets[socket_id]['group']
+        self.input_terminal_changed_state.emit(client_name, input_terminal_name, new_state)
+        if self.monitor_batcher is not None:
+            self.monitor_batcher.addChange(client_name, input_terminal_name, new_state)
 
 
     def getClientSocketId(self, input_terminal_name):
@@ -260,32 +443,81 @@ class SASServer(QtNetwork.QTcpServer):
         self.client_sockets[socket_id]['socket'].abort()
         self.unRegisterTerminals(socket_id)
         del self.client_sockets[socket_id]
+        self.socket_handles.release(socket_id)
+        self.flushSockets()
         logger.debug('Connection %s closed' % socket_id)
 
+    def queueSocketMessage(self, socket_id, message):
+        self.client_sockets[socket_id]['socket'].queueMessage(message)
+        self.pending_socket_ids.add(socket_id)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
 
-class SASServer2(QtNetwork.QTcpServer):
-
-    no_state = 'None'
+    def flushSockets(self):
+        """
+        Writes the queued messages of every socket that has any, one write per socket.
+        """
+        self.flush_timer.stop()
+        for socket_id in self.pending_socket_ids:
+            if socket_id in self.client_sockets:
+                merged_messages = self.client_sockets[socket_id]['socket'].flushMessages()
+                if merged_messages:
+                    self.flush_statistics['flushes'] += 1
+                    self.flush_statistics['messages'] += merged_messages
+                    self.flush_statistics['max_merged'] = max(self.flush_statistics['max_merged'], merged_messages)
+        self.pending_socket_ids.clear()
+
+
+class SASServer2(QtNetwork.QTcpServer, RoutingCore):
+    """
+    A Qt adapter over RoutingCore, which does all the routing. This class only owns the
+    sockets, re-emits the core's events as signals and watches the connections file.
+    """
 
     client_name_registered = QtCore.Signal(str)
     client_name_unregistered = QtCore.Signal(str)
     terminal_registered = QtCore.Signal(str, str, str, tuple)
     terminal_unregistered = QtCore.Signal(str)
     terminal_changed_state = QtCore.Signal(str, str, str)
+    connections_reloaded = QtCore.Signal(int, int)
+    # The statisticsSummary of the core, see enableStatisticsReports.
+    statistics_reported = QtCore.Signal(dict)
+    # Batched (client_name, terminal_name, new_state) changes, see enableMonitorBatching.
+    terminals_changed_state = QtCore.Signal(list)
     
 
-    def __init__(self, server_port, connections_path, parent=None):
+    def __init__(self, server_port, connections_path, parent=None, max_write_latency=10, watch_connections=True, journal_path=None):
         super(SASServer2, self).__init__(parent)
+        RoutingCore.__init__(self, connections_path, journal_path)
 
-        self.connections = {}
+        self.server_port = server_port
 
-        self.buildTerminalConnections(connections_path)
+        self.sockets = {}
+
+        # Messages queued outside of a batch of incoming messages are written at the latest
+        # max_write_latency milliseconds after being queued.
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(max_write_latency)
+        self.flush_timer.timeout.connect(self.flushSockets)
+
+        # Edits of the connections file are applied while running. Editors tend to save in several
+        # steps, so the file is reloaded once it has been quiet for a moment.
+        self.reload_timer = QtCore.QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(200)
+        self.reload_timer.timeout.connect(self.onReloadTimeout)
+        if watch_connections:
+            self.connections_watcher = QtCore.QFileSystemWatcher(self)
+            self.connections_watcher.fileChanged.connect(self.onConnectionsFileChanged)
+            self.watchConnectionsFile()
+        else:
+            self.connections_watcher = None
 
-        self.server_port = server_port
+        self.monitor_batcher = None
 
-        self.client_sockets = {}
-        
-        self.registered_terminals = {}
+        self.statistics_timer = QtCore.QTimer(self)
+        self.statistics_timer.timeout.connect(self.reportStatistics)
 
         # Starts listening on selected port.
         started = self.listen(address = QtNetwork.QHostAddress.Any, port = self.server_port)
@@ -296,184 +528,91 @@ class SASServer2(QtNetwork.QTcpServer):
             logger.critical('Server could not bind to port %d' % self.server_port)
 
 
-    def buildTerminalConnections(self, connections_path):
-        try:
-            f = open(connections_path, 'r')
-        except FileNotFoundError:
-            logger.critical('%s does not exist. No connections registered.' % connections_path)
-            return
-
-        entries = f.readlines()
-
-        valid_entry_counter = 0
-        connection_counter = 0
-
-        for entry in entries:
-            if entry.strip() and not entry.lstrip()[0] == '#':
-
-                if len(entry.split('->')) != 2:
-                    logger.warning('Malformed line in %s:\nLine: %s')
-                else:
-                    # No error check is done here!!!!!!!!
-                    s1, s2 = entry.split('->')
-                    
-                    input_terminal = s1.strip()
-                    
-                    output_terminals = []
-                    s2s = s2.split(',')
-                    for each in s2s:
-                        output_terminals.append(each.strip())
-
-                    if input_terminal in self.connections:
-                        self.connections[input_terminal].extend(output_terminals)
-                    else:
-                        self.connections[input_terminal] = output_terminals
-
-                    for output_terminal in output_terminals:
-                        if output_terminal in self.connections:
-                            self.connections[output_terminal].append(input_terminal)
-                        else:
-                            self.connections[output_terminal] = [input_terminal]
-
-                    connection_counter += len(output_terminals)
-                    valid_entry_counter += 1
-        
-        logger.info('Successfully registered %d connections from %d entries.' % (connection_counter, valid_entry_counter))
-
-
-    def quit(self):
-        pass
-
-
-    def incomingConnection(self, socketDescriptor):
-        # Generates a random string in order to tell sockets apart, and make sure it's unique.
-        rand_id = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(3))
-        while rand_id in self.client_sockets.keys():
-            rand_id = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(3))
-
-        new_socket = SASClientSocket(rand_id, parent=self)
-        new_socket.setSocketDescriptor(socketDescriptor)
-        new_socket.readyReadId.connect(self.readSocket)
-        new_socket.disconnectedId.connect(self.closeSocket)
-
-        self.client_sockets[rand_id] = {'socket': new_socket, 'name': ''}
-
-        logger.debug('New incoming connention: %s' % rand_id)
-
-
-    def readSocket(self, socket_id):
-        ready_socket = self.client_sockets[socket_id]['socket']
-        
-        received_message = ready_socket.readAll().data().decode()
-        
-        lines = received_message.split('\n')
-
-        for line in lines:
-            entries = line.split(':')
-            if len(entries) > 1:
-                if entries[0] == 'clientname':
-                    client_name = entries[1]
-                    self.registerClientName(client_name, socket_id)
-
-                elif entries[0] == 'registration':
-                    terminals = entries[1:]
-                    self.registerTerminals(terminals, socket_id)
-
-                elif entries[0] == 'statechange':
-                    terminal_name = entries[1]
-                    new_state = entries[2]
-                    self.registerTerminalStateChange(terminal_name, new_state, socket_id)
-
-                else:
-                    raise Exception
-
-
-    def registerClientName(self, client_name, socket_id):
-        self.client_sockets[socket_id]['name'] = client_name
+    def onClientNameRegistered(self, client_name):
         self.client_name_registered.emit(client_name)
-        logger.info('Client with id %s registered as %s.' % (socket_id, client_name))
-    
-
 
-    def registerTerminals(self, terminals, socket_id):
-        for terminal_name in terminals:
-            self.registered_terminals[terminal_name] = {'state': self.no_state, 'socket_id': socket_id}
-
-            # Get all connected terminals here, and add them as a tuple to the emit below!
-            if terminal_name in self.connections:
-                connected_terminal_names = tuple(self.connections[terminal_name])
-            else:
-                connected_terminal_names = ()
-
-            client_name = self.client_sockets[socket_id]['name']
-            self.terminal_registered.emit(client_name, terminal_name, self.registered_terminals[terminal_name]['state'], connected_terminal_names)
-            logger.debug('Client %s registered a terminal: %s)' % (client_name, terminal_name))
+    def onClientNameUnregistered(self, client_name):
+        self.client_name_unregistered.emit(client_name)
 
-            # Hmmm.... Set state according to connected terminals here????? No, all logic at client side!
+    def onTerminalRegistered(self, client_name, terminal_name, state, connected_terminal_names):
+        self.terminal_registered.emit(client_name, terminal_name, state, connected_terminal_names)
 
+    def onTerminalChangedState(self, client_name, terminal_name, new_state):
+        self.terminal_changed_state.emit(client_name, terminal_name, new_state)
+        if self.monitor_batcher is not None:
+            self.monitor_batcher.addChange(client_name, terminal_name, new_state)
 
-    def registerTerminalStateChange(self, terminal_name, new_state, socket_id):
+    def onConnectionsReloaded(self, added_connections, removed_connections):
+        self.connections_reloaded.emit(added_connections, removed_connections)
 
-        assert terminal_name in self.registered_terminals, 'Tried to register a statechange on %s, but this terminal is not registered at the server.' % terminal_name
+    def onFlushRequested(self):
+        self.flush_timer.start()
 
-        old_state = self.registered_terminals[terminal_name]['state']
+    def onSessionDetached(self, session_token, expiry_time):
+        QtCore.QTimer.singleShot(int(self.session_grace_period * 1000), partial(self.expireSession, session_token, expiry_time))
 
-        # Set new state
-        self.registered_terminals[terminal_name]['state'] = new_state
 
-        client_name = self.client_sockets[socket_id]['name']
+    def enableMonitorBatching(self, interval=100):
+        """
+        Starts emitting terminals_changed_state with the latest state of every terminal
+        that changed, at most once per interval milliseconds. Meant for monitors that
+        can not keep up with terminal_changed_state, which is still emitted for every change.
+        """
+        if self.monitor_batcher is None:
+            self.monitor_batcher = SASMonitorBatcher(interval, self)
+            self.monitor_batcher.changes_ready.connect(self.terminals_changed_state)
+        else:
+            self.monitor_batcher.setInterval(interval)
+        return self.monitor_batcher
 
-        self.terminal_changed_state.emit(client_name, terminal_name, new_state)
 
-        logger.debug('%s changed state from %s to %s' % (terminal_name, old_state, new_state))
+    def enableStatisticsReports(self, interval=1000):
+        """
+        Starts emitting statistics_reported with the server's metrics every interval milliseconds.
+        """
+        self.statistics_timer.start(interval)
 
-        # Send new state to all connected terminals, but only if the connected terminal has a
-        # different state (that is if both states are no_state, no_state should always be
-        # propagated - NOOOOOOOOOOOO. Perhaps a 'question state' is necessary. To check which is the first
-        # source in the path of the question).
-        if terminal_name in self.connections:
-            for connected_terminal in self.connections[terminal_name]:
-                if self.registered_terminals[connected_terminal]['state'] != new_state or self.registered_terminals[connected_terminal]['state'] == self.no_state:
-                    self.remoteSendTerminalState(connected_terminal, new_state)
+    def reportStatistics(self):
+        self.statistics_reported.emit(self.statisticsSummary())
 
 
-    def unRegisterTerminals(self, socket_id):
-        socket_id_registered_terminals = [terminal for terminal in self.registered_terminals if self.registered_terminals[terminal]['socket_id'] == socket_id]
+    def watchConnectionsFile(self):
+        # Saving by replacing the file drops it from the watcher, so it is added again after every change.
+        if self.connections_path not in self.connections_watcher.files() and os.path.exists(self.connections_path):
+            self.connections_watcher.addPath(self.connections_path)
 
-        for terminal_name in socket_id_registered_terminals:
-            self.registerTerminalStateChange(terminal_name, self.no_state, socket_id)
+    def onConnectionsFileChanged(self, path):
+        self.reload_timer.start()
 
-        for terminal_name in socket_id_registered_terminals:
-            del self.registered_terminals[terminal_name]
-            logger.debug('Unregistered terminal %s' % (terminal_name, ))
+    def onReloadTimeout(self):
+        self.watchConnectionsFile()
+        self.reloadTerminalConnections()
 
-        client_name = self.client_sockets[socket_id]['name']
-        self.client_name_unregistered.emit(client_name)
 
+    def quit(self):
+        self.flushSockets()
+        self.stopCapture()
+        self.closeJournal()
 
-    def remoteSendTerminalState(self, terminal_name, new_state):
-        if terminal_name in self.registered_terminals:
-            if self.getTerminalState(terminal_name) != new_state:
-                socket_id = self.registered_terminals[terminal_name]['socket_id']
-                client_socket = self.client_sockets[socket_id]['socket']
-                client_name = self.client_sockets[socket_id]['name']
-                message = 'statechange:' + terminal_name + ':' + new_state + '\n'
-                client_socket.write(message.encode())
-                logger.debug('Sent statechange on %s (new state: %s) to %s' % (terminal_name, new_state, client_name))
 
-            # self.terminal_changed_state.emit(client_name, terminal_name, new_state)
+    def incomingConnection(self, socketDescriptor):
+        new_socket = SASClientSocket(None, parent=self)
+        new_socket.setSocketDescriptor(socketDescriptor)
+        new_socket.id = self.addSocket(new_socket.write)
+        new_socket.readyReadId.connect(self.readSocket)
+        new_socket.disconnectedId.connect(self.closeSocket)
 
+        self.sockets[new_socket.id] = new_socket
 
-    def getClientSocketId(self, terminal_name):
-        return self.registered_input_terminal_states[terminal_name]['socket_id']
 
-    def getTerminalState(self, terminal_name):
-        return self.registered_terminals[terminal_name]['state']
+    def readSocket(self, socket_id):
+        self.receiveData(socket_id, self.sockets[socket_id].readAll().data())
 
 
     def closeSocket(self, socket_id):
-        self.client_sockets[socket_id]['socket'].abort()
-        self.unRegisterTerminals(socket_id)
-        del self.client_sockets[socket_id]
-        logger.debug('Connection %s closed' % socket_id)
+        self.sockets.pop(socket_id).abort()
+        self.removeSocket(socket_id)
 
+    def flushSockets(self):
+        self.flush_timer.stop()
+        RoutingCore.flushSockets(self)
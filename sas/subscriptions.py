@@ -0,0 +1,106 @@
+"""
+Terminal name pattern subscriptions for remote monitors, kept free of Qt.
+
+A pattern is either a terminal name, or a prefix followed by '*', which matches
+every terminal starting with the prefix. A lone '*' matches every terminal.
+
+Prefix patterns are kept in a trie with one node per character, so finding the
+subscribers of a terminal takes one step per character of its name, however
+many patterns there are. The result is cached per terminal name until the
+subscriptions change.
+"""
+
+wildcard = '*'
+
+
+class SubscriptionIndex(object):
+
+    def __init__(self):
+        # terminal name -> set of subscribers
+        self.exact = {}
+
+        # Trie of prefix patterns. Every node is a dict of character -> child node, and the
+        # subscribers of the prefix ending at the node are kept under the None key.
+        self.prefixes = {}
+
+        # subscriber -> set of patterns, to remove all of them when the subscriber goes away.
+        self.patterns = {}
+
+        self.cache = {}
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def isValidPattern(self, pattern):
+        # The wildcard may only end a pattern.
+        return bool(pattern) and wildcard not in pattern[:-1]
+
+    def subscribe(self, subscriber, pattern):
+        if pattern.endswith(wildcard):
+            node = self.prefixes
+            for character in pattern[:-1]:
+                node = node.setdefault(character, {})
+            node.setdefault(None, set()).add(subscriber)
+        else:
+            self.exact.setdefault(pattern, set()).add(subscriber)
+
+        self.patterns.setdefault(subscriber, set()).add(pattern)
+        self.cache = {}
+
+    def unsubscribe(self, subscriber, pattern):
+        subscriber_patterns = self.patterns.get(subscriber)
+        if subscriber_patterns is None or pattern not in subscriber_patterns:
+            return
+
+        if pattern.endswith(wildcard):
+            # Walk down to the node of the prefix, then prune the nodes left empty on the way back up.
+            prefix = pattern[:-1]
+            path = [self.prefixes]
+            for character in prefix:
+                path.append(path[-1][character])
+            subscribers = path[-1][None]
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del path[-1][None]
+            for depth in range(len(prefix), 0, -1):
+                if path[depth]:
+                    break
+                del path[depth - 1][prefix[depth - 1]]
+        else:
+            subscribers = self.exact[pattern]
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.exact[pattern]
+
+        subscriber_patterns.discard(pattern)
+        if not subscriber_patterns:
+            del self.patterns[subscriber]
+        self.cache = {}
+
+    def removeSubscriber(self, subscriber):
+        for pattern in list(self.patterns.get(subscriber, ())):
+            self.unsubscribe(subscriber, pattern)
+
+    def match(self, terminal_name):
+        """
+        Returns the set of subscribers with a pattern matching terminal_name.
+        """
+        subscribers = self.cache.get(terminal_name)
+        if subscribers is not None:
+            return subscribers
+
+        subscribers = set(self.exact.get(terminal_name, ()))
+        node = self.prefixes
+        for character in terminal_name:
+            if None in node:
+                subscribers.update(node[None])
+            node = node.get(character)
+            if node is None:
+                break
+        else:
+            if None in node:
+                subscribers.update(node[None])
+
+        subscribers = frozenset(subscribers)
+        self.cache[terminal_name] = subscribers
+        return subscribers
@@ -0,0 +1,81 @@
+"""
+Tracing of the routing hot paths into an in-memory ring buffer.
+
+The servers and clients record an event for every terminal they register,
+every state change and every state sent or received. Recording only appends a
+tuple of references to a bounded deque; nothing is formatted until the buffer
+is dumped, so tracing can stay on in production and the last events are there
+for a post-mortem. When disabled, which is the default, every trace point
+costs one attribute test:
+
+    if tracer.enabled:
+        tracer.record(tracing.sent_state, terminal_name, new_state, client_name)
+
+Tracing is switched at runtime with tracer.enable() and tracer.disable().
+"""
+
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Event codes, and how they read in a dump.
+registered = 1
+unregistered = 2
+changed_state = 3
+sent_state = 4
+received_state = 5
+pushed_state = 6
+monitored_state = 7
+
+event_names = {registered: 'registered',
+               unregistered: 'unregistered',
+               changed_state: 'changed state',
+               sent_state: 'sent state',
+               received_state: 'received state',
+               pushed_state: 'pushed state',
+               monitored_state: 'monitored state'}
+
+
+class TraceBuffer(object):
+
+    def __init__(self, size=65536):
+        self.enabled = False
+        # (time, event, terminal name, state, peer) records, the oldest are dropped when full.
+        self.records = collections.deque(maxlen=size)
+
+    def enable(self, size=None):
+        if size is not None and size != self.records.maxlen:
+            self.records = collections.deque(self.records, maxlen=size)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.records.clear()
+
+    def record(self, event, terminal_name, state, peer=''):
+        self.records.append((time.time(), event, terminal_name, state, peer))
+
+    def format(self):
+        """
+        Returns the buffered events as lines of text, oldest first.
+        """
+        lines = []
+        for timestamp, event, terminal_name, state, peer in list(self.records):
+            lines.append('%s.%06d %-15s %s %s %s' % (time.strftime('%H:%M:%S', time.localtime(timestamp)), int(timestamp % 1 * 1e6),
+                                                     event_names.get(event, event), terminal_name, state, peer))
+        return lines
+
+    def dump(self):
+        """
+        Writes the buffered events to the log.
+        """
+        lines = self.format()
+        logger.info('Trace of the last %d events:\n%s' % (len(lines), '\n'.join(lines)))
+
+
+# The trace buffer shared by all servers and clients of the process.
+tracer = TraceBuffer()
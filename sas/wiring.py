@@ -0,0 +1,313 @@
+"""
+Wiring helpers for the servers, kept free of Qt so they can be used offline.
+
+A connections file has one entry per line, 'terminal -> terminal, terminal, ...'.
+Empty lines and lines starting with '#' are ignored.
+
+Parsing a large file on every server start is slow, so the parsed entries are
+compiled into a binary file next to it (the same path with '.compiled'
+appended). It holds the interned terminal names, the entries as arrays of name
+indices, and the precomputed nets. It is reused as long as the connections
+file is unchanged, which is checked by size and modification time first and by
+content hash second.
+
+Running this module reports the parse, compile and load timings of a file:
+
+    python -m sas.wiring connections.txt
+"""
+
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+from array import array
+
+logger = logging.getLogger(__name__)
+
+compiled_suffix = '.compiled'
+
+# Header of a compiled file: magic, byte order, source size, source mtime (ns), source sha1,
+# number of terminal names, number of entries, number of targets, size of the name blob.
+# The header is followed by the entry_sources, entry_ends, entry_targets and terminal_nets
+# arrays (4 byte unsigned integers each) and the newline separated terminal names.
+compiled_magic = b'SASWIRE1'
+compiled_header = struct.Struct('<8sB3xQQ20sIIII')
+
+
+class CompiledConnections(object):
+    """
+    The entries of a connections file with interned terminal names. Entry i
+    joins terminal_names[entry_sources[i]] to the terminals indexed by
+    entry_targets[entry_ends[i - 1]:entry_ends[i]]. terminal_nets holds the
+    index of the root terminal of each terminal's net.
+    """
+
+    def __init__(self, terminal_names, entry_sources, entry_ends, entry_targets, terminal_nets):
+        self.terminal_names = terminal_names
+        self.entry_sources = entry_sources
+        self.entry_ends = entry_ends
+        self.entry_targets = entry_targets
+        self.terminal_nets = terminal_nets
+
+    def entries(self):
+        """
+        Yields the entries in file order, as (terminal, connected terminals) tuples.
+        """
+        terminal_names = self.terminal_names
+        entry_targets = self.entry_targets
+        start = 0
+        for source, end in zip(self.entry_sources, self.entry_ends):
+            yield terminal_names[source], tuple([terminal_names[target] for target in entry_targets[start:end]])
+            start = end
+
+    def entryCount(self):
+        return len(self.entry_sources)
+
+    def connectionCount(self):
+        return len(self.entry_targets)
+
+    def terminalNets(self):
+        terminal_names = self.terminal_names
+        return {terminal_name: terminal_names[root] for terminal_name, root in zip(terminal_names, self.terminal_nets)}
+
+    def netMembers(self):
+        terminal_names = self.terminal_names
+        members = {}
+        for terminal_name, root in zip(terminal_names, self.terminal_nets):
+            members.setdefault(terminal_names[root], []).append(terminal_name)
+        return {net: tuple(net_terminal_names) for net, net_terminal_names in members.items()}
+
+
+def parseConnections(text, connections_path=''):
+    """
+    Parses the text of a connections file into a list of (terminal, connected
+    terminals) entries. Malformed lines are logged with their line number and
+    skipped.
+    """
+    entries = []
+
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+
+        parts = line.split('->')
+        if len(parts) != 2:
+            logger.warning('Malformed line %d in %s: %s' % (line_number, connections_path, line))
+            continue
+
+        terminal_name = parts[0].strip()
+        connected_terminal_names = tuple([each.strip() for each in parts[1].split(',')])
+
+        # Terminal names travel in colon separated messages, so they can not contain colons.
+        if not terminal_name or ':' in terminal_name or any(not each or ':' in each for each in connected_terminal_names):
+            logger.warning('Malformed terminal name on line %d in %s: %s' % (line_number, connections_path, line))
+            continue
+
+        entries.append((terminal_name, connected_terminal_names))
+
+    return entries
+
+
+def compileConnections(entries):
+    terminal_indices = {}
+    terminal_names = []
+
+    def intern(terminal_name):
+        index = terminal_indices.get(terminal_name)
+        if index is None:
+            index = terminal_indices[terminal_name] = len(terminal_names)
+            terminal_names.append(terminal_name)
+        return index
+
+    entry_sources = array('I')
+    entry_ends = array('I')
+    entry_targets = array('I')
+
+    for terminal_name, connected_terminal_names in entries:
+        entry_sources.append(intern(terminal_name))
+        entry_targets.extend([intern(connected_terminal_name) for connected_terminal_name in connected_terminal_names])
+        entry_ends.append(len(entry_targets))
+
+    # Terminals joined by a connection, directly or through other terminals, end up in the
+    # same net. This is a union-find (path halving) on name indices in plain lists, so
+    # joining all connections of a file is close to linear in the number of connections.
+    parents = list(range(len(terminal_names)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    start = 0
+    for source, end in zip(entry_sources, entry_ends):
+        source_root = find(source)
+        for target in entry_targets[start:end]:
+            target_root = find(target)
+            if target_root != source_root:
+                # Keep the lower index as root, so nets are named after their first terminal in the file.
+                if target_root < source_root:
+                    source_root, target_root = target_root, source_root
+                parents[target_root] = source_root
+        start = end
+
+    terminal_nets = array('I', [find(index) for index in range(len(terminal_names))])
+
+    return CompiledConnections(terminal_names, entry_sources, entry_ends, entry_targets, terminal_nets)
+
+
+def saveCompiledConnections(compiled_connections, compiled_path, source_stat, source_digest):
+    names_blob = '\n'.join(compiled_connections.terminal_names).encode()
+    header = compiled_header.pack(compiled_magic, sys.byteorder == 'little', source_stat.st_size, source_stat.st_mtime_ns, source_digest,
+                                  len(compiled_connections.terminal_names), compiled_connections.entryCount(),
+                                  compiled_connections.connectionCount(), len(names_blob))
+
+    # Written to a temporary file first, so a server starting meanwhile never reads half a file.
+    temporary_path = compiled_path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(header)
+        compiled_connections.entry_sources.tofile(f)
+        compiled_connections.entry_ends.tofile(f)
+        compiled_connections.entry_targets.tofile(f)
+        compiled_connections.terminal_nets.tofile(f)
+        f.write(names_blob)
+    os.replace(temporary_path, compiled_path)
+
+
+def readCompiledHeader(compiled_path):
+    """
+    Returns the header fields of a compiled file, or None if there is no usable one.
+    """
+    try:
+        with open(compiled_path, 'rb') as f:
+            data = f.read(compiled_header.size)
+    except OSError:
+        return None
+
+    if len(data) != compiled_header.size:
+        return None
+
+    fields = compiled_header.unpack(data)
+    if fields[0] != compiled_magic or fields[1] != (sys.byteorder == 'little'):
+        return None
+    return fields
+
+
+def loadCompiledConnections(compiled_path):
+    with open(compiled_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            _, _, _, _, _, name_count, entry_count, connection_count, names_size = compiled_header.unpack_from(mapped)
+
+            view = memoryview(mapped)
+            position = compiled_header.size
+            arrays = []
+            for count in (entry_count, entry_count, connection_count, name_count):
+                values = array('I')
+                values.frombytes(view[position:position + count * values.itemsize])
+                position += count * values.itemsize
+                arrays.append(values)
+            names_blob = bytes(view[position:position + names_size])
+            view.release()
+
+    terminal_names = names_blob.decode().split('\n') if name_count else []
+    entry_sources, entry_ends, entry_targets, terminal_nets = arrays
+
+    return CompiledConnections(terminal_names, entry_sources, entry_ends, entry_targets, terminal_nets)
+
+
+def loadConnections(connections_path, use_compiled=True, timings=None):
+    """
+    Returns the CompiledConnections of a connections file, or None if the file
+    does not exist. The compiled file next to it is used when it is up to date,
+    and written otherwise. If a dict is passed as timings, the time spent in
+    each step is stored in it, in seconds.
+    """
+    if timings is None:
+        timings = {}
+
+    try:
+        source_stat = os.stat(connections_path)
+    except FileNotFoundError:
+        return None
+
+    compiled_path = connections_path + compiled_suffix
+    header = readCompiledHeader(compiled_path) if use_compiled else None
+
+    if header is not None and header[2] == source_stat.st_size and header[3] == source_stat.st_mtime_ns:
+        start = time.perf_counter()
+        compiled_connections = loadCompiledConnections(compiled_path)
+        timings['load'] = time.perf_counter() - start
+        return compiled_connections
+
+    # An editor saving by renaming a new file over the old one may have removed it since.
+    try:
+        with open(connections_path, 'rb') as f:
+            source = f.read()
+    except FileNotFoundError:
+        return None
+    source_digest = hashlib.sha1(source).digest()
+
+    # Touched, but not changed.
+    if header is not None and header[4] == source_digest:
+        start = time.perf_counter()
+        compiled_connections = loadCompiledConnections(compiled_path)
+        timings['load'] = time.perf_counter() - start
+        return compiled_connections
+
+    start = time.perf_counter()
+    entries = parseConnections(source.decode(), connections_path)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled_connections = compileConnections(entries)
+    timings['compile'] = time.perf_counter() - start
+
+    if use_compiled:
+        start = time.perf_counter()
+        try:
+            saveCompiledConnections(compiled_connections, compiled_path, source_stat, source_digest)
+        except OSError as error:
+            logger.warning('Could not save compiled connections to %s: %s' % (compiled_path, error))
+        timings['save'] = time.perf_counter() - start
+
+    return compiled_connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compiles a connections file and reports parse, compile and load timings.')
+    parser.add_argument('connections_path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    timings = {}
+    compiled_connections = loadConnections(args.connections_path, use_compiled=False, timings=timings)
+    if compiled_connections is None:
+        sys.exit('%s does not exist.' % args.connections_path)
+
+    start = time.perf_counter()
+    compiled_path = args.connections_path + compiled_suffix
+    source_stat = os.stat(args.connections_path)
+    with open(args.connections_path, 'rb') as f:
+        source_digest = hashlib.sha1(f.read()).digest()
+    saveCompiledConnections(compiled_connections, compiled_path, source_stat, source_digest)
+    timings['save'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    loadConnections(args.connections_path, timings=timings)
+    timings['cached start'] = time.perf_counter() - start
+
+    print('%d terminals, %d entries, %d connections, %d nets' % (len(compiled_connections.terminal_names), compiled_connections.entryCount(),
+                                                                 compiled_connections.connectionCount(), len(set(compiled_connections.terminal_nets))))
+    for step in ('parse', 'compile', 'save', 'load', 'cached start'):
+        print('%-13s %9.2f ms' % (step, timings[step] * 1000.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,4 +9,5 @@ setup(name='sas',
     license='GPL',
     packages = ['sas'],
     #py_modules = ['sasclient', 'sasserver'],
+    entry_points={'console_scripts': ['sas-server = sas.aioserver:main', 'sas-replay = sas.replay:main']},
     zip_safe=False)
\ No newline at end of file
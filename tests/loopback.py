@@ -0,0 +1,114 @@
+"""
+An in-memory network of a RoutingCore and ClientCores for the tests.
+
+Data written by either side is queued and only delivered by pump(), so, as with
+real sockets, nothing is handled from within the handler that sent it.
+"""
+
+import collections
+import os
+import tempfile
+import unittest
+
+from sas.core import RoutingCore, ClientCore
+
+
+class LoopbackNetwork(object):
+
+    def __init__(self, connections_path, journal_path=None):
+        self.core = RoutingCore(connections_path, journal_path)
+        # Everything written by either side, as (deliver, arguments), in order.
+        self.queue = collections.deque()
+
+    def pump(self):
+        while self.queue:
+            deliver, arguments = self.queue.popleft()
+            deliver(*arguments)
+
+    def addSocket(self, receive):
+        """
+        Adds a socket whose data from the server is given to receive, and returns its id.
+        """
+        return self.core.addSocket(lambda data: self.queue.append((receive, (data, ))))
+
+    def send(self, socket_id, data):
+        self.queue.append((self.core.receiveData, (socket_id, data)))
+
+
+class LoopbackClient(ClientCore):
+
+    def __init__(self, network, client_name, terminal_names):
+        super(LoopbackClient, self).__init__(self.transmit)
+        self.network = network
+        self.socket_id = None
+        self.setClientName(client_name)
+        for terminal_name in terminal_names:
+            self.registerTerminal(terminal_name)
+
+        # Everything sent and received, the (terminal name, state) pairs received and the (client name,
+        # terminal name, state) changes of monitored terminals, in order.
+        self.sent_data = []
+        self.received_data = []
+        self.received_states = []
+        self.monitored_states = []
+
+    def connect(self):
+        self.socket_id = self.network.addSocket(self.receiveData)
+        self.connectedToServer()
+
+    def disconnect(self):
+        # Whatever is in flight is delivered first, as a clean close of a TCP connection would.
+        self.network.pump()
+        self.network.core.removeSocket(self.socket_id)
+        self.disconnectedFromServer()
+        self.socket_id = None
+        self.network.pump()
+
+    def transmit(self, data):
+        self.sent_data.append(data)
+        self.network.send(self.socket_id, data)
+
+    def receiveData(self, data):
+        self.received_data.append(data)
+        super(LoopbackClient, self).receiveData(data)
+
+    def receivedTerminalState(self, terminal_name, new_state):
+        self.received_states.append((terminal_name, new_state))
+        super(LoopbackClient, self).receivedTerminalState(terminal_name, new_state)
+
+    def receivedMonitorState(self, client_name, terminal_name, new_state):
+        self.monitored_states.append((client_name, terminal_name, new_state))
+        super(LoopbackClient, self).receivedMonitorState(client_name, terminal_name, new_state)
+
+    def states(self, terminal_names=None):
+        return {terminal_name: self.getTerminalState(terminal_name) for terminal_name in (terminal_names or self.terminals)}
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """
+    Gives every test a temporary directory for its connections and journal files.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def writeConnections(self, text, name='connections.txt'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def network(self, connections, journal_path=None):
+        network = LoopbackNetwork(self.writeConnections(connections), journal_path)
+        self.addCleanup(network.core.closeJournal)
+        return network
+
+    def client(self, network, client_name, terminal_names, protocol_version=None):
+        client = LoopbackClient(network, client_name, terminal_names)
+        if protocol_version is not None:
+            client.protocol_version = protocol_version
+        client.connect()
+        network.pump()
+        return client
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from sas import protocol
+from sas.aioserver import SASAsyncServer
+
+
+class AsyncClient(object):
+    """
+    A client of the server on a real socket, which keeps the frames it received.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.receive_buffer = bytearray()
+        self.frames = []
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def receive(self, frame_count):
+        # Waits for frame_count frames in all, and returns them.
+        while len(self.frames) < frame_count:
+            data = await asyncio.wait_for(self.reader.read(65536), 5.0)
+            if not data:
+                break
+            self.receive_buffer.extend(data)
+            self.frames.extend(protocol.splitFrames(self.receive_buffer))
+        return self.frames
+
+
+class AsyncServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        connections_path = os.path.join(directory.name, 'connections.txt')
+        with open(connections_path, 'w') as f:
+            f.write('A -> B\nB -> C\n')
+
+        self.server = SASAsyncServer(0, connections_path, host='127.0.0.1')
+        await self.server.start()
+        self.port = self.server.server.sockets[0].getsockname()[1]
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            client.writer.close()
+        self.server.quit()
+        await self.server.server.wait_closed()
+
+    async def client(self, client_name, terminal_names, protocol_version=None):
+        client = AsyncClient(*await asyncio.open_connection('127.0.0.1', self.port))
+        self.clients.append(client)
+        if protocol_version is None:
+            await client.send(('clientname:%s\n' % client_name).encode())
+        else:
+            await client.send(('clientname:%s:%d\n' % (client_name, protocol_version)).encode())
+        await client.send(('registration:%s\n' % ':'.join(terminal_names)).encode())
+        await self.settle()
+        return client
+
+    async def settle(self):
+        # The server runs on the same event loop, and handles what it was sent while this sleeps.
+        await asyncio.sleep(0.05)
+
+    async def testStateReachesTheNet(self):
+        source = await self.client('source', ['A'])
+        sink = await self.client('sink', ['C'])
+
+        await source.send(b'statechange:A:230VAC\n')
+        self.assertEqual(await sink.receive(1), ['statechange:C:230VAC'])
+        self.assertEqual(self.server.getTerminalState('C'), '230VAC')
+
+    async def testMessagesSplitOverWrites(self):
+        source = await self.client('source', ['A'])
+        sink = await self.client('sink', ['C'])
+
+        await source.send(b'statechange:A:2')
+        await self.settle()
+        await source.send(b'30VAC\nstatechange:A:0VAC\n')
+        self.assertEqual(await sink.receive(2), ['statechange:C:230VAC', 'statechange:C:0VAC'])
+
+    async def testBinaryProtocol(self):
+        source = await self.client('source', ['A'], protocol.binary_protocol_version)
+        sink = await self.client('sink', ['C'], protocol.binary_protocol_version)
+        source_frames = await source.receive(2)
+        self.assertEqual(source_frames[0], 'protocol:%d' % protocol.binary_protocol_version)
+        terminal_ids = dict(zip(source_frames[1].split(':')[1::2], map(int, source_frames[1].split(':')[2::2])))
+
+        await source.send(protocol.packStateChange(terminal_ids['A'], protocol.state_codes['48VDC']))
+        frames = await sink.receive(3)
+        terminal_id = int(frames[1].split(':')[2])
+        self.assertEqual(frames[2], (protocol.record_marker, terminal_id, protocol.state_codes['48VDC']))
+
+    async def testDisconnectResetsTheNet(self):
+        source = await self.client('source', ['A'])
+        sink = await self.client('sink', ['C'])
+        await source.send(b'statechange:A:230VAC\n')
+        await sink.receive(1)
+
+        source.writer.close()
+        self.assertEqual(await sink.receive(2), ['statechange:C:230VAC', 'statechange:C:None'])
+
+
+if __name__ == '__main__':
+    unittest.main()
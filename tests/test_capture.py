@@ -0,0 +1,119 @@
+import asyncio
+import os
+import unittest
+
+from sas import capture, protocol
+from sas.replay import RecordTranslator, expectedStates, replayLocally
+
+from .loopback import LoopbackTestCase
+
+
+class CaptureTest(LoopbackTestCase):
+
+    def setUp(self):
+        super(CaptureTest, self).setUp()
+        self.capture_path = os.path.join(self.directory, 'traffic.sascap')
+        self.connections = 'A -> B\nC -> D\n'
+
+    def capture(self, disconnect=True):
+        """
+        Captures a source and a sink, the source sending a state in two writes and, unless
+        disconnect is false, then disconnecting.
+        """
+        network = self.network(self.connections)
+        # As when replaying, the terminals of a closed connection are unregistered at once.
+        network.core.session_grace_period = 0
+        network.core.startCapture(self.capture_path)
+        self.addCleanup(network.core.stopCapture)
+        source = self.client(network, 'source', ['A'])
+        sink = self.client(network, 'sink', ['B', 'D'])
+        source.sendData(b'statechange:A:230')
+        source.sendData(b'VAC\n')
+        network.pump()
+        if disconnect:
+            source.disconnect()
+        sink.pushTerminalState('D', '12VDC')
+        network.pump()
+        network.core.stopCapture()
+        return network
+
+    def testRecords(self):
+        network = self.capture()
+        records = list(capture.readCapture(self.capture_path))
+        terminal_names = {session: data.decode() for _, event, session, data in records if event == capture.terminal_event}
+        self.assertEqual(terminal_names, dict(enumerate(network.core.terminal_names)))
+        records = [record for record in records if record[1] != capture.terminal_event]
+        events = [(event, session) for _, event, session, _ in records]
+        self.assertEqual(events[:2], [(capture.open_event, 0), (capture.data_event, 0)])
+        self.assertIn((capture.close_event, 0), events)
+        self.assertEqual([event for event, _ in events].count(capture.open_event), 2)
+
+        # The data is kept as it was received, partial frames included.
+        source_data = [data for _, event, session, data in records if event == capture.data_event and session == 0]
+        self.assertIn(b'statechange:A:230', source_data)
+        self.assertIn(b'VAC\n', source_data)
+
+        timestamps = [timestamp for timestamp, _, _, _ in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def testTruncatedCaptureEndsEarly(self):
+        self.capture()
+        records = list(capture.readCapture(self.capture_path))
+        with open(self.capture_path, 'ab') as f:
+            f.write(capture.capture_record.pack(1.0, capture.data_event, 0, 100) + b'statechange')
+        self.assertEqual(list(capture.readCapture(self.capture_path)), records)
+
+    def testNotACaptureFile(self):
+        path = self.writeConnections('A -> B\n')
+        with self.assertRaises(ValueError):
+            list(capture.readCapture(path))
+
+    def testExpectedStates(self):
+        network = self.capture()
+        expected = expectedStates(self.capture_path, os.path.join(self.directory, 'connections.txt'))
+        self.assertEqual(expected, network.core.registeredTerminalStates())
+        self.assertEqual(expected, {'B': 'None', 'D': '12VDC'})
+
+    def testReplay(self):
+        # The sessions stay open, so the end states do not depend on the order the replaying
+        # server handles a close and data on another connection in.
+        self.capture(disconnect=False)
+        states, statistics = asyncio.run(replayLocally(self.capture_path, os.path.join(self.directory, 'connections.txt'), None))
+        self.assertEqual(states, {'A': '230VAC', 'B': '230VAC', 'D': '12VDC'})
+        self.assertEqual(statistics['sessions'], 2)
+        records = [record for record in capture.readCapture(self.capture_path) if record[1] != capture.terminal_event]
+        self.assertEqual(statistics['records'], len(records))
+
+    def testReplayBinaryRecords(self):
+        network = self.network(self.connections)
+        # A terminal registered before the capture gives later ones other IDs than on a fresh server.
+        early = self.client(network, 'early', ['E'])
+        early.disconnect()
+        network.core.startCapture(self.capture_path)
+        self.addCleanup(network.core.stopCapture)
+        sink = self.client(network, 'sink', ['F', 'D'])
+        sink.pushTerminalState('F', '12VDC')
+        sink.pushTerminalState('D', '48VDC')
+        network.pump()
+        network.core.stopCapture()
+
+        terminal_names = {session: data for _, event, session, data in capture.readCapture(self.capture_path) if event == capture.terminal_event}
+        self.assertEqual(terminal_names[network.core.terminal_ids['F']], b'F')
+        self.assertTrue(any(event == capture.data_event and protocol.record_marker_byte in data for _, event, _, data in capture.readCapture(self.capture_path)))
+
+        connections_path = os.path.join(self.directory, 'connections.txt')
+        self.assertEqual(expectedStates(self.capture_path, connections_path), {'F': '12VDC', 'D': '48VDC'})
+        states, _ = asyncio.run(replayLocally(self.capture_path, connections_path, None))
+        self.assertEqual(states, {'F': '12VDC', 'D': '48VDC'})
+
+    def testRecordCutBetweenData(self):
+        translator = RecordTranslator()
+        translator.addTerminal(7, b'F')
+        record = protocol.packStateChange(7, protocol.state_codes['12VDC'])
+        self.assertEqual(translator.translate(0, b'snapshot:own\n' + record[:2]), b'snapshot:own\n')
+        self.assertEqual(translator.translate(1, b'statechange:G:'), b'statechange:G:')
+        self.assertEqual(translator.translate(0, record[2:] + record), b'statechange:F:12VDC\n' * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+try:
+    from sas.client import SASClient
+except ImportError:
+    SASClient = None
+
+
+class FakeSocket(object):
+    """
+    Hands the data given to it to readAll, one chunk at a time, like a QTcpSocket.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def readAll(self):
+        return FakeByteArray(self.chunks.pop(0))
+
+
+class FakeByteArray(object):
+
+    def __init__(self, data):
+        self.bytes = data
+
+    def data(self):
+        return self.bytes
+
+
+@unittest.skipIf(SASClient is None, 'sas.client needs PySide2')
+class LegacyClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = SASClient()
+        self.client.setClientName('panel')
+        self.client.socket = FakeSocket()
+        self.received_states = []
+        for name in ('A', 'B'):
+            self.client.registerInputTerminal(name, lambda new_state, name=name: self.received_states.append((name, new_state)))
+
+    def receive(self, *chunks):
+        for chunk in chunks:
+            self.client.socket.chunks.append(chunk)
+            self.client.onReadyRead()
+
+    def testLinesSplitOverReads(self):
+        self.receive(b'states:A:230', b'VAC:B:48VDC\nstatech', b'ange:A:0VAC', b'\n')
+        self.assertEqual(self.received_states, [('A', '230VAC'), ('B', '48VDC'), ('A', '0VAC')])
+        self.assertEqual(self.client.receive_buffer, bytearray())
+
+    def testSnapshotSplitOverReads(self):
+        snapshots = []
+        self.client.snapshot_received.connect(snapshots.append)
+        self.receive(b'snapshot:A:230VAC:', b'B:None\n')
+        self.assertEqual(snapshots, [{'A': '230VAC', 'B': 'None'}])
+
+    def testUnknownMessageIsLogged(self):
+        with self.assertLogs('sas.client', 'WARNING'):
+            self.receive(b'unknown:message\nstatechange:B:12VDC\n')
+        self.assertEqual(self.received_states, [('B', '12VDC')])
+
+
+if __name__ == '__main__':
+    unittest.main()
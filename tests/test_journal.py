@@ -0,0 +1,46 @@
+import os
+import unittest
+
+from .loopback import LoopbackTestCase
+
+
+class JournalRecoveryTest(LoopbackTestCase):
+
+    def testRecoveryAfterUncleanStop(self):
+        journal_path = os.path.join(self.directory, 'states.journal')
+        network = self.network('A -> B\nC -> D\nE -> F\n', journal_path)
+        source = self.client(network, 'source', ['A', 'C', 'E'])
+        source.pushTerminalState('A', '230VAC')
+        source.pushTerminalState('C', '48VDC')
+        source.pushTerminalState('C', '12VDC')
+        network.pump()
+
+        # The server dies without closing the journal, in the middle of writing a record.
+        with open(journal_path, 'ab') as f:
+            f.write(b'E:230V')
+
+        restarted = self.network('A -> B\nC -> D\nE -> F\n', journal_path)
+        core = restarted.core
+        self.assertEqual(core.net_states[core.terminal_nets['B']], '230VAC')
+        self.assertEqual(core.net_states[core.terminal_nets['D']], '12VDC')
+        self.assertEqual(core.net_states[core.terminal_nets['F']], 'None')
+
+        # Terminals registering after the restart get the recovered states at once.
+        sink = self.client(restarted, 'sink', ['B', 'D', 'F'])
+        self.assertEqual(sink.states(), {'B': '230VAC', 'D': '12VDC', 'F': 'None'})
+
+    def testRecoveryIsRepeatable(self):
+        journal_path = os.path.join(self.directory, 'states.journal')
+        network = self.network('A -> B\n', journal_path)
+        source = self.client(network, 'source', ['A'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        # Recovering compacts the journal into a snapshot, which the next recovery reads.
+        for _ in range(2):
+            core = self.network('A -> B\n', journal_path).core
+            self.assertEqual(core.net_states[core.terminal_nets['A']], '230VAC')
+
+
+if __name__ == '__main__':
+    unittest.main()
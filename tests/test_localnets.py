@@ -0,0 +1,124 @@
+import unittest
+
+from sas import protocol
+
+from .loopback import LoopbackClient, LoopbackTestCase
+
+
+class FixedSource(object):
+    """
+    Pushes a fixed state when its client connects, like sas.misc.SingleSource.
+    """
+
+    def __init__(self, client, terminal_name, state):
+        self.client = client
+        self.terminal_name = terminal_name
+        self.state = state
+
+    def initializeSource(self):
+        self.client.pushTerminalState(self.terminal_name, self.state)
+
+    def action(self, new_state):
+        # Reflects its state into a net that was reset.
+        if new_state == self.client.no_state:
+            self.client.pushTerminalState(self.terminal_name, self.state)
+
+
+class Breaker(object):
+    """
+    A closed circuit breaker, giving its output the state of its input.
+    """
+
+    def __init__(self, client, input_terminal_name, output_terminal_name):
+        self.client = client
+        self.output_terminal_name = output_terminal_name
+        client.terminals[input_terminal_name]['action'] = self.inputAction
+
+    def inputAction(self, new_state):
+        self.client.pushTerminalState(self.output_terminal_name, new_state)
+
+
+class LocalNetTest(LoopbackTestCase):
+
+    def testGroupsOfTheClientsTerminals(self):
+        network = self.network('A -> B\nB -> X\nC -> D\nE -> Y\n')
+        panel = self.client(network, 'panel', ['A', 'B', 'C', 'D', 'E'])
+        self.client(network, 'other', ['X', 'Y'])
+
+        self.assertEqual(set(panel.local_nets), {'A', 'B', 'C', 'D'})
+        self.assertEqual(sorted(panel.local_nets['A']), ['A', 'B'])
+        # The members of a net share one tuple.
+        self.assertIs(panel.local_nets['C'], panel.local_nets['D'])
+
+    def testChangeIsRoutedInTheClient(self):
+        network = self.network('A -> B\nB -> X\n')
+        panel = self.client(network, 'panel', ['A', 'B'])
+        other = self.client(network, 'other', ['X'])
+        panel.sent_data = []
+        panel.received_data = []
+
+        panel.pushTerminalState('A', '230VAC')
+        self.assertEqual(panel.getTerminalState('B'), '230VAC')
+        # The server records the state for B too, so B echoing the state it was given sends nothing.
+        self.assertEqual(panel.sent_data, [panel.encodeTerminalState('A', '230VAC')])
+
+        network.pump()
+        self.assertEqual(panel.received_data, [])
+        self.assertEqual(other.getTerminalState('X'), '230VAC')
+        self.assertEqual(network.core.getTerminalState('B'), '230VAC')
+
+    def testOlderClientsAreRoutedByTheServer(self):
+        network = self.network('A -> B\n')
+        panel = self.client(network, 'panel', ['A', 'B'], protocol.session_protocol_version)
+        self.assertEqual(panel.local_nets, {})
+
+        panel.pushTerminalState('A', '230VAC')
+        self.assertEqual(panel.getTerminalState('B'), 'None')
+        network.pump()
+        self.assertEqual(panel.getTerminalState('B'), '230VAC')
+
+    def testStatesPushedBeforeTheGroupsArrive(self):
+        network = self.network('A -> B\n')
+        panel = LoopbackClient(network, 'panel', ['A', 'B'])
+        panel.sources.append(FixedSource(panel, 'A', '48VDC'))
+        panel.connect()
+        network.pump()
+
+        self.assertEqual(panel.states(), {'A': '48VDC', 'B': '48VDC'})
+        self.assertEqual(network.core.registeredTerminalStates(), {'A': '48VDC', 'B': '48VDC'})
+
+    def testSourceReflectsIntoAResetNet(self):
+        network = self.network('S -> I, X\nO -> L\n')
+        network.core.session_grace_period = 0
+        panel = LoopbackClient(network, 'panel', ['S', 'I', 'O'])
+        source = FixedSource(panel, 'S', '230VAC')
+        panel.sources.append(source)
+        panel.terminals['S']['action'] = source.action
+        Breaker(panel, 'I', 'O')
+        panel.connect()
+        network.pump()
+        other = self.client(network, 'other', ['X'])
+        lamp = self.client(network, 'lamp', ['L'])
+        self.assertEqual(lamp.getTerminalState('L'), '230VAC')
+
+        # The server resets the net of X, sending None to both S and I. The source gives the net its
+        # state again, and the server and the panel agree on it.
+        other.disconnect()
+        network.pump()
+        self.assertEqual(panel.states(), {'S': '230VAC', 'I': '230VAC', 'O': '230VAC'})
+        self.assertEqual(network.core.registeredTerminalStates(), {'S': '230VAC', 'I': '230VAC', 'O': '230VAC', 'L': '230VAC'})
+        self.assertEqual(lamp.getTerminalState('L'), '230VAC')
+
+    def testLargeNetIsDeliveredWithoutRecursion(self):
+        terminal_names = ['T%d' % index for index in range(5000)]
+        network = self.network('T0 -> ' + ', '.join(terminal_names[1:]) + '\n')
+        panel = self.client(network, 'panel', terminal_names)
+
+        panel.pushTerminalState('T0', '230VAC')
+        self.assertEqual(set(panel.states().values()), {'230VAC'})
+        network.pump()
+        self.assertEqual(set(network.core.registeredTerminalStates().values()), {'230VAC'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+from sas.metrics import Histogram, ServerMetrics
+
+from .loopback import LoopbackTestCase
+
+
+class HistogramTest(unittest.TestCase):
+
+    def testBuckets(self):
+        histogram = Histogram(bucket_count=4)
+        for value in (0, 1, 2, 3, 4, 5, 100):
+            histogram.record(value)
+        # Up to 1, up to 2, up to 4, and everything above in the last bucket.
+        self.assertEqual(histogram.counts, [2, 1, 2, 2])
+        self.assertEqual(histogram.count, 7)
+        self.assertEqual(histogram.maximum, 100)
+
+    def testScale(self):
+        histogram = Histogram(1e6)
+        histogram.record(3e-6, count=10)
+        self.assertEqual(histogram.counts[2], 10)
+        self.assertAlmostEqual(histogram.total, 3e-5)
+
+    def testPercentiles(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), 0.0)
+        histogram.record(1, count=90)
+        histogram.record(1000, count=10)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(90), 1)
+        self.assertEqual(histogram.percentile(99), 1024)
+
+    def testSummary(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.summary()['buckets'], [0])
+        histogram.record(1)
+        histogram.record(3)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['mean'], 2)
+        self.assertEqual(summary['buckets'], [1, 0, 1])
+
+
+class ServerMetricsTest(unittest.TestCase):
+
+    def testRecordBatch(self):
+        metrics = ServerMetrics()
+        metrics.recordBatch('panel', {'statechange': 2, 'staterecord': 1, 'registration': 1}, 100, 5e-6)
+        metrics.recordBatch('panel', {'statechange': 1}, 20, 1e-3)
+        summary = metrics.summary()
+        self.assertEqual(summary['messages'], {'statechange': 3, 'staterecord': 1, 'registration': 1})
+        self.assertEqual(summary['counters']['bytes_received'], 120)
+        self.assertEqual(summary['message_latency_us']['statechange']['count'], 3)
+        self.assertAlmostEqual(summary['message_latency_us']['statechange']['max'], 1000)
+        # Registrations are not state changes of the client.
+        self.assertEqual(summary['client_latency_us']['panel']['count'], 4)
+
+    def testFanOutAndWrites(self):
+        metrics = ServerMetrics()
+        metrics.recordFanOut(3)
+        metrics.recordFanOut(0)
+        metrics.recordWrite(2, 50)
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], {'bytes_received': 0, 'bytes_sent': 50, 'state_changes': 2, 'sends': 3})
+        self.assertEqual(summary['fan_out']['count'], 2)
+        self.assertEqual(summary['queue_depth']['max'], 2)
+
+
+class StatsTest(LoopbackTestCase):
+
+    def testStatsCommand(self):
+        network = self.network('A -> B, C\n')
+        source = self.client(network, 'source', ['A'])
+        sink = self.client(network, 'sink', ['B', 'C'])
+        statistics = []
+        sink.receivedStatistics = statistics.append
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        sink.requestStatistics()
+        network.pump()
+        self.assertEqual(len(statistics), 1)
+        summary = statistics[0]
+        self.assertEqual(summary['sockets'], 2)
+        self.assertEqual(summary['registered_terminals'], 3)
+        self.assertGreaterEqual(summary['messages']['registration'], 2)
+        self.assertIn('source', summary['client_latency_us'])
+        # The change of A was sent to B and C.
+        self.assertEqual(summary['fan_out']['max'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+
+from sas import protocol
+
+from .loopback import LoopbackClient, LoopbackTestCase
+
+try:
+    from PySide2 import QtCore
+    from sas import misc
+except ImportError:
+    # The components are Qt objects.
+    misc = None
+
+
+@unittest.skipIf(misc is None, 'sas.misc needs PySide2')
+class SchedulerTest(LoopbackTestCase):
+
+    def breakerChain(self, breaker_count, use_scheduler, protocol_version=None):
+        """
+        Returns a connected client with a source feeding a chain of closed breakers, its breakers and
+        its scheduler, if any.
+        """
+        connections = ['SRC -> I0'] + ['O%d -> I%d' % (index, index + 1) for index in range(breaker_count - 1)]
+        network = self.network('\n'.join(connections) + '\n')
+        input_names = ['I%d' % index for index in range(breaker_count)]
+        output_names = ['O%d' % index for index in range(breaker_count)]
+        client = LoopbackClient(network, 'panel', ['SRC'] + input_names + output_names)
+        if protocol_version is not None:
+            client.protocol_version = protocol_version
+
+        scheduler = misc.DeltaScheduler(client) if use_scheduler else None
+        breakers = []
+        for input_name, output_name in zip(input_names, output_names):
+            breaker = misc.SinglePhaseCircuitBreaker(client, initially_closed=True, scheduler=scheduler)
+            breaker.addTerminalPair(input_name, output_name)
+            breakers.append(breaker)
+        source = misc.SingleSource('230VAC', '0VAC', client, scheduler=scheduler)
+        source.addTerminal('SRC')
+
+        client.connect()
+        network.pump()
+        return network, client, breakers, scheduler
+
+    def assertChainStates(self, network, client, breaker_count, state):
+        terminal_names = ['I%d' % index for index in range(breaker_count)] + ['O%d' % index for index in range(breaker_count)]
+        self.assertEqual(set(client.states(terminal_names).values()), {state})
+        server_states = network.core.registeredTerminalStates()
+        self.assertEqual(set(server_states[terminal_name] for terminal_name in terminal_names), {state})
+
+    def testChainSettles(self):
+        for use_scheduler in (False, True):
+            network, client, breakers, _ = self.breakerChain(20, use_scheduler)
+            self.assertChainStates(network, client, 20, '230VAC')
+
+            # Opening a breaker takes the power from everything after it.
+            breaker = breakers[10]
+            breaker.closed = False
+            breaker.inputAction(client.getTerminalState(breaker.input_terminal_name))
+            network.pump()
+            self.assertEqual(client.getTerminalState('O9'), '230VAC')
+            self.assertEqual(network.core.getTerminalState('O19'), 'None')
+            self.assertEqual(client.getTerminalState('O19'), 'None')
+
+    def testSchedulerSendsOnlySettledStates(self):
+        sent_sizes = []
+        for use_scheduler in (False, True):
+            # Routed by the server, so every breaker is given its input state from there. A client
+            # routing its own nets sends the settled states of the whole chain in one batch either way.
+            network, client, _, _ = self.breakerChain(50, use_scheduler, protocol.session_protocol_version)
+            sent_sizes.append(sum(len(data) for data in client.sent_data))
+        self.assertLess(sent_sizes[1], sent_sizes[0])
+
+    def testDeepChainSettlesInCycles(self):
+        network, client, _, scheduler = self.breakerChain(2000, True)
+        self.assertChainStates(network, client, 2000, '230VAC')
+        # Every terminal of the chain is evaluated once.
+        self.assertEqual(scheduler.statistics['evaluations'], 2 * 2000 + 1)
+
+    def testOscillationIsGivenUp(self):
+        client = LoopbackClient(None, 'panel', ['A', 'B'])
+        client.sendData = lambda data: None
+        scheduler = misc.DeltaScheduler(client, max_cycles=50)
+
+        class Inverter(misc.Component):
+
+            def __init__(self, input_terminal_name, output_terminal_name):
+                super(Inverter, self).__init__(client, scheduler)
+                self.output_terminal_name = output_terminal_name
+                self.setTerminalAction(input_terminal_name, self.inputAction)
+
+            def inputAction(self, new_state):
+                self.pushTerminalState(self.output_terminal_name, '0VDC' if new_state == '12VDC' else '12VDC')
+
+        # An inverter whose output is fed back to its input never settles.
+        Inverter('A', 'B')
+        scheduler.watch('B', lambda new_state: scheduler.postEvent('A', new_state))
+        with self.assertLogs('sas.misc', 'WARNING'):
+            scheduler.postEvent('A', '12VDC')
+        self.assertEqual(scheduler.statistics['cycles'], 50)
+        self.assertFalse(scheduler.running)
+        self.assertEqual(scheduler.pending, {})
+
+
+@unittest.skipIf(misc is None or misc.numpy is None, 'component banks need PySide2 and NumPy')
+class ComponentBankTest(LoopbackTestCase):
+
+    def bankClient(self, terminal_names):
+        client = LoopbackClient(None, 'panel', terminal_names)
+        client.sendData = lambda data: None
+        return client
+
+    def receive(self, client, bank, terminal_name, state):
+        # The bank is evaluated right away instead of from the event loop.
+        client.receivedTerminalState(terminal_name, state)
+        bank.evaluate()
+
+    def testChangeoverContactSharesItsInput(self):
+        client = self.bankClient(['K_COIL', 'K_IN0', 'K_OUT0', 'K_OUT1'])
+        relays = misc.RelayBank(client, ['K_COIL'], [(0, 'K_IN0', 'K_OUT0', False), (0, 'K_IN0', 'K_OUT1', True)])
+        self.receive(client, relays, 'K_COIL', '230VAC')
+        self.receive(client, relays, 'K_IN0', '230VAC')
+        self.assertEqual(client.states(['K_OUT0', 'K_OUT1']), {'K_OUT0': '230VAC', 'K_OUT1': 'None'})
+
+        self.receive(client, relays, 'K_COIL', '0VAC')
+        self.assertEqual(client.states(['K_OUT0', 'K_OUT1']), {'K_OUT0': 'None', 'K_OUT1': '230VAC'})
+
+    def testBreakersOnOneBus(self):
+        client = self.bankClient(['BUS', 'O0', 'O1', 'O2'])
+        breakers = misc.CircuitBreakerBank(client, ['BUS'] * 3, ['O0', 'O1', 'O2'], initially_closed=[True, False, True])
+        self.receive(client, breakers, 'BUS', '230VAC')
+        self.assertEqual(client.states(['O0', 'O1', 'O2']), {'O0': '230VAC', 'O1': 'None', 'O2': '230VAC'})
+
+    def testEvaluationIsScheduled(self):
+        application = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+        client = self.bankClient(['A', 'B', 'O0', 'O1'])
+        breakers = misc.CircuitBreakerBank(client, ['A', 'B'], ['O0', 'O1'], initially_closed=True)
+        evaluations = []
+        evaluate_outputs = breakers.evaluateOutputs
+        breakers.evaluateOutputs = lambda: evaluations.append(None) or evaluate_outputs()
+
+        # Both inputs are evaluated together, once the event loop runs.
+        client.receivedTerminalState('A', '230VAC')
+        client.receivedTerminalState('B', '48VDC')
+        self.assertEqual(client.states(['O0', 'O1']), {'O0': 'None', 'O1': 'None'})
+        application.processEvents()
+        self.assertEqual(client.states(['O0', 'O1']), {'O0': '230VAC', 'O1': '48VDC'})
+        self.assertEqual(len(evaluations), 1)
+        self.assertFalse(breakers.evaluation_pending)
+
+    def testBankWithoutLogicKeepsItsOutputs(self):
+        client = self.bankClient(['O'])
+        bank = misc.ComponentBank(client, ['O'])
+        client.receivedTerminalState('O', '230VAC')
+        bank.evaluate()
+        self.assertEqual(client.getTerminalState('O'), '230VAC')
+
+    def testOutputsMustBeDistinct(self):
+        client = self.bankClient(['A', 'B', 'O'])
+        with self.assertRaises(ValueError):
+            misc.CircuitBreakerBank(client, ['A', 'B'], ['O', 'O'])
+        with self.assertRaises(ValueError):
+            misc.CircuitBreakerBank(client, ['A', 'O'], ['O', 'B'])
+
+
+if __name__ == '__main__':
+    unittest.main()
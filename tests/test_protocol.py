@@ -0,0 +1,56 @@
+import unittest
+
+from sas import protocol
+
+
+class SplitFramesTest(unittest.TestCase):
+
+    def testPartialLineIsKept(self):
+        buffer = bytearray(b'statechange:A:23')
+        self.assertEqual(protocol.splitFrames(buffer), [])
+        self.assertEqual(buffer, b'statechange:A:23')
+
+        buffer.extend(b'0VAC\nstatechange:B')
+        self.assertEqual(protocol.splitFrames(buffer), ['statechange:A:230VAC'])
+        self.assertEqual(buffer, b'statechange:B')
+
+    def testPartialRecordIsKept(self):
+        record = protocol.packStateChange(5, 1)
+        buffer = bytearray(record[:3])
+        self.assertEqual(protocol.splitFrames(buffer), [])
+
+        buffer.extend(record[3:])
+        self.assertEqual(protocol.splitFrames(buffer), [(protocol.record_marker, 5, 1)])
+        self.assertEqual(buffer, b'')
+
+    def testMixedTextAndRecords(self):
+        data = b'protocol:2\n' + protocol.packStateChange(1, 2) + protocol.packStateChange(300, 3) + b'terminalids:A:1\nstatechange:B:48VDC\n'
+        self.assertEqual(protocol.splitFrames(bytearray(data)),
+                         ['protocol:2', (protocol.record_marker, 1, 2), (protocol.record_marker, 300, 3), 'terminalids:A:1', 'statechange:B:48VDC'])
+
+    def testMixedInputSplitAtEveryByte(self):
+        data = b'terminalids:A:0:B:1\n' + protocol.packStateChange(0, 1) + b'statechange:B:48VDC\n' + protocol.packStateChange(1, 0)
+        expected = protocol.splitFrames(bytearray(data))
+
+        for split in range(1, len(data)):
+            buffer = bytearray(data[:split])
+            frames = protocol.splitFrames(buffer)
+            buffer.extend(data[split:])
+            frames.extend(protocol.splitFrames(buffer))
+            self.assertEqual(frames, expected, 'split at %d' % split)
+            self.assertEqual(buffer, b'')
+
+    def testBulkStates(self):
+        states = [('A', '230VAC'), ('B', 'None')]
+        message = protocol.packStates('states', states)
+        self.assertEqual(message, b'states:A:230VAC:B:None\n')
+        self.assertEqual(protocol.unpackStates(message.decode().rstrip('\n').split(':')[1:]), states)
+
+    def testNegotiateProtocolVersion(self):
+        self.assertEqual(protocol.negotiateProtocolVersion(0), protocol.text_protocol_version)
+        self.assertEqual(protocol.negotiateProtocolVersion(protocol.batch_protocol_version), protocol.batch_protocol_version)
+        self.assertEqual(protocol.negotiateProtocolVersion(1000), protocol.highest_protocol_version)
+
+
+if __name__ == '__main__':
+    unittest.main()
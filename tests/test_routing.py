@@ -0,0 +1,242 @@
+import os
+import unittest
+from unittest import mock
+
+from sas import protocol
+from sas.core import ClientCore
+
+from .loopback import LoopbackTestCase
+
+
+class NetTest(LoopbackTestCase):
+
+    def testConnectionsResolveIntoNets(self):
+        network = self.network('A -> B\nB -> C\nD -> E\n')
+        core = network.core
+        self.assertEqual(core.terminal_nets['A'], core.terminal_nets['C'])
+        self.assertNotEqual(core.terminal_nets['A'], core.terminal_nets['D'])
+        self.assertEqual(sorted(core.net_members[core.terminal_nets['B']]), ['A', 'B', 'C'])
+
+    def testStateReachesTheWholeNet(self):
+        network = self.network('A -> B\nB -> C\nD -> E\n')
+        source = self.client(network, 'source', ['A', 'D'])
+        # B is not registered, the state still reaches C through it.
+        sink = self.client(network, 'sink', ['C', 'E'])
+
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+        self.assertEqual(sink.states(), {'C': '230VAC', 'E': 'None'})
+        self.assertEqual(network.core.getTerminalState('C'), '230VAC')
+
+    def testEveryProtocolVersion(self):
+        for protocol_version in range(protocol.text_protocol_version, protocol.highest_protocol_version + 1):
+            network = self.network('A -> B\n')
+            source = self.client(network, 'source', ['A'], protocol_version)
+            sink = self.client(network, 'sink', ['B'], protocol_version)
+
+            source.pushTerminalState('A', '48VDC')
+            network.pump()
+            self.assertEqual(sink.getTerminalState('B'), '48VDC', 'protocol version %d' % protocol_version)
+            self.assertEqual(sink.negotiated_protocol_version, protocol_version)
+
+            # A state missing from the state table of the binary protocol is sent as text.
+            source.pushTerminalState('A', '24VDC')
+            network.pump()
+            self.assertEqual(sink.getTerminalState('B'), '24VDC', 'protocol version %d' % protocol_version)
+
+    def testRegisteringIntoANetWithAState(self):
+        network = self.network('A -> B, C\n')
+        source = self.client(network, 'source', ['A'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        sink = self.client(network, 'sink', ['B'], protocol.binary_protocol_version)
+        self.assertEqual(sink.getTerminalState('B'), '230VAC')
+        # The terminal IDs arrive before the binary record using them.
+        self.assertEqual(sink.terminal_ids, {'B': network.core.terminal_ids['B']})
+
+        bulk_sink = self.client(network, 'bulk sink', ['C'], protocol.bulk_protocol_version)
+        self.assertEqual(bulk_sink.received_states, [('C', '230VAC')])
+        self.assertIn(b'states:C:230VAC\n', b''.join(bulk_sink.received_data))
+
+    def testDisconnectResetsTheNet(self):
+        network = self.network('A -> B\n')
+        network.core.session_grace_period = 0
+        source = self.client(network, 'source', ['A'])
+        sink = self.client(network, 'sink', ['B'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        source.disconnect()
+        self.assertEqual(sink.getTerminalState('B'), 'None')
+        self.assertEqual(network.core.registeredTerminalStates(), {'B': 'None'})
+
+    def testSnapshot(self):
+        network = self.network('A -> B\nC -> D\n')
+        source = self.client(network, 'source', ['A', 'C'])
+        sink = self.client(network, 'sink', ['B'])
+        snapshots = []
+        sink.receivedSnapshot = snapshots.append
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        sink.requestSnapshot()
+        sink.requestSnapshot(all_terminals=True)
+        network.pump()
+        self.assertEqual(snapshots, [{'B': '230VAC'}, {'A': '230VAC', 'B': '230VAC', 'C': 'None'}])
+
+
+class ReloadTest(LoopbackTestCase):
+
+    def reload(self, network, connections):
+        path = self.writeConnections(connections)
+        # The compiled file is reused while the size and modification time match.
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000000000))
+        network.core.reloadTerminalConnections()
+        network.pump()
+
+    def testMergedNetKeepsItsState(self):
+        network = self.network('A -> B\nC -> D\n')
+        source = self.client(network, 'source', ['A'])
+        # Without routing its own nets, which it would give D the state of B in.
+        sink = self.client(network, 'sink', ['B', 'D'], protocol.session_protocol_version)
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+        sink.received_states = []
+
+        self.reload(network, 'A -> B\nC -> D\nB -> C\n')
+        self.assertEqual(sink.states(), {'B': '230VAC', 'D': '230VAC'})
+        # Only the terminal whose net changed state is sent anything.
+        self.assertEqual(sink.received_states, [('D', '230VAC')])
+
+    def testSplitNetIsReset(self):
+        network = self.network('A -> B\nB -> C\n')
+        source = self.client(network, 'source', ['A'])
+        sink = self.client(network, 'sink', ['B', 'C'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        self.reload(network, 'A -> B\n')
+        self.assertEqual(sink.getTerminalState('C'), 'None')
+        self.assertNotIn('C', network.core.terminal_nets)
+
+    def testUnchangedNetsAreLeftAlone(self):
+        network = self.network('A -> B\nC -> D\n')
+        source = self.client(network, 'source', ['A', 'C'])
+        sink = self.client(network, 'sink', ['B', 'D'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+        sink.received_states = []
+
+        self.reload(network, 'A -> B\nC -> D\nE -> F\n')
+        self.assertEqual(sink.received_states, [])
+        self.assertEqual(sink.getTerminalState('B'), '230VAC')
+
+    def testMissingFileKeepsTheConnections(self):
+        network = self.network('A -> B\n')
+        os.remove(network.core.connections_path)
+        with self.assertLogs('sas.core', 'WARNING'):
+            network.core.reloadTerminalConnections()
+        self.assertEqual(network.core.net_members, {'A': ('A', 'B')})
+
+    def testFileRemovedWhileReloading(self):
+        network = self.network('A -> B\n')
+        source = self.client(network, 'source', ['A'])
+        sink = self.client(network, 'sink', ['B'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        # Edited, and renamed away by the editor saving it again after the reload found the file.
+        path = self.writeConnections('A -> C\n')
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000000000))
+        stat = os.stat(path)
+        os.remove(path)
+        with mock.patch('sas.wiring.os.stat', return_value=stat), self.assertLogs('sas.core', 'WARNING'):
+            network.core.reloadTerminalConnections()
+        self.assertEqual(network.core.net_members, {'A': ('A', 'B')})
+        network.pump()
+        self.assertEqual(sink.getTerminalState('B'), '230VAC')
+
+
+class BatchTest(LoopbackTestCase):
+
+    def testBatchIsSentAsOneMessage(self):
+        network = self.network('A1 -> B1\nA2 -> B2\n')
+        source = self.client(network, 'source', ['A1', 'A2'])
+        sink = self.client(network, 'sink', ['B1', 'B2'])
+        source.sent_data = []
+
+        with source.batch():
+            source.pushTerminalState('A1', '230VAC')
+            source.pushTerminalState('A2', '48VDC')
+            source.pushTerminalState('A1', '0VAC')
+        self.assertEqual(source.sent_data, [b'statechanges:A1:0VAC:A2:48VDC\n'])
+
+        network.pump()
+        # The state in between is never routed.
+        self.assertEqual(sink.received_states, [('B1', '0VAC'), ('B2', '48VDC')])
+
+    def testBatchIsAppliedAsAWhole(self):
+        network = self.network('A1 -> B1\nA2 -> B1\n')
+        source = self.client(network, 'source', ['A1', 'A2'], protocol.session_protocol_version)
+        sink = self.client(network, 'sink', ['B1'])
+        monitor_data = []
+        monitor = network.addSocket(monitor_data.append)
+        network.send(monitor, b'subscribe:*\n')
+        network.pump()
+
+        # Both terminals are in the one net, which is pushed once with the last state given for it.
+        network.send(source.socket_id, b'statechanges:A1:230VAC:A2:48VDC\n')
+        network.pump()
+        self.assertEqual(sink.received_states, [('B1', '48VDC')])
+        self.assertEqual(source.received_states, [('A1', '48VDC')])
+        self.assertEqual(network.core.registeredTerminalStates(), {'A1': '48VDC', 'A2': '48VDC', 'B1': '48VDC'})
+        # Monitors see every change of the batch, in one write. The clients echoing their new states follow.
+        self.assertEqual(monitor_data[0], b'monitor:source:A1:230VAC\nmonitor:source:A2:48VDC\n')
+
+    def testUnchangedBatchSendsNothing(self):
+        network = self.network('A -> B\n')
+        source = self.client(network, 'source', ['A'])
+        source.sent_data = []
+
+        with source.batch():
+            source.pushTerminalState('A', '230VAC')
+            source.pushTerminalState('A', 'None')
+        self.assertEqual(source.sent_data, [])
+
+    def testOldServersGetTheChangesOneByOne(self):
+        network = self.network('A1 -> B1\nA2 -> B2\n')
+        source = self.client(network, 'source', ['A1', 'A2'], protocol.bulk_protocol_version)
+        sink = self.client(network, 'sink', ['B1', 'B2'])
+        source.sent_data = []
+
+        with source.batch():
+            source.pushTerminalState('A1', '230VAC')
+            source.pushTerminalState('A2', '48VDC')
+        self.assertEqual(len(source.sent_data), 1)
+        self.assertNotIn(b'statechanges', source.sent_data[0])
+
+        network.pump()
+        self.assertEqual(sink.states(), {'B1': '230VAC', 'B2': '48VDC'})
+
+
+class ClientCoreTest(unittest.TestCase):
+
+    def testDataGoesToTheWriter(self):
+        written = []
+        client = ClientCore(written.append)
+        client.setClientName('panel')
+        client.registerTerminal('A')
+        client.connectedToServer()
+        self.assertEqual(written, [b'clientname:panel:%d\n' % protocol.highest_protocol_version, b'registration:A\n'])
+
+    def testDataIsDroppedWithoutAWriter(self):
+        client = ClientCore()
+        client.registerTerminal('A')
+        client.connectedToServer()
+        client.pushTerminalState('A', '230VAC')
+        self.assertEqual(client.getTerminalState('A'), '230VAC')
+
+
+if __name__ == '__main__':
+    unittest.main()
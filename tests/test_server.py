@@ -0,0 +1,154 @@
+import os
+import tempfile
+import time
+import unittest
+
+from sas import protocol
+
+try:
+    from PySide2 import QtCore, QtNetwork
+    from sas.client import SASClient2
+    from sas.server import SASServer2
+except ImportError:
+    SASServer2 = None
+
+
+class ServerClient(object):
+    """
+    A client of the server on a real socket, which keeps the frames it received.
+    """
+
+    def __init__(self, server, client_name, terminal_names, protocol_version=None):
+        self.socket = QtNetwork.QTcpSocket()
+        self.socket.connectToHost('127.0.0.1', server.serverPort())
+        if not self.socket.waitForConnected(5000):
+            raise RuntimeError('Could not connect to the server.')
+        self.receive_buffer = bytearray()
+        self.frames = []
+
+        if protocol_version is None:
+            self.send('clientname:%s\n' % client_name)
+        else:
+            self.send('clientname:%s:%d\n' % (client_name, protocol_version))
+        self.send('registration:%s\n' % ':'.join(terminal_names))
+
+    def send(self, message):
+        self.socket.write(message.encode())
+        self.socket.flush()
+
+    def receive(self):
+        self.receive_buffer.extend(self.socket.readAll().data())
+        self.frames.extend(protocol.splitFrames(self.receive_buffer))
+        return self.frames
+
+    def close(self):
+        self.socket.abort()
+
+
+@unittest.skipIf(SASServer2 is None, 'SASServer2 needs PySide2')
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.application = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def writeConnections(self, text):
+        path = os.path.join(self.directory, 'connections.txt')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def server(self, connections):
+        server = SASServer2(0, self.writeConnections(connections))
+        self.addCleanup(self.closeServer, server)
+        return server
+
+    def closeServer(self, server):
+        # The clients are gone by now, see client. Deleted from the event loop, rather than whenever the
+        # garbage collector gets to it, so no event is left for a socket of the server after it is gone.
+        self.settle()
+        server.close()
+        server.deleteLater()
+        QtCore.QCoreApplication.sendPostedEvents(None, QtCore.QEvent.DeferredDelete)
+
+    def client(self, server, client_name, terminal_names, protocol_version=None):
+        client = ServerClient(server, client_name, terminal_names, protocol_version)
+        self.addCleanup(client.close)
+        self.settle()
+        return client
+
+    def settle(self, seconds=0.1, until=None):
+        # Lets both ends handle everything in flight, including the flush timer of the server.
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.application.processEvents()
+            if until is not None and until():
+                return
+            time.sleep(0.005)
+
+
+class ServerTest(ServerTestCase):
+
+    def testStateReachesTheWholeNet(self):
+        server = self.server('A -> B\nB -> C\nD -> E\n')
+        source = self.client(server, 'source', ['A', 'D'])
+        # B is not registered, the state still reaches C through it.
+        sink = self.client(server, 'sink', ['C', 'E'])
+
+        source.send('statechange:A:230VAC\n')
+        self.settle()
+        self.assertEqual(sink.receive(), ['statechange:C:230VAC'])
+        self.assertEqual(server.getTerminalState('C'), '230VAC')
+        self.assertEqual(server.getTerminalState('E'), 'None')
+
+    def testRegisteringIntoANetWithAState(self):
+        server = self.server('A -> B\n')
+        source = self.client(server, 'source', ['A'])
+        source.send('statechange:A:230VAC\n')
+        self.settle()
+
+        sink = self.client(server, 'sink', ['B'], protocol.binary_protocol_version)
+        # The terminal IDs arrive before the binary record using them.
+        terminal_id = server.terminal_ids['B']
+        self.assertEqual(sink.receive(), ['protocol:2', 'terminalids:B:%d' % terminal_id,
+                                          (protocol.record_marker, terminal_id, protocol.state_codes['230VAC'])])
+
+    def testDisconnectResetsTheNet(self):
+        server = self.server('A -> B\n')
+        source = self.client(server, 'source', ['A'])
+        sink = self.client(server, 'sink', ['B'])
+        source.send('statechange:A:230VAC\n')
+        self.settle()
+
+        source.close()
+        self.settle()
+        self.assertEqual(sink.receive(), ['statechange:B:230VAC', 'statechange:B:None'])
+
+    def testStoppedClientEndsItsSession(self):
+        server = self.server('A -> B\n')
+        sink = self.client(server, 'sink', ['B'])
+        client = SASClient2()
+        client.server_port = server.serverPort()
+        client.registerTerminal('A')
+        client.startClient()
+        self.settle(5.0, until=lambda: client.session_token is not None)
+        client.pushTerminalState('A', '230VAC')
+        self.settle()
+
+        # Without waiting out the grace period for the session to be resumed.
+        client.stopClient()
+        self.settle(1.0, until=lambda: len(sink.receive()) == 2)
+        self.assertEqual(sink.receive(), ['statechange:B:230VAC', 'statechange:B:None'])
+        self.assertEqual(server.detached_sessions, {})
+
+    def testEditIsPickedUp(self):
+        server = self.server('A -> B\n')
+        self.writeConnections('A -> B\nC -> D\n')
+        self.settle(5.0, until=lambda: 'C' in server.terminal_nets)
+        self.assertEqual(server.terminal_nets['D'], 'C')
+
+
+if __name__ == '__main__':
+    unittest.main()
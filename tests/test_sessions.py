@@ -0,0 +1,103 @@
+import unittest
+
+from .loopback import LoopbackTestCase
+
+
+class SessionTest(LoopbackTestCase):
+
+    def setUp(self):
+        super(SessionTest, self).setUp()
+        self.loopback = self.network('A -> B\nC -> D\n')
+        self.core = self.loopback.core
+        self.source = self.client(self.loopback, 'source', ['A', 'C'])
+        self.sink = self.client(self.loopback, 'sink', ['B', 'D'])
+
+        self.source.pushTerminalState('A', '230VAC')
+        self.loopback.pump()
+
+    def testResumeWithinGracePeriod(self):
+        session_token = self.source.session_token
+        self.source.disconnect()
+        # The terminals stay registered while the session waits to be resumed.
+        self.assertIn(session_token, self.core.detached_sessions)
+        self.assertEqual(self.sink.getTerminalState('B'), '230VAC')
+
+        # Missed by the source on the server side, and by the server on the client side.
+        self.sink.pushTerminalState('D', '48VDC')
+        self.source.pushTerminalState('A', '0VAC')
+        self.loopback.pump()
+
+        self.source.sent_data = []
+        self.source.connect()
+        self.loopback.pump()
+        self.assertTrue(self.source.sent_data[0].startswith(('resume:%s:' % session_token).encode()))
+        self.assertFalse(any(data.startswith(b'clientname:') for data in self.source.sent_data))
+
+        self.assertEqual(self.source.session_token, session_token)
+        self.assertEqual(self.core.detached_sessions, {})
+        self.assertEqual(self.source.getTerminalState('C'), '48VDC')
+        self.assertEqual(self.sink.getTerminalState('B'), '0VAC')
+
+    def testResumeSendsOnlyWhatWasMissed(self):
+        self.sink.pushTerminalState('D', '48VDC')
+        self.loopback.pump()
+        self.source.disconnect()
+
+        self.source.received_states = []
+        self.source.connect()
+        self.loopback.pump()
+        self.assertEqual(self.source.received_states, [])
+        self.assertTrue(self.source.connected)
+
+    def testExpiredSessionRegistersAgain(self):
+        session_token = self.source.session_token
+        self.source.disconnect()
+        self.core.expireSession(session_token, self.core.detached_sessions[session_token])
+        self.loopback.pump()
+        self.assertEqual(self.sink.getTerminalState('B'), 'None')
+        self.assertNotIn('A', self.core.registeredTerminalStates())
+
+        self.source.connect()
+        self.loopback.pump()
+        self.assertIn(('expired:%s\n' % session_token).encode(), self.source.received_data)
+        self.assertNotEqual(self.source.session_token, session_token)
+        self.assertIn('A', self.core.registeredTerminalStates())
+
+    def testResumedSessionIsNotExpired(self):
+        session_token = self.source.session_token
+        self.source.disconnect()
+        expiry_time = self.core.detached_sessions[session_token]
+        self.source.connect()
+        self.loopback.pump()
+
+        # The timer of the first detach fires late.
+        self.core.expireSession(session_token, expiry_time)
+        self.assertEqual(self.core.sessions[session_token], self.source.socket_id)
+        self.assertEqual(self.sink.getTerminalState('B'), '230VAC')
+
+    def testNoGracePeriod(self):
+        self.core.session_grace_period = 0
+        self.source.disconnect()
+        self.assertEqual(self.core.detached_sessions, {})
+        self.assertEqual(self.sink.getTerminalState('B'), 'None')
+
+    def testEndedSessionIsNotKept(self):
+        session_token = self.source.session_token
+        self.source.endSession()
+        self.source.disconnect()
+        # A clean stop resets the nets at once, the grace period notwithstanding.
+        self.assertEqual(self.core.detached_sessions, {})
+        self.assertNotIn(session_token, self.core.sessions)
+        self.assertEqual(self.sink.getTerminalState('B'), 'None')
+        self.assertEqual(self.core.registeredTerminalStates(), {'B': 'None', 'D': 'None'})
+
+        # The next connection registers as a new client.
+        self.source.sent_data = []
+        self.source.connect()
+        self.loopback.pump()
+        self.assertTrue(self.source.sent_data[0].startswith(b'clientname:'))
+        self.assertNotEqual(self.source.session_token, session_token)
+
+
+if __name__ == '__main__':
+    unittest.main()
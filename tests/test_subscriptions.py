@@ -0,0 +1,124 @@
+import unittest
+
+from sas.subscriptions import SubscriptionIndex
+
+from .loopback import LoopbackTestCase
+
+
+class SubscriptionIndexTest(unittest.TestCase):
+
+    def testPatterns(self):
+        index = SubscriptionIndex()
+        self.assertFalse(index)
+        index.subscribe('exact', 'K1-13')
+        index.subscribe('relays', 'K1*')
+        index.subscribe('k', 'K*')
+        index.subscribe('all', '*')
+        self.assertTrue(index)
+
+        self.assertEqual(index.match('K1-13'), {'exact', 'relays', 'k', 'all'})
+        self.assertEqual(index.match('K1'), {'relays', 'k', 'all'})
+        self.assertEqual(index.match('K2-1'), {'k', 'all'})
+        self.assertEqual(index.match('X'), {'all'})
+        self.assertEqual(index.match(''), {'all'})
+
+    def testValidPatterns(self):
+        index = SubscriptionIndex()
+        self.assertTrue(index.isValidPattern('K1-13'))
+        self.assertTrue(index.isValidPattern('K1*'))
+        self.assertTrue(index.isValidPattern('*'))
+        self.assertFalse(index.isValidPattern(''))
+        self.assertFalse(index.isValidPattern('K*3'))
+
+    def testMatchesAreCachedUntilTheSubscriptionsChange(self):
+        index = SubscriptionIndex()
+        index.subscribe('relays', 'K1*')
+        self.assertIs(index.match('K1-13'), index.match('K1-13'))
+
+        index.subscribe('exact', 'K1-13')
+        self.assertEqual(index.match('K1-13'), {'relays', 'exact'})
+        index.unsubscribe('relays', 'K1*')
+        self.assertEqual(index.match('K1-13'), {'exact'})
+
+    def testUnsubscribingPrunesTheTrie(self):
+        index = SubscriptionIndex()
+        index.subscribe('a', 'K12*')
+        index.subscribe('b', 'K1*')
+        index.subscribe('a', 'K1-13')
+
+        index.unsubscribe('a', 'K12*')
+        # The node of K1 holds the subscribers of 'K1*', and has no children left.
+        self.assertEqual(index.prefixes, {'K': {'1': {None: {'b'}}}})
+        index.unsubscribe('b', 'K1*')
+        index.unsubscribe('a', 'K1-13')
+        self.assertEqual(index.prefixes, {})
+        self.assertEqual(index.exact, {})
+        self.assertFalse(index)
+
+    def testUnknownSubscriptionsAreIgnored(self):
+        index = SubscriptionIndex()
+        index.subscribe('a', 'K1*')
+        index.unsubscribe('a', 'K2*')
+        index.unsubscribe('b', 'K1*')
+        self.assertEqual(index.match('K1-13'), {'a'})
+
+    def testRemoveSubscriber(self):
+        index = SubscriptionIndex()
+        index.subscribe('a', 'K1*')
+        index.subscribe('a', 'X')
+        index.subscribe('b', 'K*')
+        index.removeSubscriber('a')
+        self.assertEqual(index.match('K1-13'), {'b'})
+        self.assertEqual(index.match('X'), set())
+        self.assertEqual(index.patterns, {'b': {'K*'}})
+
+
+class MonitorTest(LoopbackTestCase):
+
+    def setUp(self):
+        super(MonitorTest, self).setUp()
+        self.loopback = self.network('K1-13 -> X1\nK2-1 -> X2\n')
+        self.source = self.client(self.loopback, 'source', ['K1-13', 'K2-1'])
+        self.monitor = self.client(self.loopback, 'monitor', [])
+
+    def testMonitorSeesTheMatchingChanges(self):
+        self.monitor.subscribe(['K1*'])
+        self.loopback.pump()
+
+        self.source.pushTerminalState('K1-13', '48VDC')
+        self.source.pushTerminalState('K2-1', '48VDC')
+        self.loopback.pump()
+        self.assertEqual(self.monitor.monitored_states, [('source', 'K1-13', '48VDC')])
+
+    def testUnsubscribe(self):
+        self.monitor.subscribe(['K1*', 'K2-1'])
+        self.monitor.unsubscribe(['K1*'])
+        self.assertEqual(self.monitor.subscriptions, ['K2-1'])
+        self.loopback.pump()
+
+        self.source.pushTerminalState('K1-13', '48VDC')
+        self.source.pushTerminalState('K2-1', '48VDC')
+        self.loopback.pump()
+        self.assertEqual(self.monitor.monitored_states, [('source', 'K2-1', '48VDC')])
+
+    def testSubscriptionsAreSentAgainOnReconnect(self):
+        self.monitor.subscribe(['K*'])
+        self.loopback.pump()
+        self.monitor.disconnect()
+        self.assertFalse(self.loopback.core.subscriptions)
+
+        self.monitor.connect()
+        self.loopback.pump()
+        self.source.pushTerminalState('K2-1', '12VDC')
+        self.loopback.pump()
+        self.assertEqual(self.monitor.monitored_states, [('source', 'K2-1', '12VDC')])
+
+    def testMalformedPatternIsRejected(self):
+        with self.assertLogs('sas.core', 'WARNING'):
+            self.loopback.send(self.monitor.socket_id, b'subscribe:K*1\n')
+            self.loopback.pump()
+        self.assertFalse(self.loopback.core.subscriptions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from sas import tracing
+from sas.tracing import TraceBuffer, tracer
+
+from .loopback import LoopbackTestCase
+
+
+class TraceBufferTest(unittest.TestCase):
+
+    def testOldestRecordsAreDropped(self):
+        buffer = TraceBuffer(size=2)
+        for state in ('230VAC', '48VDC', '12VDC'):
+            buffer.record(tracing.changed_state, 'A', state, 'panel')
+        self.assertEqual([record[3] for record in buffer.records], ['48VDC', '12VDC'])
+
+    def testResizeKeepsTheNewestRecords(self):
+        buffer = TraceBuffer(size=4)
+        self.assertFalse(buffer.enabled)
+        for state in ('230VAC', '48VDC', '12VDC'):
+            buffer.record(tracing.changed_state, 'A', state)
+        buffer.enable(size=2)
+        self.assertTrue(buffer.enabled)
+        self.assertEqual([record[3] for record in buffer.records], ['48VDC', '12VDC'])
+
+        buffer.disable()
+        self.assertFalse(buffer.enabled)
+        buffer.clear()
+        self.assertEqual(buffer.format(), [])
+
+    def testDump(self):
+        buffer = TraceBuffer()
+        buffer.record(tracing.sent_state, 'B', '230VAC', 'panel')
+        self.assertEqual(len(buffer.format()), 1)
+        self.assertTrue(buffer.format()[0].endswith('sent state      B 230VAC panel'))
+        with self.assertLogs('sas.tracing', 'INFO') as logs:
+            buffer.dump()
+        self.assertIn('Trace of the last 1 events', logs.output[0])
+
+
+class RoutingTraceTest(LoopbackTestCase):
+
+    def setUp(self):
+        super(RoutingTraceTest, self).setUp()
+        tracer.clear()
+        tracer.enable()
+        self.addCleanup(tracer.clear)
+        self.addCleanup(tracer.disable)
+
+    def testRoutingIsTraced(self):
+        network = self.network('A -> B\n')
+        source = self.client(network, 'source', ['A'])
+        sink = self.client(network, 'sink', ['B'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+
+        events = [(event, terminal_name, state) for _, event, terminal_name, state, _ in tracer.records]
+        self.assertIn((tracing.registered, 'B', 'None'), events)
+        self.assertIn((tracing.pushed_state, 'A', '230VAC'), events)
+        self.assertIn((tracing.changed_state, 'A', '230VAC'), events)
+        self.assertIn((tracing.sent_state, 'B', '230VAC'), events)
+        self.assertIn((tracing.received_state, 'B', '230VAC'), events)
+        self.assertLess(events.index((tracing.changed_state, 'A', '230VAC')), events.index((tracing.sent_state, 'B', '230VAC')))
+
+    def testNothingIsTracedWhenDisabled(self):
+        tracer.disable()
+        network = self.network('A -> B\n')
+        source = self.client(network, 'source', ['A'])
+        source.pushTerminalState('A', '230VAC')
+        network.pump()
+        self.assertEqual(len(tracer.records), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sas import wiring
+
+
+class ParseTest(unittest.TestCase):
+
+    def testEntries(self):
+        text = '# A comment\n\nA -> B\n  C ->D,  E \n'
+        self.assertEqual(wiring.parseConnections(text), [('A', ('B', )), ('C', ('D', 'E'))])
+
+    def testMalformedLinesAreSkipped(self):
+        text = 'A -> B\nA B\nA -> B -> C\nA:1 -> B\nC -> D,\nE -> F\n'
+        with self.assertLogs('sas.wiring', 'WARNING') as logs:
+            entries = wiring.parseConnections(text, 'connections.txt')
+        self.assertEqual(entries, [('A', ('B', )), ('E', ('F', ))])
+        self.assertEqual(len(logs.output), 4)
+        self.assertIn('line 2 in connections.txt', logs.output[0])
+
+
+class CompileTest(unittest.TestCase):
+
+    def testNets(self):
+        compiled_connections = wiring.compileConnections([('A', ('B', )), ('C', ('D', )), ('E', ('F', 'G')), ('B', ('C', ))])
+        terminal_nets = compiled_connections.terminalNets()
+        # Nets are named after their first terminal in the file.
+        self.assertEqual({terminal_name: terminal_nets[terminal_name] for terminal_name in 'ABCDEFG'},
+                         {'A': 'A', 'B': 'A', 'C': 'A', 'D': 'A', 'E': 'E', 'F': 'E', 'G': 'E'})
+        self.assertEqual(compiled_connections.netMembers(), {'A': ('A', 'B', 'C', 'D'), 'E': ('E', 'F', 'G')})
+
+    def testEntriesAndCounts(self):
+        entries = [('A', ('B', 'C')), ('B', ('D', )), ('A', ('E', ))]
+        compiled_connections = wiring.compileConnections(entries)
+        self.assertEqual(list(compiled_connections.entries()), entries)
+        self.assertEqual(compiled_connections.entryCount(), 3)
+        self.assertEqual(compiled_connections.connectionCount(), 4)
+
+    def testLongChain(self):
+        # Joined one link at a time, which needs the path halving to stay fast.
+        terminal_names = ['T%d' % index for index in range(20000)]
+        entries = [(terminal_names[index + 1], (terminal_names[index], )) for index in range(len(terminal_names) - 1)]
+        compiled_connections = wiring.compileConnections(entries)
+        self.assertEqual(list(compiled_connections.netMembers()), ['T1'])
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.connections_path = os.path.join(directory.name, 'connections.txt')
+        self.compiled_path = self.connections_path + wiring.compiled_suffix
+
+    def write(self, text, mtime_offset=0):
+        with open(self.connections_path, 'w') as f:
+            f.write(text)
+        # The compiled file is matched by size and modification time, which a test writes within the same tick.
+        stat = os.stat(self.connections_path)
+        os.utime(self.connections_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + mtime_offset * 1000000000))
+
+    def load(self, **arguments):
+        timings = {}
+        compiled_connections = wiring.loadConnections(self.connections_path, timings=timings, **arguments)
+        return compiled_connections, sorted(timings)
+
+    def testMissingFile(self):
+        self.assertIsNone(wiring.loadConnections(self.connections_path))
+
+    def testFileRemovedWhileLoading(self):
+        self.write('A -> B\n')
+        stat = os.stat(self.connections_path)
+        os.remove(self.connections_path)
+        # Found by os.stat, but gone by the time it is opened.
+        with mock.patch('sas.wiring.os.stat', return_value=stat):
+            self.assertIsNone(wiring.loadConnections(self.connections_path))
+
+    def testCompiledFileIsReused(self):
+        self.write('A -> B\nB -> C\nD -> E\n')
+        compiled_connections, steps = self.load()
+        self.assertEqual(steps, ['compile', 'parse', 'save'])
+        self.assertTrue(os.path.exists(self.compiled_path))
+
+        loaded_connections, steps = self.load()
+        self.assertEqual(steps, ['load'])
+        self.assertEqual(list(loaded_connections.entries()), list(compiled_connections.entries()))
+        self.assertEqual(loaded_connections.terminalNets(), compiled_connections.terminalNets())
+        self.assertEqual(loaded_connections.netMembers(), compiled_connections.netMembers())
+
+    def testTouchedFileIsNotCompiledAgain(self):
+        self.write('A -> B\n')
+        self.load()
+        self.write('A -> B\n', mtime_offset=1)
+        _, steps = self.load()
+        self.assertEqual(steps, ['load'])
+
+    def testChangedFileIsCompiledAgain(self):
+        self.write('A -> B\n')
+        self.load()
+        # The same size, so only the modification time and the content tell them apart.
+        self.write('A -> C\n', mtime_offset=1)
+        compiled_connections, steps = self.load()
+        self.assertEqual(steps, ['compile', 'parse', 'save'])
+        self.assertEqual(list(compiled_connections.entries()), [('A', ('C', ))])
+        _, steps = self.load()
+        self.assertEqual(steps, ['load'])
+
+    def testBrokenCompiledFileIsReplaced(self):
+        self.write('A -> B\n')
+        with open(self.compiled_path, 'wb') as f:
+            f.write(b'garbage')
+        compiled_connections, steps = self.load()
+        self.assertIn('parse', steps)
+        self.assertEqual(list(compiled_connections.entries()), [('A', ('B', ))])
+        self.assertEqual(self.load()[1], ['load'])
+
+    def testWithoutCompiledFile(self):
+        self.write('A -> B\n')
+        compiled_connections, steps = self.load(use_compiled=False)
+        self.assertEqual(steps, ['compile', 'parse'])
+        self.assertFalse(os.path.exists(self.compiled_path))
+
+    def testEmptyFile(self):
+        self.write('# Nothing connected yet\n')
+        self.load()
+        compiled_connections, steps = self.load()
+        self.assertEqual(steps, ['load'])
+        self.assertEqual(compiled_connections.terminal_names, [])
+        self.assertEqual(compiled_connections.netMembers(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()